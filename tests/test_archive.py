@@ -0,0 +1,86 @@
+import random
+import time
+
+import pytest
+
+from tic_tac_toe import archive
+from tic_tac_toe.archive import NO_WINNER, O_WON, TIED, X_WON, Archive, ArchiveWriter, Tally
+
+PLAYERS = ["Smith", "Jones", "BOT", "Müller"]
+
+
+def random_games(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        marks = tuple(rng.sample(PLAYERS, 2))
+        moves = rng.sample(range(9), rng.randint(0, 9))
+        started = rng.randint(1_600_000_000, 1_700_000_000)
+        winner = rng.choice([X_WON, O_WON, TIED, NO_WINNER])
+        games.append((marks, moves, started, started + rng.randint(0, 300), winner))
+    return games
+
+
+@pytest.fixture
+def games(tmp_path):
+    games = random_games(500)
+    writer = ArchiveWriter(str(tmp_path), "test", segment_games=128)
+    for marks, moves, started, ended, winner in games:
+        writer.add(marks, moves, started, ended, winner, difficulty=len(moves) % 3)
+    writer.close()
+    return games
+
+
+def expected_win_rates(games):
+    tallies = {}
+    for (x, o), _, _, _, winner in games:
+        for player, won, lost in ((x, X_WON, O_WON), (o, O_WON, X_WON)):
+            tallies.setdefault(player, Tally()).add(1, winner == won, winner == lost, winner == TIED)
+    return tallies
+
+
+def expected_first_moves(games):
+    tallies = {pos: Tally() for pos in range(9)}
+    for _, moves, _, _, winner in games:
+        if moves:
+            tallies[moves[0]].add(1, winner == X_WON, winner == O_WON, winner == TIED)
+    return tallies
+
+
+def test_round_trip(tmp_path, games):
+    assert len(Archive(str(tmp_path)).paths()) == 4
+    records = list(Archive(str(tmp_path)))
+    assert [(record.marks, record.moves, record.started, record.seconds, record.winner) for record in records] == [
+        (marks, moves, started, ended - started, winner) for marks, moves, started, ended, winner in games
+    ]
+    assert [record.difficulty for record in records] == [len(moves) % 3 for _, moves, _, _, _ in games]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False], ids=["numpy", "python"])
+def test_queries(tmp_path, monkeypatch, games, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(archive, "numpy", None)
+    queried = Archive(str(tmp_path))
+    assert queried.win_rates() == expected_win_rates(games)
+    assert queried.first_moves() == expected_first_moves(games)
+
+
+def test_skips_truncated_segments(tmp_path, games):
+    queried = Archive(str(tmp_path))
+    last = queried.paths()[-1]
+    with open(last, "r+b") as segment:
+        segment.truncate(100)
+    assert len(queried) == 128 * 3
+
+
+def test_flushes_after_interval_without_more_games(tmp_path):
+    writer = ArchiveWriter(str(tmp_path), "test", flush_interval=0.05)
+    writer.add(("Smith", "BOT"), [4, 0], 1_600_000_000, 1_600_000_010, X_WON, difficulty=1)
+    deadline = time.monotonic() + 5
+    while not Archive(str(tmp_path)).paths() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [record.moves for record in Archive(str(tmp_path))] == [[4, 0]]
+    assert len(writer) == 0
+    writer.close()
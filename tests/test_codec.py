@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+from tic_tac_toe import codec
+from tic_tac_toe.bench import SAMPLES
+from tic_tac_toe.messages import Acc, Codes, HandShake, Message, MessageType, Result, SendMessage, SocketType, WireFormat
+
+FORMATS = [WireFormat.JSON] + sorted(codec.binary_formats)
+
+
+def values(message: Message):
+    return message.message_type, message.ack, codec.message_codecs[message.message_type].to_values(message)
+
+
+@pytest.mark.parametrize("wire_format", FORMATS)
+@pytest.mark.parametrize("message", SAMPLES.values(), ids=lambda message: message.message_type.name)
+def test_frame_round_trip(wire_format, message):
+    frame = codec.encode_frame(message, wire_format)
+    frames, consumed = codec.decode_frames(frame)
+    assert consumed == len(frame)
+    assert [values(decoded) for decoded in frames] == [values(message)]
+
+
+@pytest.mark.parametrize("wire_format", FORMATS)
+def test_no_ack_round_trip(wire_format):
+    message = SendMessage("hi", "Jones", message_id=3)
+    message.ack = False
+    (decoded,), _ = codec.decode_frames(codec.encode_frame(message, wire_format))
+    assert decoded.ack is False
+
+
+def test_mixed_stream():
+    samples = list(SAMPLES.values())
+    stream = b"".join(
+        codec.encode_frame(message, FORMATS[index % len(FORMATS)]) for index, message in enumerate(samples)
+    )
+    frames, consumed = codec.decode_frames(stream)
+    assert consumed == len(stream)
+    assert [values(frame) for frame in frames] == [values(message) for message in samples]
+
+
+@pytest.mark.parametrize("wire_format", FORMATS)
+def test_incomplete_frames_are_left(wire_format):
+    first = codec.encode_frame(SAMPLES[next(iter(SAMPLES))], wire_format)
+    second = codec.encode_frame(SendMessage("good game; well played", "Jones", message_id=9), wire_format)
+    stream = first + second
+    for size in range(len(stream) + 1):
+        frames, consumed = codec.decode_frames(stream[:size])
+        complete = [len(first)] * (size >= len(first)) + [len(second)] * (size == len(stream))
+        assert len(frames) == len(complete)
+        assert consumed == sum(complete)
+
+
+def test_delimiter_in_text_is_escaped():
+    frame = codec.encode_frame(SendMessage("a;b;;c", "Jones", message_id=1))
+    assert frame.count(codec.JSON_DELIMITER) == 1
+    (decoded,), _ = codec.decode_frames(frame)
+    assert decoded.text == "a;b;;c"
+
+
+@pytest.mark.parametrize("data", [
+    b"not json;",
+    b'{"message_type": 12};',
+    b'{"no_type": 1};',
+    b"[1, 2];",
+    b"\x00\x00\x00\x00\x01\x7f",
+    b"\x00\x00\x00\x00\x02\x0c\x81",
+    b"\x00\xff\xff\xff\xff\x01",
+    b"x" * (codec.MAX_FRAME_SIZE + 1),
+])
+def test_corrupt_frames_raise(data):
+    with pytest.raises(codec.FrameError):
+        codec.decode_frames(data)
+
+
+@pytest.mark.parametrize("message", SAMPLES.values(), ids=lambda message: message.message_type.name)
+def test_json_backends_agree(message):
+    encoded = [codec.serialize(message, backend) for backend in codec.json_backends]
+    assert len(set(encoded)) == 1
+    for backend in codec.json_backends:
+        assert values(codec.get_message(memoryview(encoded[0]), backend)) == values(message)
+
+
+@pytest.mark.parametrize("message", SAMPLES.values(), ids=lambda message: message.message_type.name)
+def test_values_round_trip(message):
+    message_codec = codec.message_codecs[message.message_type]
+    assert message_codec.to_values(message_codec.from_values(message_codec.to_values(message))) == (
+        message_codec.to_values(message)
+    )
+
+
+def test_unset_optional_fields_are_left_out_of_json():
+    data = codec.message_codecs[MessageType.HAND_SHAKE].to_dict(HandShake(SocketType.CLIENT, "Smith", message_id=1))
+    assert data == {"message_type": MessageType.HAND_SHAKE, "message_id": 1, "socket_type": SocketType.CLIENT,
+                    "username": "Smith"}
+
+
+def test_json_from_older_peer():
+    message = codec.get_message(b'{"message_type": 1, "message_id": 4, "socket_type": 1, "username": "Smith"}')
+    assert isinstance(message, HandShake)
+    assert message.ack is True
+    assert (message.username, message.wire_formats, message.token) == ("Smith", None, None)
+
+
+@pytest.mark.parametrize("wire_format", FORMATS)
+def test_handshake_acc_carries_username(wire_format):
+    acc = Acc(*Codes.OK, message_id=1, token="abc", username="Smith")
+    (decoded,), _ = codec.decode_frames(codec.encode_frame(acc, wire_format))
+    assert (decoded.token, decoded.username) == ("abc", "Smith")
+
+
+@pytest.mark.parametrize(
+    "message", [message for message in SAMPLES.values() if message.message_type in codec.LEGACY_FIELDS],
+    ids=lambda message: message.message_type.name,
+)
+def test_legacy_json_only_has_fields_old_peers_know(message):
+    frame = codec.encode_frame(message, WireFormat.LEGACY_JSON)
+    data = json.loads(frame[:-1])
+    assert set(data) == {"message_type", "message_id", *codec.LEGACY_FIELDS[message.message_type]}
+
+
+def test_legacy_json_result_is_a_list_of_cells():
+    result = Result.pack(["Smith", None, "BOT"] + [None] * 6, ["Smith", "BOT"], None, game_id=3)
+    data = json.loads(codec.encode_frame(result, WireFormat.LEGACY_JSON)[:-1])
+    assert data["game_state"] == ["Smith", None, "BOT"] + [None] * 6
+
+
+def test_legacy_json_acc_has_no_token_or_username():
+    acc = Acc(*Codes.OK, message_id=1, token="abc", username="Smith")
+    data = json.loads(codec.encode_frame(acc, WireFormat.LEGACY_JSON)[:-1])
+    assert data == {"message_type": MessageType.ACC, "message_id": 1, "result": 0, "text": "OK"}
+
+
+def test_negotiate():
+    assert codec.negotiate(None) is None
+    assert codec.negotiate([250, WireFormat.BINARY]) == WireFormat.BINARY
+    assert codec.negotiate(codec.WIRE_FORMATS) == codec.WIRE_FORMATS[0]
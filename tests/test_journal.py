@@ -0,0 +1,73 @@
+from tic_tac_toe.journal import HEADER, Journal, JournaledGame
+
+
+def play(journal: Journal, games: int, moves: int = 3):
+    for game_id in range(1, games + 1):
+        journal.start(game_id, ("Smith", "BOT"), 1, 1000.0 + game_id)
+        for pos in range(moves):
+            journal.move(game_id, (game_id + pos) % 9)
+        if game_id % 3 == 0:
+            journal.end(game_id)
+
+
+def reopen(path: str) -> Journal:
+    return Journal(path, "f" * 32)
+
+
+def test_recovers_games(tmp_path):
+    path = str(tmp_path / "games.journal")
+    journal = Journal(path, "a" * 32)
+    play(journal, 5)
+    expected = dict(journal.games)
+    journal.close()
+    recovered = reopen(path)
+    assert recovered.server_id == "a" * 32
+    assert recovered.games == expected
+    assert recovered.games[1] == JournaledGame(("Smith", "BOT"), 1, 1001.0, [1, 2, 3])
+    recovered.close()
+
+
+def test_recovers_across_snapshots(tmp_path):
+    path = str(tmp_path / "games.journal")
+    journal = Journal(path, "a" * 32, size=HEADER.size + 512)
+    play(journal, 40)
+    assert journal.generation > 0
+    expected, generation = dict(journal.games), journal.generation
+    journal.close()
+    recovered = reopen(path)
+    assert (recovered.games, recovered.generation) == (expected, generation)
+    # carries on appending after the recovered records
+    recovered.move(1, 8)
+    recovered.close()
+    again = reopen(path)
+    assert again.games[1].moves == expected[1].moves + [8]
+    again.close()
+
+
+def test_recovers_from_snapshot_of_next_generation(tmp_path, monkeypatch):
+    path = str(tmp_path / "games.journal")
+    journal = Journal(path, "a" * 32)
+    play(journal, 5)
+    expected = dict(journal.games)
+    # dies after the snapshot is in place but before the file starts over
+    monkeypatch.setattr(journal, "clear", lambda: None)
+    journal.snapshot()
+    journal.close()
+    recovered = reopen(path)
+    assert (recovered.games, recovered.generation) == (expected, 1)
+    assert recovered.pos == HEADER.size
+    recovered.close()
+
+
+def test_torn_record_ends_replay(tmp_path):
+    path = str(tmp_path / "games.journal")
+    journal = Journal(path, "a" * 32)
+    play(journal, 2)
+    last = journal.pos
+    journal.move(2, 0)
+    journal.mm[journal.pos - 1] ^= 0xFF
+    journal.close()
+    recovered = reopen(path)
+    assert recovered.games[2].moves == [2, 3, 4]
+    assert recovered.pos == last
+    recovered.close()
@@ -0,0 +1,51 @@
+import pytest
+
+from tic_tac_toe.matchmaking import Matchmaker
+from tic_tac_toe.messages import Difficulty, GameType
+from tic_tac_toe.models import GameServerData, User
+
+
+def join(matchmaker: Matchmaker, username: str, game_type: GameType = GameType.SINGLE_PLAYER):
+    return matchmaker.join(User(object(), None, username), game_type, Difficulty.EASY)
+
+
+@pytest.mark.parametrize("take_out", ["remove_server", "suspend", "retire"])
+def test_released_game_doesnt_bring_back_its_server(take_out):
+    matchmaker = Matchmaker()
+    server = GameServerData([], 2)
+    matchmaker.add_server(server)
+    game = join(matchmaker, "Smith").game.result(0)
+    if take_out == "retire":
+        # only a server without games can be retired
+        assert not matchmaker.retire(server)
+        matchmaker.release(game)
+        assert matchmaker.retire(server)
+    else:
+        getattr(matchmaker, take_out)(server)
+        assert matchmaker.release(game)
+    assert id(server) not in matchmaker.free
+    assert not join(matchmaker, "Jones").game.done()
+
+
+def test_server_added_back_seats_waiting_players():
+    matchmaker = Matchmaker()
+    server = GameServerData([], 1)
+    matchmaker.add_server(server)
+    game = join(matchmaker, "Smith").game.result(0)
+    matchmaker.suspend(server)
+    matchmaker.release(game)
+    ticket = join(matchmaker, "Jones")
+    matchmaker.add_server(server)
+    assert ticket.game.result(0).server is server
+
+
+def test_cancel_after_remove_doesnt_bring_back_its_server():
+    matchmaker = Matchmaker()
+    server = GameServerData([], 2)
+    matchmaker.add_server(server)
+    ticket = join(matchmaker, "Smith", GameType.MULTI_PLAYER)
+    ticket.game.result(0)
+    matchmaker.remove_server(server)
+    matchmaker.cancel(ticket)
+    assert id(server) not in matchmaker.free
+    assert not join(matchmaker, "Jones").game.done()
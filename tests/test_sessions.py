@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from tic_tac_toe.models import User
+from tic_tac_toe.registry import UserRegistry
+from tic_tac_toe.sessions import SessionTokens
+
+KEY = b"k" * 32
+TTL = 0.01
+
+
+def register(registry: UserRegistry, username: str) -> User:
+    user = User(object(), None, username)
+    registry.add(user)
+    return user
+
+
+def test_issued_token_verifies():
+    tokens = SessionTokens(KEY)
+    token = tokens.issue("Smith", "00ff")
+    assert tokens.verify(token) == ("Smith", "00ff")
+    assert SessionTokens.nonce(token) == "00ff"
+    # usernames may have dots, the nonce and mac never do
+    assert tokens.verify(tokens.issue("J.R.R.", "00ff")) == ("J.R.R.", "00ff")
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda token: token.replace("Smith", "Jones", 1),
+    lambda token: token.replace(".00ff.", ".00fe.", 1),
+    lambda token: token[:-1] + ("0" if token[-1] != "0" else "1"),
+    lambda token: token[:-1],
+    lambda token: token + "0",
+    lambda token: token.rsplit(".", 1)[0],
+], ids=["username", "nonce", "mac", "short mac", "long mac", "no mac"])
+def test_tampered_token_is_rejected(tamper):
+    tokens = SessionTokens(KEY)
+    assert tokens.verify(tamper(tokens.issue("Smith", "00ff"))) is None
+
+
+@pytest.mark.parametrize("token", [None, "", "Smith", "Smith.00ff", "..", "Smith.00ff.zz"])
+def test_malformed_token_is_rejected(token):
+    assert SessionTokens(KEY).verify(token) is None
+
+
+def test_token_of_another_key_is_rejected():
+    assert SessionTokens(KEY).verify(SessionTokens(b"x" * 32).issue("Smith", "00ff")) is None
+    # the default key is random so tokens don't survive a restart
+    assert SessionTokens().verify(SessionTokens().issue("Smith", "00ff")) is None
+
+
+def test_token_expires_with_its_user():
+    tokens, registry = SessionTokens(KEY), UserRegistry(TTL)
+    user = register(registry, "Smith")
+    username, nonce = tokens.verify(tokens.issue(user.username, user.session.nonce))
+    assert registry.get(username) is user
+    registry.disconnect(user.socket_handler)
+    time.sleep(2 * TTL)
+    assert not registry.connect(user, object())
+    assert registry.get(username) is None
+    # someone else registering the name doesn't bring the old token back
+    again = register(registry, "Smith")
+    assert again.username == "Smith"
+    assert again.session.nonce != nonce
+
+
+def test_user_in_game_is_kept():
+    registry = UserRegistry(TTL)
+    user = register(registry, "Smith")
+    user.game = object()
+    registry.disconnect(user.socket_handler)
+    time.sleep(2 * TTL)
+    assert registry.get("Smith") is user
+    assert registry.connect(user, object())
+    assert user.online
+
+
+@pytest.mark.parametrize("username", sorted(UserRegistry.RESERVED))
+def test_reserved_names_are_taken(username):
+    assert register(UserRegistry(TTL), username).username == f"{username}2"
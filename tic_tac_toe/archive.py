@@ -0,0 +1,492 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from tic_tac_toe.board import Board
+from tic_tac_toe.logger import get_logger
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+MAGIC = b"TTTA"
+VERSION = 1
+SUFFIX = ".segment"
+# magic, version, games, players
+HEADER = struct.Struct("<4sBxxxII")
+# name, array typecode, numpy dtype
+COLUMNS = (
+    ("started", "I", "<u4"),
+    ("seconds", "H", "<u2"),
+    ("x", "I", "<u4"),
+    ("o", "I", "<u4"),
+    ("difficulty", "B", "u1"),
+    ("winner", "B", "u1"),
+)
+# every move is a nibble of position + 1, the first move in the lowest one, 0 after the last
+MOVES_SIZE = 5
+ALIGN = 8
+
+X_WON, O_WON, TIED, NO_WINNER = 0, 1, 2, 3
+
+
+def pack_moves(moves: Sequence[int]) -> bytes:
+    value = 0
+    for index, pos in enumerate(moves):
+        value |= (pos + 1) << 4 * index
+    return value.to_bytes(MOVES_SIZE, "little")
+
+
+def unpack_moves(data: bytes) -> List[int]:
+    value = int.from_bytes(data, "little")
+    moves = []
+    while value:
+        moves.append((value & 15) - 1)
+        value >>= 4
+    return moves
+
+
+def replay(moves: Sequence[int]) -> Iterator[Board]:
+    """
+    The board after every move, played by the `Board` games are played on
+    """
+    board = Board()
+    for pos in moves:
+        if board.outcome is not None or not board.is_free(pos):
+            raise ValueError(f"Move {pos} can't be played on {board.cells:#x}")
+        board.play(pos)
+        yield board.copy()
+
+
+def layout(games: int, players: int) -> Dict[str, int]:
+    """
+    Offset of every column in a segment
+    Notes:
+        the player table at `names` is `players` + 1 uint32 ends of the names,
+        the utf-8 names follow at `blob` until the end of the file
+    """
+    offsets = {}
+    offset = HEADER.size
+    for name, typecode, _ in COLUMNS:
+        offsets[name] = offset
+        offset += -(-games * array(typecode).itemsize // ALIGN) * ALIGN
+    offsets["moves"] = offset
+    offset += -(-games * MOVES_SIZE // ALIGN) * ALIGN
+    offsets["names"] = offset
+    offsets["blob"] = offset + (players + 1) * 4
+    return offsets
+
+
+def little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_segment(columns: Dict[str, array], moves: bytes, names: Sequence[str]) -> bytes:
+    games = len(moves) // MOVES_SIZE
+    offsets = layout(games, len(names))
+    encoded = [name.encode() for name in names]
+    ends = array("I", [0])
+    for name in encoded:
+        ends.append(ends[-1] + len(name))
+    data = bytearray(offsets["blob"] + ends[-1])
+    HEADER.pack_into(data, 0, MAGIC, VERSION, games, len(names))
+    for name, _, _ in COLUMNS:
+        column = little_endian(columns[name])
+        data[offsets[name]:offsets[name] + len(column)] = column
+    data[offsets["moves"]:offsets["moves"] + len(moves)] = moves
+    data[offsets["names"]:offsets["blob"]] = little_endian(ends)
+    data[offsets["blob"]:] = b"".join(encoded)
+    return bytes(data)
+
+
+@dataclass
+class GameRecord:
+    marks: Tuple[str, str]
+    moves: List[int]
+    started: int
+    seconds: int
+    winner: int
+    difficulty: int = 0
+
+    @property
+    def winner_name(self) -> Optional[str]:
+        """
+        Same as `GameEnded.winner`
+        """
+        if self.winner == TIED:
+            return 'TIE'
+        if self.winner == NO_WINNER:
+            return None
+        return self.marks[self.winner]
+
+    def boards(self) -> Iterator[Board]:
+        return replay(self.moves)
+
+    def board(self) -> Board:
+        board = Board()
+        for board in self.boards():
+            pass
+        return board
+
+
+@dataclass
+class Tally:
+    games: int = 0
+    wins: int = 0
+    losses: int = 0
+    ties: int = 0
+
+    @property
+    def win_rate(self) -> float:
+        return self.wins / self.games if self.games else 0.0
+
+    def add(self, games: int, wins: int, losses: int, ties: int):
+        self.games += int(games)
+        self.wins += int(wins)
+        self.losses += int(losses)
+        self.ties += int(ties)
+
+
+class ArchiveWriter:
+    """
+    Appends finished games to segment files in `directory`
+    Notes:
+        games are buffered as columns and written out as one segment every
+        `segment_games` games, by a thread once the oldest buffered game waited
+        `flush_interval` seconds and on `close`, a crash loses what's still buffered
+        a segment is written to a temporary file and renamed so readers only see whole ones,
+        names start with the time they're written at so they sort oldest first
+    """
+
+    logger = get_logger("archive", split=" ")
+    SEGMENT_GAMES = 1 << 16
+    FLUSH_INTERVAL = 60.0
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        segment_games: int = SEGMENT_GAMES,
+        flush_interval: float = FLUSH_INTERVAL,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.segment_games = segment_games
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffered = threading.Condition(self.lock)
+        self.stopped = False
+        self.reset()
+        self.thread = threading.Thread(target=self.run, name="archive", daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        self.columns = {name: array(typecode) for name, typecode, _ in COLUMNS}
+        self.moves = bytearray()
+        self.players: Dict[str, int] = {}
+        self.oldest: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.moves) // MOVES_SIZE
+
+    def player(self, name: str) -> int:
+        return self.players.setdefault(name, len(self.players))
+
+    def add(
+        self,
+        marks: Sequence[str],
+        moves: Sequence[int],
+        started: float,
+        ended: float,
+        winner: int,
+        difficulty: int = 0,
+    ):
+        """
+        Args:
+            winner: `X_WON`, `O_WON`, `TIED` or `NO_WINNER`
+            difficulty: of the bot, 0 between two players
+        """
+        with self.lock:
+            columns = self.columns
+            columns["started"].append(int(started))
+            columns["seconds"].append(min(max(int(ended - started), 0), 0xFFFF))
+            columns["x"].append(self.player(marks[0]))
+            columns["o"].append(self.player(marks[1]))
+            columns["difficulty"].append(difficulty)
+            columns["winner"].append(winner)
+            self.moves += pack_moves(moves)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+                self.buffered.notify()
+            if len(self) >= self.segment_games:
+                self.write()
+
+    def run(self):
+        with self.lock:
+            while not self.stopped:
+                if self.oldest is None:
+                    self.buffered.wait()
+                    continue
+                delay = self.oldest + self.flush_interval - time.monotonic()
+                if delay > 0:
+                    self.buffered.wait(delay)
+                    continue
+                self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        """
+        Write what's buffered as a segment, caller holds the lock
+        """
+        if not len(self):
+            return
+        started = time.perf_counter()
+        path = os.path.join(self.directory, f"{time.time_ns() // 1000:017d}-{self.name}{SUFFIX}")
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as segment:
+            segment.write(encode_segment(self.columns, self.moves, list(self.players)))
+        os.replace(temporary, path)
+        self.logger.info(
+            "Archived %d games to %s in %.1fms", len(self), path, (time.perf_counter() - started) * 1000
+        )
+        self.reset()
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.buffered.notify()
+        self.thread.join()
+        self.flush()
+
+
+class Segment:
+    """
+    A segment file mapped read-only, columns are views of the mapping so only what's used is read
+    Notes:
+        player ids are indexes into `names`, which only holds for this segment
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            raise ValueError(f"{path} is truncated")
+        magic, version, self.count, players = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} isn't an archive segment")
+        self.offsets = layout(self.count, players)
+        if len(self.mm) < self.offsets["blob"]:
+            raise ValueError(f"{path} is truncated")
+        ends = self.column("names", "I", players + 1)
+        blob = self.offsets["blob"]
+        if len(self.mm) != blob + ends[-1]:
+            raise ValueError(f"{path} is truncated")
+        self.names = [self.mm[blob + start:blob + end].decode() for start, end in zip(ends, ends[1:])]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def column(self, name: str, typecode: str, count: Optional[int] = None) -> Sequence[int]:
+        count = self.count if count is None else count
+        offset = self.offsets[name]
+        view = memoryview(self.mm)[offset:offset + count * array(typecode).itemsize]
+        if sys.byteorder == "little":
+            return view.cast(typecode)
+        values = array(typecode, view.tobytes())
+        values.byteswap()
+        return values
+
+    def columns(self) -> Dict[str, Sequence[int]]:
+        return {name: self.column(name, typecode) for name, typecode, _ in COLUMNS}
+
+    def arrays(self) -> Dict[str, "numpy.ndarray"]:
+        """
+        The columns as numpy arrays over the mapping, `moves` is a games x `MOVES_SIZE` array of bytes
+        """
+        arrays = {
+            name: numpy.frombuffer(self.mm, dtype, self.count, self.offsets[name]) for name, _, dtype in COLUMNS
+        }
+        arrays["moves"] = numpy.frombuffer(
+            self.mm, "u1", self.count * MOVES_SIZE, self.offsets["moves"]
+        ).reshape(self.count, MOVES_SIZE)
+        return arrays
+
+    def first_moves(self) -> bytes:
+        """
+        Lowest byte of the moves of every game, its low nibble is the first move + 1
+        """
+        start = self.offsets["moves"]
+        return self.mm[start:start + self.count * MOVES_SIZE:MOVES_SIZE]
+
+    def __iter__(self) -> Iterator[GameRecord]:
+        names, moves = self.names, self.offsets["moves"]
+        columns = self.columns()
+        rows = zip(*(columns[name] for name, _, _ in COLUMNS))
+        for index, (started, seconds, x, o, difficulty, winner) in enumerate(rows):
+            start = moves + index * MOVES_SIZE
+            yield GameRecord(
+                (names[x], names[o]), unpack_moves(self.mm[start:start + MOVES_SIZE]),
+                started, seconds, winner, difficulty,
+            )
+
+
+class Archive:
+    """
+    Every segment in `directory`, oldest first
+    Notes:
+        bulk queries go over the columns a segment at a time, with numpy when it's installed
+    """
+
+    logger = get_logger("archive", split=" ")
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def paths(self) -> List[str]:
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(SUFFIX)
+        )
+
+    def segments(self) -> Iterator[Segment]:
+        for path in self.paths():
+            try:
+                yield Segment(path)
+            except ValueError as e:
+                self.logger.warning("Skipping %s", e)
+
+    def __iter__(self) -> Iterator[GameRecord]:
+        for segment in self.segments():
+            yield from segment
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments())
+
+    def win_rates(self) -> Dict[str, Tally]:
+        """
+        Games, wins, losses and ties of every player
+        """
+        tallies: Dict[str, Tally] = {}
+        for segment in self.segments():
+            players = len(segment.names)
+            if numpy is not None:
+                columns = segment.arrays()
+                x, o, winner = columns["x"], columns["o"], columns["winner"]
+
+                def count(ids, outcome):
+                    return numpy.bincount(ids[winner == outcome], minlength=players)
+
+                counts = zip(
+                    numpy.bincount(x, minlength=players) + numpy.bincount(o, minlength=players),
+                    count(x, X_WON) + count(o, O_WON),
+                    count(x, O_WON) + count(o, X_WON),
+                    count(x, TIED) + count(o, TIED),
+                )
+            else:
+                counts = [[0, 0, 0, 0] for _ in range(players)]
+                columns = segment.columns()
+                for x, o, winner in zip(columns["x"], columns["o"], columns["winner"]):
+                    counts[x][0] += 1
+                    counts[o][0] += 1
+                    if winner == X_WON:
+                        counts[x][1] += 1
+                        counts[o][2] += 1
+                    elif winner == O_WON:
+                        counts[o][1] += 1
+                        counts[x][2] += 1
+                    elif winner == TIED:
+                        counts[x][3] += 1
+                        counts[o][3] += 1
+            for name, row in zip(segment.names, counts):
+                tallies.setdefault(name, Tally()).add(*row)
+        return tallies
+
+    def first_moves(self) -> Dict[int, Tally]:
+        """
+        Games by the cell they were opened on, wins and losses are the first player's
+        """
+        counts = [[0, 0, 0, 0] for _ in range(9)]
+        for segment in self.segments():
+            if numpy is not None:
+                columns = segment.arrays()
+                first = (columns["moves"][:, 0] & 15).astype(numpy.intp) - 1
+                played = first >= 0
+                first, winner = first[played], columns["winner"][played]
+                for column, outcome in ((0, None), (1, X_WON), (2, O_WON), (3, TIED)):
+                    cells = first if outcome is None else first[winner == outcome]
+                    for pos, count in enumerate(numpy.bincount(cells, minlength=9)):
+                        counts[pos][column] += int(count)
+            else:
+                winners = segment.column("winner", "B")
+                columns = {X_WON: 1, O_WON: 2, TIED: 3}
+                for first, winner in zip(segment.first_moves(), winners):
+                    pos = (first & 15) - 1
+                    if pos < 0:
+                        continue
+                    counts[pos][0] += 1
+                    if winner in columns:
+                        counts[pos][columns[winner]] += 1
+        return {pos: Tally(*row) for pos, row in enumerate(counts)}
+
+
+if __name__ == "__main__":
+    from tic_tac_toe.bench import print_rows
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="where the game servers archived their games")
+    parser.add_argument("query", choices=("summary", "win-rates", "first-moves", "games"))
+    parser.add_argument("--limit", type=int, default=20, help="rows printed")
+    args = parser.parse_args()
+    archive = Archive(args.directory)
+    started = time.perf_counter()
+    if args.query == "summary":
+        segments = list(archive.segments())
+        games = sum(len(segment) for segment in segments)
+        size = sum(len(segment.mm) for segment in segments)
+        rows = [{
+            "segments": len(segments),
+            "games": games,
+            "MB": size / 1e6,
+            "bytes_per_game": size / games if games else 0.0,
+        }]
+    elif args.query == "win-rates":
+        tallies = sorted(archive.win_rates().items(), key=lambda item: item[1].games, reverse=True)
+        rows = [
+            {"player": name, "games": tally.games, "wins": tally.wins, "losses": tally.losses,
+             "ties": tally.ties, "win_rate": tally.win_rate}
+            for name, tally in tallies[:args.limit]
+        ]
+    elif args.query == "first-moves":
+        rows = [
+            {"cell": pos, "games": tally.games, "wins": tally.wins, "losses": tally.losses,
+             "ties": tally.ties, "win_rate": tally.win_rate}
+            for pos, tally in archive.first_moves().items()
+        ]
+    else:
+        rows = []
+        for record in archive:
+            if len(rows) == args.limit:
+                break
+            rows.append({
+                "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.started)),
+                "x": record.marks[0], "o": record.marks[1], "winner": record.winner_name,
+                "moves": "".join(map(str, record.moves)), "seconds": record.seconds,
+            })
+    if rows:
+        print_rows(rows)
+    print(f"{args.query} took {time.perf_counter() - started:.2f}s")
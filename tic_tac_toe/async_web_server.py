@@ -0,0 +1,137 @@
+import asyncio
+import socket
+import traceback
+from typing import Callable, Optional
+
+from tic_tac_toe.defensive import defensive
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.messages import (
+    Message,
+    HandShake,
+    SocketType,
+    RequestNewGame,
+    Codes,
+    GameFound,
+    WaitForOpponent,
+)
+from tic_tac_toe.models import GameServerData, User
+from tic_tac_toe.socket_handler import AsyncSocketHandler
+from tic_tac_toe.web_server import WebServer
+
+
+class AsyncWebServer(WebServer):
+    """
+    Same handshake, matchmaking and relay as `WebServer` but every client and
+    game server socket is multiplexed on a single asyncio event loop
+    so an idle player costs a transport instead of a thread
+    """
+
+    logger = get_logger("async-web-server", split=" ")
+    BACKLOG = 4096
+
+    def __init__(self, user_ttl: float = WebServer.USER_TTL, session_key: Optional[bytes] = None):
+        super().__init__(user_ttl, session_key)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def handle_handshake(self, socket_handler: AsyncSocketHandler, message: HandShake):
+        self.logger.info("Handle socket %s", message)
+        if not self.valid_handshake(message):
+            socket_handler.close()
+        elif message.socket_type == SocketType.GAME:
+            socket_handler.peer = self.add_game_server(socket_handler, message)
+        else:
+            socket_handler.peer = self.add_client(socket_handler, message)
+            if socket_handler.peer is None:
+                socket_handler.close()
+
+    def handle_message(self, socket_handler: AsyncSocketHandler, message: Message):
+        """
+        Notes:
+            every connection shares the loop, a message that can't be handled
+            drops its own connection rather than taking the loop down
+        """
+        try:
+            if socket_handler.peer is None:
+                self.handle_handshake(socket_handler, message)
+            elif isinstance(socket_handler.peer, GameServerData):
+                self.handle_game_server_message(socket_handler.peer, message, socket_handler)
+            else:
+                self.handle_client_message(socket_handler.peer, message)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.error("Dropping the connection, handling %s failed\n%s", message, traceback.format_exc())
+            socket_handler.shutdown()
+
+    def handle_close(self, socket_handler: AsyncSocketHandler):
+        if isinstance(socket_handler.peer, User):
+            self.remove_client(socket_handler)
+        elif isinstance(socket_handler.peer, GameServerData):
+            self.remove_link(socket_handler.peer, socket_handler)
+
+    def new_game(self, user: User, message: RequestNewGame):
+        asyncio.ensure_future(self.wait_for_game(user, message))
+
+    async def wait_for_game(self, user: User, message: RequestNewGame):
+        self.logger.info("New game")
+        socket_handler = user.socket_handler
+        socket_handler.send_acc(message.message_id, *Codes.WAIT_FOR_EMPTY_SERVER)
+        self.logger.info("Wait for game")
+        # `handle_close` cancels the ticket of a player that disconnects
+        ticket = self.tickets[id(socket_handler)] = self.matchmaker.join(user, message.game_type, message.difficulty)
+        try:
+            user.game = await asyncio.wrap_future(ticket.game)
+            user.socket_handler.send_message(WaitForOpponent(), False)
+            await asyncio.wrap_future(ticket.ready)
+        except asyncio.CancelledError:
+            self.logger.error("%s left matchmaking or its game server did", user.username)
+            if user.game is not None:
+                self.game_lost(user, user.game)
+            return
+        finally:
+            self.tickets.pop(id(socket_handler), None)
+        self.logger.info("Found game")
+        game = user.game
+        self.router.join(game)
+        acc = await user.socket_handler.request(GameFound(self.router.opponent(user).username))
+        if acc is None:
+            self.logger.error("User disconnected")
+            self.abort_game(game)
+            return
+        self.logger.info("Acc game found %d %s", acc.result, acc.text)
+        self.start_game(game)
+
+    def start_keep_alive(self):
+        self.keep_alive.start(self.loop)
+
+    def close_game_server(self, server: GameServerData):
+        for link in list(server.links):
+            self.loop.call_soon_threadsafe(link.shutdown)
+
+    def call_later(self, delay: float, callback: Callable, *args):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback, *args)
+
+    def make_handler(self) -> AsyncSocketHandler:
+        return AsyncSocketHandler(self.handle_message, self.handle_close)
+
+    def adopt(self, conn: socket.socket):
+        self.loop.call_soon_threadsafe(
+            self.loop.create_task, self.loop.connect_accepted_socket(self.make_handler, conn)
+        )
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await self.loop.create_server(
+            self.make_handler, sock=self.listen(), backlog=self.BACKLOG,
+        )
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    @defensive(logger.error)
+    def handle_sockets(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
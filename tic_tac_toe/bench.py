@@ -0,0 +1,489 @@
+import argparse
+import io
+import itertools
+import random
+import time
+import timeit
+import tracemalloc
+from typing import Dict, List, Optional
+
+from tic_tac_toe import codec, messages
+from tic_tac_toe.messages import Message, MessageType, WireFormat, messages_types
+
+SAMPLES: Dict[MessageType, Message] = {
+    MessageType.HAND_SHAKE: messages.HandShake(
+        messages.SocketType.CLIENT, "Smith", wire_formats=codec.WIRE_FORMATS
+    ),
+    MessageType.ACC: messages.Acc(*messages.Codes.OK),
+    MessageType.NEW_GAME_REQUEST: messages.RequestNewGame(messages.GameType.MULTI_PLAYER),
+    MessageType.WAIT_FOR_OPPONENT: messages.WaitForOpponent(),
+    MessageType.MAKE_MOVE: messages.MakeMove(4),
+    MessageType.RESULT: messages.Result.pack(
+        ["Smith", None, "Jones", None, "Smith", None, "Jones", None, None], ["Smith", "Jones"], None
+    ),
+    MessageType.STOP_PROXY: messages.StopProxy(),
+    MessageType.GAME_FOUND: messages.GameFound("Jones"),
+    MessageType.GAME_START: messages.StartGame(["Smith", "Jones"]),
+    MessageType.GAME_ENDED: messages.GameEnded("Smith"),
+    MessageType.YOU_CAN_MOVE: messages.YouCanMove("Smith"),
+    MessageType.SEND_MESSAGE: messages.SendMessage("good game; well played", "Jones"),
+    MessageType.RECONNECTED: messages.PlayerReconnected("Smith"),
+    MessageType.EXIT: messages.Exit("Smith"),
+    MessageType.HEARTBEAT: messages.Heartbeat(),
+}
+assert set(SAMPLES) == set(messages_types), "every message type needs a sample"
+for message_id, sample in enumerate(SAMPLES.values(), 1):
+    sample.message_id = message_id
+
+
+def per_call(func, number: int) -> float:
+    """
+    Best of 3 runs in microseconds per call
+    """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def bench_codecs(number: int = 20000) -> List[Dict]:
+    """
+    Encode and decode time and frame size of every message type in every wire format
+    JSON rows use the best installed backend, `json-stdlib` rows force the stdlib one
+    """
+    rows = []
+    for message_type, message in SAMPLES.items():
+        for wire_format in codec.WIRE_FORMATS + ["json-stdlib"]:
+            if wire_format == "json-stdlib":
+                name = wire_format
+                frame = codec.serialize(message, codec.JsonBackend) + codec.JSON_DELIMITER
+                encode = lambda: codec.serialize(message, codec.JsonBackend)
+                decode = lambda: codec.get_message(frame[:-1], codec.JsonBackend)
+            else:
+                name = WireFormat(wire_format).name.lower()
+                frame = codec.encode_frame(message, wire_format)
+                encode = lambda: codec.encode_frame(message, wire_format)
+                decode = lambda: codec.decode_frames(frame)
+            rows.append({
+                "message": message_type.name,
+                "format": name,
+                "bytes": len(frame),
+                "encode_us": per_call(encode, number),
+                "decode_us": per_call(decode, number),
+            })
+    return rows
+
+
+def bench_messages(number: int = 100000) -> List[Dict]:
+    """
+    Construction time and retained memory of the hottest message types
+    """
+    factories = {
+        "Acc": lambda: messages.Acc(*messages.Codes.OK),
+        "YouCanMove": lambda: messages.YouCanMove("Smith"),
+        "Result": lambda: messages.Result(0b000010001_000100010, ["Smith", "Jones"], None),
+    }
+    rows = []
+    for name, factory in factories.items():
+        tracemalloc.start()
+        kept = [factory() for _ in range(number)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del kept
+        rows.append({
+            "message": name,
+            "bytes_per_message": size // number,
+            "create_us": per_call(factory, number),
+        })
+    return rows
+
+
+def bench_matchmaking(servers: int = 5000, capacity: int = 1) -> List[Dict]:
+    """
+    Latency from the second player joining (or a running game being released)
+    until both players' `ready` futures resolve, with every slot registered
+    """
+    from tic_tac_toe.matchmaking import Matchmaker
+    from tic_tac_toe.models import GameServerData, User
+
+    matchmaker = Matchmaker()
+    for _ in range(servers):
+        matchmaker.add_server(GameServerData([], capacity))
+    slots = servers * capacity
+    users = [User(None, None, f"user-{i}") for i in range(2 * slots + 2)]
+    rows = []
+
+    games = []
+    latencies = []
+    for i in range(slots):
+        first = matchmaker.join(users[2 * i], messages.GameType.MULTI_PLAYER)
+        start = time.perf_counter()
+        second = matchmaker.join(users[2 * i + 1], messages.GameType.MULTI_PLAYER)
+        first.ready.result()
+        games.append(second.ready.result())
+        latencies.append(time.perf_counter() - start)
+    rows.append(latency_row("match free slot", latencies))
+
+    latencies = []
+    for game in games:
+        first = matchmaker.join(users[-2], messages.GameType.MULTI_PLAYER)
+        second = matchmaker.join(users[-1], messages.GameType.MULTI_PLAYER)
+        start = time.perf_counter()
+        matchmaker.release(game)
+        first.ready.result()
+        second.ready.result()
+        latencies.append(time.perf_counter() - start)
+    rows.append(latency_row("match after release", latencies))
+    return rows
+
+
+def bench_bot(number: int = 20000) -> List[Dict]:
+    """
+    Time to solve every position for the perfect bot and per-move latency
+    of every difficulty over all non terminal positions
+    """
+    from tic_tac_toe.board import Board
+    from tic_tac_toe.bot import BOTS, PerfectBot
+
+    start = time.perf_counter()
+    PerfectBot.solve()
+    rows = [{
+        "case": "perfect solve",
+        "positions": PerfectBot.positions,
+        "us": (time.perf_counter() - start) * 1e6,
+    }]
+    boards = [
+        Board.from_cells(cells) for cells, move in enumerate(PerfectBot.table) if move
+    ]
+    for difficulty, bot_class in BOTS.items():
+        bot = bot_class()
+        moves = iter(boards * (number // len(boards) + 1))
+        rows.append({
+            "case": f"{difficulty.name.lower()} move",
+            "positions": len(boards),
+            "us": per_call(lambda: bot.choose(next(moves)), number // 3),
+        })
+    return rows
+
+
+def bench_bot_batch(total: int = 200000) -> List[Dict]:
+    """
+    Moves per second of `choose_many` for batch sizes 1 to 100k over random
+    non terminal positions, `loop` rows call `choose` once per board
+    """
+    import random
+
+    from tic_tac_toe.board import Board
+    from tic_tac_toe.bot import BOTS, PerfectBot
+
+    PerfectBot.solve()
+    positions = [cells for cells, move in enumerate(PerfectBot.table) if move]
+    rows = []
+    for difficulty, bot_class in BOTS.items():
+        bot = bot_class()
+        for size in (1, 10, 100, 1000, 10000, 100000):
+            batch = random.choices(positions, k=size)
+            number = max(1, total // size)
+            rows.append({
+                "bot": difficulty.name.lower(),
+                "batch": size,
+                "moves_per_s": size / per_call(lambda: bot.choose_many(batch), number) * 1e6,
+            })
+        boards = [Board.from_cells(cells) for cells in random.choices(positions, k=1000)]
+        rows.append({
+            "bot": difficulty.name.lower(),
+            "batch": "loop",
+            "moves_per_s": len(boards) / per_call(lambda: [bot.choose(board) for board in boards], 20) * 1e6,
+        })
+    return rows
+
+
+def bench_protocol(multi_player: int = 20, single_player: int = 10) -> List[Dict]:
+    """
+    Messages sent by every party per move played, over a real web server,
+    game server and scripted clients on localhost
+    """
+    import random
+    import socket
+    import threading
+    from collections import Counter
+
+    from tic_tac_toe.game_server import GameServer
+    from tic_tac_toe.socket_handler import SocketHandler
+    from tic_tac_toe.web_server import WebServer
+
+    counts = Counter()
+    send_message = SocketHandler.send_message
+
+    def counting_send_message(self, message, *args, **kwargs):
+        counts[message.message_type.name] += 1
+        return send_message(self, message, *args, **kwargs)
+
+    SocketHandler.send_message = counting_send_message
+    WebServer.PORT = random.randint(20000, 30000)
+    web_server = WebServer()
+    web_server.sockets_thread.daemon = True
+    web_server.sockets_thread.start()
+    time.sleep(0.3)
+    game_server = GameServer(WebServer.HOST, WebServer.PORT)
+    threading.Thread(target=game_server.start, daemon=True).start()
+    time.sleep(0.3)
+    moves = []
+
+    def play(game_type: messages.GameType):
+        handler = SocketHandler(socket.create_connection((WebServer.HOST, WebServer.PORT)))
+        handler.handshake(messages.HandShake(messages.SocketType.CLIENT))
+        handler.send_message(messages.RequestNewGame(game_type), True)
+        free = set(range(9))
+        while True:
+            message = handler.get_next_message()
+            handler.acknowledge([message])
+            if message.message_type == MessageType.RESULT:
+                free = {pos for pos, cell in enumerate(message.game_state) if cell is None}
+            elif message.message_type == MessageType.YOU_CAN_MOVE:
+                handler.send_message(messages.MakeMove(random.choice(sorted(free))), False)
+                moves.append(message)
+            elif message.message_type == MessageType.GAME_ENDED:
+                break
+        handler.shutdown()
+
+    players = [
+        threading.Thread(target=play, args=(game_type,))
+        for game_type in [messages.GameType.MULTI_PLAYER] * multi_player
+        + [messages.GameType.SINGLE_PLAYER] * single_player
+    ]
+    for player in players:
+        player.start()
+    for player in players:
+        player.join()
+    time.sleep(0.3)
+    SocketHandler.send_message = send_message
+    web_server.stop()
+    return [
+        {"message": name, "count": count, "per_move": count / len(moves)}
+        for name, count in counts.most_common() + [("total", sum(counts.values()))]
+    ]
+
+
+def receive_concat(burst: bytes, copies: Optional[List[int]] = None) -> int:
+    """
+    Previous receive path, fixed 1 KiB reads appended to a bytes remainder
+    """
+    source = io.BytesIO(burst)
+    remain = b""
+    received = 0
+    while True:
+        data = source.read(1024)
+        if not data:
+            return received
+        if copies is not None:
+            copies.append(len(remain) + len(data))
+        remain += data
+        frames, consumed = codec.decode_frames(remain)
+        if copies is not None and consumed:
+            copies.append(len(remain) - consumed)
+        remain = remain[consumed:]
+        received += len(frames)
+
+
+def receive_into(burst: bytes, copies: Optional[List[int]] = None) -> int:
+    from tic_tac_toe.socket_handler import FrameDecoder
+
+    source = io.BytesIO(burst)
+    decoder = FrameDecoder()
+    received = 0
+    while True:
+        buffer, start, end = decoder.buffer, decoder.start, decoder.end
+        with decoder.reserve() as view:
+            size = source.readinto(view)
+        if copies is not None and (decoder.buffer is not buffer or decoder.start != start):
+            copies.append(end - start)
+        if not size:
+            return received
+        received += len(decoder.received(size))
+
+
+def bench_receive(repeat: int = 5) -> List[Dict]:
+    """
+    Throughput and bytes copied by the receive path itself for bursts of 1 KiB
+    to 1 MiB through `FrameDecoder` and through the previous receive path,
+    big chat messages show the cost of rescanning JSON frames split over reads
+    """
+    rows = []
+    chat = messages.SendMessage("well played " * 2000, "Jones")
+    chat.message_id = 1
+    for wire_format in (codec.WIRE_FORMATS[0], WireFormat.JSON):
+        for name, samples in (("mixed", list(SAMPLES.values())), ("chat-24k", [chat])):
+            for size in (1 << 10, 1 << 14, 1 << 17, 1 << 20):
+                burst = bytearray()
+                while len(burst) < size:
+                    burst += codec.encode_frame(random.choice(samples), wire_format)
+                burst = bytes(burst)
+                if rows and rows[-1]["burst"] == len(burst):
+                    continue
+                for path, receive in (("concat", receive_concat), ("recv_into", receive_into)):
+                    copies = []
+                    count = receive(burst, copies)
+                    seconds = min(timeit.repeat(lambda: receive(burst), number=1, repeat=repeat))
+                    rows.append({
+                        "format": WireFormat(wire_format).name.lower(),
+                        "messages": name,
+                        "burst": len(burst),
+                        "path": path,
+                        "count": count,
+                        "MB_per_s": len(burst) / seconds / 1e6,
+                        "copied_kb": sum(copies) / 1024,
+                    })
+    return rows
+
+
+def bench_metrics(number: int = 200000) -> List[Dict]:
+    """
+    Cost of recording a metric on the hot path with collection off and on
+    """
+    from tic_tac_toe.metrics import Registry
+
+    registry = Registry()
+    counter = registry.counter("bench_messages_total", "Messages", "type")
+    histogram = registry.histogram("bench_seconds", "Durations")
+    kind = MessageType.RESULT
+    rows = []
+    for enabled in (False, True):
+        registry.enabled = enabled
+        rows.append({
+            "metrics": "on" if enabled else "off",
+            "counter_inc_us": per_call(lambda: counter.inc(kind), number),
+            "observe_us": per_call(lambda: histogram.observe(0.003), number),
+        })
+    return rows
+
+
+def bench_logging(number: int = 20000) -> List[Dict]:
+    """
+    Cost of an INFO record for the thread that logs and until it's written, synchronous,
+    queued and queued with a rate limit, the terminal being /dev/null
+    """
+    import contextlib
+    import os
+
+    from tic_tac_toe import logger as logger_module
+
+    settings = dict(logger_module.SETTINGS)
+    rows = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        for mode, use_queue, rate in (("sync", False, 0), ("queue", True, 0), ("queue+rate", True, 100)):
+            logger_module.configure("INFO", use_queue, rate=rate)
+            logger = logger_module.get_logger("bench", split=" ")
+            message = SAMPLES[MessageType.MAKE_MOVE]
+            start = time.perf_counter()
+            for _ in range(number):
+                logger.info("Client said %s %s", message.message_type, message)
+            logged = time.perf_counter() - start
+            logger_module.flush(timeout=60)
+            rows.append({
+                "mode": mode,
+                "caller_us": logged / number * 1e6,
+                "written_us": (time.perf_counter() - start) / number * 1e6,
+            })
+        logger_module.configure(settings["level"], settings["queue"], rate=settings["rate"])
+    return rows
+
+
+def bench_archive(games: int = 100000, copies: int = 20) -> List[Dict]:
+    """
+    Archiving `games` random games, then queries over `copies` segments of them
+    """
+    import os
+    import shutil
+    import tempfile
+
+    from tic_tac_toe import archive
+    from tic_tac_toe.board import TIE, Board
+
+    rng = random.Random(1)
+    players = [f"player{index}" for index in range(1000)]
+    records = []
+    for _ in range(games):
+        board, moves = Board(), []
+        while board.outcome is None:
+            pos = rng.choice(board.free_cells())
+            board.play(pos)
+            moves.append(pos)
+        outcome = archive.TIED if board.outcome == TIE else board.outcome
+        records.append((rng.sample(players, 2), moves, outcome))
+    directory = tempfile.mkdtemp()
+    try:
+        writer = archive.ArchiveWriter(directory, "bench", segment_games=games)
+        start = time.perf_counter()
+        for marks, moves, outcome in records:
+            writer.add(marks, moves, 1700000000, 1700000030, outcome)
+        write_us = (time.perf_counter() - start) / games * 1e6
+        writer.close()
+        (path,) = archive.Archive(directory).paths()
+        size = os.path.getsize(path)
+        for copy in range(1, copies):
+            shutil.copy(path, path.replace(archive.SUFFIX, f"-{copy}{archive.SUFFIX}"))
+        reader = archive.Archive(directory)
+        rows = []
+        for query in ("win_rates", "first_moves"):
+            start = time.perf_counter()
+            getattr(reader, query)()
+            rows.append({
+                "query": query,
+                "games": games * copies,
+                "seconds": time.perf_counter() - start,
+                "write_us": write_us,
+                "bytes_per_game": size / games,
+            })
+        start = time.perf_counter()
+        replayed = sum(1 for record in itertools.islice(reader, games) for _ in record.boards())
+        rows.append({
+            "query": "replay",
+            "games": games,
+            "seconds": time.perf_counter() - start,
+            "write_us": write_us,
+            "bytes_per_game": size / games,
+        })
+        assert replayed == sum(len(moves) for _, moves, _ in records)
+    finally:
+        shutil.rmtree(directory)
+    return rows
+
+
+def latency_row(name: str, latencies: List[float]) -> Dict:
+    latencies = sorted(latencies)
+    return {
+        "case": name,
+        "count": len(latencies),
+        "p50_us": latencies[len(latencies) // 2] * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6,
+        "max_us": latencies[-1] * 1e6,
+    }
+
+
+def print_rows(rows: List[Dict]):
+    columns = list(rows[0])
+    print(*(column.ljust(18) for column in columns))
+    for row in rows:
+        print(*(
+            (f"{value:.2f}" if isinstance(value, float) else str(value)).ljust(18)
+            for value in row.values()
+        ))
+
+
+BENCHMARKS = {
+    "codecs": bench_codecs,
+    "messages": bench_messages,
+    "matchmaking": bench_matchmaking,
+    "bot": bench_bot,
+    "bot-batch": bench_bot_batch,
+    "protocol": bench_protocol,
+    "receive": bench_receive,
+    "metrics": bench_metrics,
+    "logging": bench_logging,
+    "archive": bench_archive,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    args = parser.parse_args()
+    print_rows(BENCHMARKS[args.benchmark]())
@@ -0,0 +1,82 @@
+from typing import List, Optional
+
+LINES = (
+    0b000000111,
+    0b000111000,
+    0b111000000,
+    0b100010001,
+    0b001010100,
+    0b001001001,
+    0b010010010,
+    0b100100100,
+)
+FULL = 0b111111111
+WINS = bytes(
+    any(mask & line == line for line in LINES) for mask in range(FULL + 1)
+)
+TIE = 2
+
+
+class Board:
+    """
+    Two 9-bit masks, bit i of masks[p] is set when player p owns cell i,
+    player 0 moves first
+    Notes:
+        `outcome` is updated by `play` so it's computed once per move,
+        None while the game goes on, 0 or 1 for the winner and `TIE`
+    """
+
+    __slots__ = ("masks", "turn", "outcome")
+
+    def __init__(self, x: int = 0, o: int = 0):
+        self.masks = [x, o]
+        self.turn = bin(x).count("1") - bin(o).count("1")
+        self.outcome: Optional[int] = None
+        if WINS[x]:
+            self.outcome = 0
+        elif WINS[o]:
+            self.outcome = 1
+        elif x | o == FULL:
+            self.outcome = TIE
+
+    @classmethod
+    def from_cells(cls, cells: int) -> "Board":
+        return cls(cells & FULL, cells >> 9)
+
+    def copy(self) -> "Board":
+        board = Board.__new__(Board)
+        board.masks = self.masks[:]
+        board.turn = self.turn
+        board.outcome = self.outcome
+        return board
+
+    @property
+    def cells(self) -> int:
+        """
+        Same packing as `Result.cells`
+        """
+        return self.masks[0] | self.masks[1] << 9
+
+    @property
+    def occupied(self) -> int:
+        return self.masks[0] | self.masks[1]
+
+    def is_free(self, pos: int) -> bool:
+        return 0 <= pos < 9 and not self.occupied >> pos & 1
+
+    def free_cells(self) -> List[int]:
+        occupied = self.occupied
+        return [pos for pos in range(9) if not occupied >> pos & 1]
+
+    def play(self, pos: int) -> Optional[int]:
+        """
+        Put current player's mark on `pos`, caller checks `is_free` first
+        """
+        mask = self.masks[self.turn] | 1 << pos
+        self.masks[self.turn] = mask
+        if WINS[mask]:
+            self.outcome = self.turn
+        elif self.masks[0] | self.masks[1] == FULL:
+            self.outcome = TIE
+        self.turn ^= 1
+        return self.outcome
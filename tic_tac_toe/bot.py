@@ -0,0 +1,252 @@
+import random
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Sequence, Type
+
+from tic_tac_toe.board import Board, FULL, WINS
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.messages import Difficulty
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# position of every cell after each of the 8 symmetries of the board
+SYMMETRIES = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8),
+    (6, 3, 0, 7, 4, 1, 8, 5, 2),
+    (8, 7, 6, 5, 4, 3, 2, 1, 0),
+    (2, 5, 8, 1, 4, 7, 0, 3, 6),
+    (2, 1, 0, 5, 4, 3, 8, 7, 6),
+    (6, 7, 8, 3, 4, 5, 0, 1, 2),
+    (0, 3, 6, 1, 4, 7, 2, 5, 8),
+    (8, 5, 2, 7, 4, 1, 6, 3, 0),
+)
+SYMMETRY_MASKS = [
+    [sum(1 << symmetry[i] for i in range(9) if mask >> i & 1) for mask in range(FULL + 1)]
+    for symmetry in SYMMETRIES
+]
+
+# smaller batches are faster without numpy
+VECTORIZE = 64
+# free cells of every occupied mask
+FREE_CELLS = [[pos for pos in range(9) if not mask >> pos & 1] for mask in range(FULL + 1)]
+if numpy is not None:
+    FREE_COUNTS = numpy.array([len(cells) for cells in FREE_CELLS], dtype=numpy.intp)
+    FREE_TABLE = numpy.array([cells + [0] * (9 - len(cells)) for cells in FREE_CELLS], dtype=numpy.int8)
+
+
+def popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+
+class Bot(ABC):
+    """
+    Picks a free cell for the player whose turn it is on `board`
+    """
+
+    difficulty: Difficulty
+
+    @abstractmethod
+    def choose(self, board: Board) -> int:
+        pass
+
+    def choose_many(self, cells: Sequence[int]) -> Sequence[int]:
+        """
+        Moves for many boards at once
+        Args:
+            cells: `Board.cells` of every board, a list or a numpy integer array
+        Returns:
+            position for every board, a numpy array when the bot has a vectorized
+            version, numpy is installed and there are at least `VECTORIZE` boards
+        """
+        return [self.choose(Board.from_cells(value)) for value in cells]
+
+
+class RandomBot(Bot):
+    difficulty = Difficulty.EASY
+
+    def choose(self, board: Board) -> int:
+        return random.choice(board.free_cells())
+
+    def choose_many(self, cells: Sequence[int]) -> Sequence[int]:
+        if numpy is None or len(cells) < VECTORIZE:
+            return [random.choice(FREE_CELLS[(value | value >> 9) & FULL]) for value in cells]
+        cells = numpy.asarray(cells, dtype=numpy.intp)
+        occupied = (cells | cells >> 9) & FULL
+        picks = (numpy.random.random(len(cells)) * FREE_COUNTS[occupied]).astype(numpy.intp)
+        return FREE_TABLE[occupied, picks]
+
+
+class HeuristicBot(Bot):
+    """
+    Wins when it can, blocks when it must, otherwise prefers center then corners
+    and plays a random cell a quarter of the time
+    Notes:
+        `forced` has the winning or blocking move + 1 of every position indexed
+        by `Board.cells`, 0 when there is none, `preferred` has the preferred
+        move + 1 of every occupied mask, both are built on first use
+    """
+
+    difficulty = Difficulty.MEDIUM
+    PREFERENCE = (4, 0, 2, 6, 8, 1, 3, 5, 7)
+    RANDOM = 0.25
+    forced: Optional[bytearray] = None
+    preferred: Optional[bytes] = None
+    forced_moves = None
+    preferred_moves = None
+
+    def __init__(self):
+        if HeuristicBot.forced is None:
+            HeuristicBot.build()
+        self.random_bot = RandomBot()
+
+    @classmethod
+    def build(cls):
+        forced = bytearray(1 << 18)
+        for x in range(FULL + 1):
+            for o in range(FULL + 1):
+                if x & o or not 0 <= popcount(x) - popcount(o) <= 1:
+                    continue
+                me, opponent = (x, o) if popcount(x) == popcount(o) else (o, x)
+                free = FREE_CELLS[x | o]
+                for mask in (me, opponent):
+                    pos = next((pos for pos in free if WINS[mask | 1 << pos]), None)
+                    if pos is not None:
+                        forced[x | o << 9] = pos + 1
+                        break
+        cls.forced = forced
+        cls.preferred = bytes(
+            next((pos + 1 for pos in cls.PREFERENCE if not occupied >> pos & 1), 0)
+            for occupied in range(FULL + 1)
+        )
+        if numpy is not None:
+            cls.forced_moves = numpy.frombuffer(forced, dtype=numpy.uint8).astype(numpy.int8) - 1
+            cls.preferred_moves = numpy.frombuffer(cls.preferred, dtype=numpy.uint8).astype(numpy.int8) - 1
+
+    def choose(self, board: Board) -> int:
+        return self.pick(board.cells)
+
+    def pick(self, cells: int) -> int:
+        pos = self.forced[cells]
+        if pos:
+            return pos - 1
+        occupied = (cells | cells >> 9) & FULL
+        if random.random() < self.RANDOM:
+            return random.choice(FREE_CELLS[occupied])
+        return self.preferred[occupied] - 1
+
+    def choose_many(self, cells: Sequence[int]) -> Sequence[int]:
+        if numpy is None or len(cells) < VECTORIZE:
+            return [self.pick(value) for value in cells]
+        cells = numpy.asarray(cells, dtype=numpy.intp)
+        moves = self.forced_moves[cells]
+        free = moves < 0
+        moves[free] = self.preferred_moves[(cells[free] | cells[free] >> 9) & FULL]
+        picks = free & (numpy.random.random(len(cells)) < self.RANDOM)
+        moves[picks] = self.random_bot.choose_many(cells[picks])
+        return moves
+
+
+class PerfectBot(Bot):
+    """
+    Every legal position is solved once with negamax over symmetry-reduced positions,
+    then the best move of all of them is written into `table` indexed by `Board.cells`
+    so choosing a move is a single lookup
+    Notes:
+        wins as fast and loses as slow as possible
+        the table is shared by every instance and built on first use
+    """
+
+    logger = get_logger("perfect-bot", split=" ")
+    difficulty = Difficulty.PERFECT
+    table: Optional[bytearray] = None
+    moves = None
+    positions = 0
+    canonical_positions = 0
+    solve_seconds = 0.0
+
+    def __init__(self):
+        if PerfectBot.table is None:
+            PerfectBot.solve()
+
+    def choose(self, board: Board) -> int:
+        return self.table[board.cells] - 1
+
+    def choose_many(self, cells: Sequence[int]) -> Sequence[int]:
+        if self.moves is None or len(cells) < VECTORIZE:
+            table = self.table
+            return [table[value] - 1 for value in cells]
+        return self.moves[numpy.asarray(cells, dtype=numpy.intp)]
+
+    @staticmethod
+    def canonical(me: int, opponent: int) -> int:
+        return min(
+            symmetry[me] | symmetry[opponent] << 9 for symmetry in SYMMETRY_MASKS
+        )
+
+    @classmethod
+    def solve(cls):
+        start = time.perf_counter()
+        values: Dict[int, int] = {}
+
+        def value(me: int, opponent: int) -> int:
+            """
+            Score for the player to move, 10 - moves played when winning
+            """
+            if WINS[opponent]:
+                return popcount(me | opponent) - 10
+            occupied = me | opponent
+            if occupied == FULL:
+                return 0
+            key = cls.canonical(me, opponent)
+            if key in values:
+                return values[key]
+            best = -10
+            for pos in range(9):
+                if not occupied >> pos & 1:
+                    best = max(best, -value(opponent, me | 1 << pos))
+            values[key] = best
+            return best
+
+        table = bytearray(1 << 18)
+        seen = {0}
+        frontier = [(0, 0)]
+        while frontier:
+            next_frontier = []
+            for x, o in frontier:
+                board = Board(x, o)
+                if board.outcome is not None:
+                    continue
+                me, opponent = board.masks[board.turn], board.masks[board.turn ^ 1]
+                best_pos, best = -1, -11
+                for pos in board.free_cells():
+                    score = -value(opponent, me | 1 << pos)
+                    if score > best:
+                        best_pos, best = pos, score
+                    child = (x | 1 << pos, o) if board.turn == 0 else (x, o | 1 << pos)
+                    if child[0] | child[1] << 9 not in seen:
+                        seen.add(child[0] | child[1] << 9)
+                        next_frontier.append(child)
+                table[board.cells] = best_pos + 1
+            frontier = next_frontier
+        cls.table = table
+        if numpy is not None:
+            cls.moves = numpy.frombuffer(table, dtype=numpy.uint8).astype(numpy.int8) - 1
+        cls.positions = len(seen)
+        cls.canonical_positions = len(values)
+        cls.solve_seconds = time.perf_counter() - start
+        cls.logger.info(
+            "Solved %d positions (%d canonical non terminal) in %.3fs",
+            cls.positions, cls.canonical_positions, cls.solve_seconds,
+        )
+
+
+BOTS: Dict[Difficulty, Type[Bot]] = {
+    bot.difficulty: bot for bot in (RandomBot, HeuristicBot, PerfectBot)
+}
+
+
+def get_bots() -> Dict[Difficulty, Bot]:
+    return {difficulty: bot() for difficulty, bot in BOTS.items()}
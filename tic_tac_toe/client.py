@@ -8,7 +8,7 @@ from tic_tac_toe.logger import get_logger
 from tic_tac_toe import messages, DEFAULT_PORT
 from tic_tac_toe.menu_handler import handle_menu
 from tic_tac_toe.messages import Codes
-from tic_tac_toe.socket_handler import SocketHandler
+from tic_tac_toe.socket_handler import SocketHandler, ConnectionClosed
 
 
 class Client:
@@ -16,8 +16,9 @@ class Client:
     DELIMITER = b";"
     WIDTH = 16
 
-    def __init__(self, host: str, port: int, username: Optional[str] = None):
+    def __init__(self, host: str, port: int, username: Optional[str] = None, token: Optional[str] = None):
         self.username = username
+        self.token = token
         self.logger.info("New client connecting to %s:%d", host, port)
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         conn.connect((host, port))
@@ -50,9 +51,12 @@ class Client:
     def new_game(self):
         self.logger.info("New game")
         while True:
-            message = self.socket_handler.get_next_message()
-            if message.message_type != messages.MessageType.ACC:
-                self.socket_handler.send_acc(message.message_id)
+            try:
+                message = self.socket_handler.get_next_message()
+            except ConnectionClosed:
+                self.logger.info("Disconnected")
+                break
+            self.socket_handler.acknowledge([message])
             if message.message_type == messages.MessageType.GAME_FOUND:
                 print(f"Game found vs {message.opponent}")
                 self.print_game_state()
@@ -99,7 +103,7 @@ class Client:
                 break
             if cmd == 'reconnect_test':
                 self.socket_handler.socket.close()
-                client = Client("127.0.0.1", DEFAULT_PORT, self.username)
+                client = Client("127.0.0.1", DEFAULT_PORT, self.username, self.token)
                 client.start()
                 exit(0)
             if cmd == "msg":
@@ -136,9 +140,11 @@ class Client:
         self.game = None
 
     def start(self):
-        acc = self.socket_handler.send_message(
-            messages.HandShake(messages.SocketType.CLIENT, self.username), True
+        acc = self.socket_handler.handshake(
+            messages.HandShake(messages.SocketType.CLIENT, self.username, token=self.token)
         )
+        if acc is not None and acc.token:
+            self.token = acc.token
         self.logger.info("Acc is %s", acc)
         if self.username and acc.in_game():
             print('You were in game')
@@ -146,7 +152,7 @@ class Client:
             self.game_menu()
         if acc.is_ok():
             print("Connected")
-            self.username = acc.text.split()[-1]
+            self.username = acc.username or self.username
             print(acc.text)
         else:
             print("Internal error")
@@ -173,6 +179,13 @@ class Client:
                 )
                 if cmd == 'sp':
                     self.single_player = True
+                    message.difficulty = messages.Difficulty[handle_menu(
+                        [
+                            ("easy", "Easy"),
+                            ("medium", "Medium"),
+                            ("perfect", "Perfect"),
+                        ]
+                    ).upper()]
                 else:
                     self.single_player = False
                 acc = self.socket_handler.send_message(message, True)
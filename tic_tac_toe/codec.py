@@ -0,0 +1,452 @@
+import copy
+import inspect
+import json
+import struct
+import typing
+from enum import IntEnum
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from tic_tac_toe.messages import Message, MessageType, WireFormat, messages_types
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+JSON_DELIMITER = b";"
+LENGTH_SIZE = 4
+HEADER_SIZE = 1 + LENGTH_SIZE
+unpack_length = struct.Struct(">I").unpack_from
+NO_ACK = 0x80
+MAX_FRAME_SIZE = 1 << 20
+JSON_FORMATS = (WireFormat.JSON, WireFormat.LEGACY_JSON)
+# fields of every message a peer from before `HandShake.wire_formats` knows, it passes
+# every key to `__init__` so anything else breaks it, `Result` used to be a list of cells
+LEGACY_FIELDS = {
+    MessageType.HAND_SHAKE: ("socket_type", "username"),
+    MessageType.ACC: ("result", "text"),
+    MessageType.NEW_GAME_REQUEST: ("game_type",),
+    MessageType.GAME_FOUND: ("opponent",),
+    MessageType.WAIT_FOR_OPPONENT: (),
+    MessageType.MAKE_MOVE: ("pos",),
+    MessageType.RESULT: ("game_state", "winner"),
+    MessageType.SEND_MESSAGE: ("text", "target"),
+    MessageType.STOP_PROXY: (),
+    MessageType.GAME_START: ("opponents",),
+    MessageType.GAME_ENDED: ("winner",),
+    MessageType.YOU_CAN_MOVE: ("user",),
+    MessageType.RECONNECTED: ("user",),
+    MessageType.EXIT: ("user",),
+}
+
+
+class FrameError(ValueError):
+    """
+    Bytes that aren't a frame we can decode, nothing after them can be trusted
+    """
+
+
+def encode_varint(value: int, out: bytearray):
+    if value < 0:
+        raise ValueError(f"Can't encode negative value {value}")
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data: Buffer, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_int(value: Optional[int], out: bytearray):
+    encode_varint(0 if value is None else value + 1, out)
+
+
+def decode_int(data: Buffer, pos: int) -> Tuple[Optional[int], int]:
+    value = data[pos]
+    if value < 0x80:
+        pos += 1
+    else:
+        value, pos = decode_varint(data, pos)
+    return (None if value == 0 else value - 1), pos
+
+
+def encode_str(value: Optional[str], out: bytearray):
+    if value is None:
+        out.append(0)
+        return
+    raw = value.encode()
+    encode_varint(len(raw) + 1, out)
+    out += raw
+
+
+def decode_str(data: Buffer, pos: int) -> Tuple[Optional[str], int]:
+    size = data[pos]
+    if size < 0x80:
+        pos += 1
+    else:
+        size, pos = decode_varint(data, pos)
+    if size == 0:
+        return None, pos
+    end = pos + size - 1
+    return str(data[pos:end], "utf-8"), end
+
+
+def list_codec(
+    encode_item: Callable, decode_item: Callable
+) -> Tuple[Callable, Callable]:
+    def encode_list(value: Optional[List], out: bytearray):
+        if value is None:
+            out.append(0)
+            return
+        encode_varint(len(value) + 1, out)
+        for item in value:
+            encode_item(item, out)
+
+    def decode_list(data: Buffer, pos: int) -> Tuple[Optional[List], int]:
+        size, pos = decode_varint(data, pos)
+        if size == 0:
+            return None, pos
+        items = [None] * (size - 1)
+        for index in range(size - 1):
+            items[index], pos = decode_item(data, pos)
+        return items, pos
+
+    return encode_list, decode_list
+
+
+def field_codec(hint) -> Tuple[Callable, Callable]:
+    """
+    Map a constructor annotation to its (encode, decode) pair
+    every field is nullable so `Optional[...]` is the same as the bare type
+    """
+    args = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+    if typing.get_origin(hint) is Union:
+        return field_codec(args[0])
+    if typing.get_origin(hint) in (list, List):
+        return list_codec(*field_codec(args[0]))
+    if hint is str:
+        return encode_str, decode_str
+    if hint is int or (inspect.isclass(hint) and issubclass(hint, IntEnum)):
+        return encode_int, decode_int
+    raise TypeError(f"Unsupported field type {hint}")
+
+
+def compile_function(name: str, lines: List[str], namespace: Dict[str, Any]) -> Callable:
+    exec("\n    ".join(lines), namespace)  # pylint: disable=exec-used
+    return namespace[name]
+
+
+class MessageCodec:
+    """
+    Encoders and decoders of one message class, generated once at import
+    Notes:
+        fields and their binary encoding are taken from the `__init__` annotations
+        decoders fill a bare instance instead of calling `__init__`
+        fields that default to None are left out of JSON while unset
+        so peers that don't know about them can still build the message
+        `Message.ack` is only written to JSON when False and travels in the
+        frame header of binary formats
+    """
+
+    def __init__(self, cls: type):
+        self.cls = cls
+        hints = typing.get_type_hints(cls.__init__)
+        parameters = inspect.signature(cls.__init__).parameters
+        self.message_type = parameters["message_type"].default
+        self.names = ["message_id"] + [
+            name for name in parameters if name not in ("self", "message_type", "message_id")
+        ]
+        optional = [name for name in self.names[1:] if parameters[name].default is None]
+        required = [name for name in self.names if name not in optional]
+        namespace = {
+            "new": object.__new__,
+            "cls": cls,
+            "message_type": self.message_type,
+            "encode_message_id": encode_int,
+            "decode_message_id": decode_int,
+        }
+        binary_names = ["encode_message_id"], ["decode_message_id"]
+        for name in self.names[1:]:
+            namespace[f"encode_{name}"], namespace[f"decode_{name}"] = field_codec(hints[name])
+            binary_names[0].append(f"encode_{name}")
+            binary_names[1].append(f"decode_{name}")
+
+        self.to_dict = compile_function("to_dict", [
+            "def to_dict(message):",
+            "data = {'message_type': message_type, "
+            + ", ".join(f"'{name}': message.{name}" for name in required) + "}",
+            *(f"if message.{name} is not None: data['{name}'] = message.{name}" for name in optional),
+            "if not message.ack: data['ack'] = False",
+            "return data",
+        ], namespace)
+        self.from_dict = compile_function("from_dict", [
+            "def from_dict(data):",
+            "message = new(cls)",
+            "message.message_type = message_type",
+            *(f"message.{name} = data['{name}']" for name in required),
+            *(f"message.{name} = data.get('{name}')" for name in optional),
+            "message.ack = data.get('ack', True)",
+            "return message",
+        ], namespace)
+        self.to_values = compile_function("to_values", [
+            "def to_values(message):",
+            f"return ({''.join(f'message.{name}, ' for name in self.names)})",
+        ], namespace)
+        self.from_values = compile_function("from_values", [
+            "def from_values(values):",
+            "message = new(cls)",
+            "message.message_type = message_type",
+            f"{', '.join(f'message.{name}' for name in self.names)}, = values",
+            "return message",
+        ], namespace)
+        self.encode_binary = compile_function("encode_binary", [
+            "def encode_binary(message, out):",
+            *(f"{encode}(message.{name}, out)" for encode, name in zip(binary_names[0], self.names)),
+        ], namespace)
+        self.decode_binary = compile_function("decode_binary", [
+            "def decode_binary(data, pos):",
+            "message = new(cls)",
+            "message.message_type = message_type",
+            *(f"message.{name}, pos = {decode}(data, pos)" for decode, name in zip(binary_names[1], self.names)),
+            "return message",
+        ], namespace)
+
+
+message_codecs: Dict[int, MessageCodec] = {
+    message_type: MessageCodec(cls) for message_type, cls in messages_types.items()
+}
+
+
+class JsonBackend:
+    name = "json"
+
+    @staticmethod
+    def dumps(data: Dict) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    @staticmethod
+    def loads(data: Buffer) -> Dict:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+
+class OrjsonBackend:
+    """
+    Same wire bytes as `JsonBackend`, reads memoryview without a copy
+    """
+
+    name = "orjson"
+
+    @staticmethod
+    def dumps(data: Dict) -> bytes:
+        return orjson.dumps(data)
+
+    @staticmethod
+    def loads(data: Buffer) -> Dict:
+        return orjson.loads(data)
+
+
+json_backends = [JsonBackend] + ([OrjsonBackend] if orjson is not None else [])
+json_backend = json_backends[-1]
+
+
+def to_legacy_dict(message: Message) -> Dict:
+    data = {"message_type": message.message_type, "message_id": message.message_id}
+    for name in LEGACY_FIELDS[message.message_type]:
+        data[name] = getattr(message, name)
+    return data
+
+
+def serialize(message: Message, backend=None, legacy: bool = False) -> bytes:
+    """
+    `;` is escaped because it delimits JSON frames
+    """
+    data = to_legacy_dict(message) if legacy else message_codecs[message.message_type].to_dict(message)
+    data = (backend or json_backend).dumps(data)
+    if b";" in data:
+        data = data.replace(b";", b"\\u003b")
+    return data
+
+
+def get_message(data: Buffer, backend=None) -> Message:
+    json_data = (backend or json_backend).loads(data)
+    return message_codecs[json_data["message_type"]].from_dict(json_data)
+
+
+class BinaryFormat:
+    """
+    Frames are `marker | u32 length | u8 message_type | body`
+    where length covers type and body and marker tells which body encoding is used
+    the high bit of the type byte is set when the message doesn't want an acc
+    """
+
+    wire_format = WireFormat.BINARY
+    marker = 0
+
+    def encode(self, message: Message) -> bytes:
+        out = bytearray(HEADER_SIZE)
+        out[0] = self.marker
+        out.append(message.message_type if message.ack else message.message_type | NO_ACK)
+        self.encode_body(message_codecs[message.message_type], message, out)
+        out[1:HEADER_SIZE] = (len(out) - HEADER_SIZE).to_bytes(LENGTH_SIZE, "big")
+        return bytes(out)
+
+    def decode(self, data: memoryview, start: int, end: int) -> Message:
+        message_type = data[start]
+        message = self.decode_body(message_codecs[message_type & ~NO_ACK], data, start + 1, end)
+        message.ack = not message_type & NO_ACK
+        return message
+
+    @staticmethod
+    def encode_body(codec: MessageCodec, message: Message, out: bytearray):
+        codec.encode_binary(message, out)
+
+    @staticmethod
+    def decode_body(codec: MessageCodec, data: memoryview, start: int, end: int) -> Message:
+        return codec.decode_binary(data, start)
+
+
+class MsgpackFormat(BinaryFormat):
+    wire_format = WireFormat.MSGPACK
+    marker = 1
+
+    @staticmethod
+    def encode_body(codec: MessageCodec, message: Message, out: bytearray):
+        out += msgpack.packb(codec.to_values(message))
+
+    @staticmethod
+    def decode_body(codec: MessageCodec, data: memoryview, start: int, end: int) -> Message:
+        return codec.from_values(msgpack.unpackb(data[start:end]))
+
+
+binary_formats: Dict[int, BinaryFormat] = {
+    binary_format.wire_format: binary_format
+    for binary_format in [BinaryFormat()] + ([MsgpackFormat()] if msgpack is not None else [])
+}
+markers: Dict[int, BinaryFormat] = {
+    binary_format.marker: binary_format for binary_format in binary_formats.values()
+}
+WIRE_FORMATS = sorted(binary_formats, reverse=True) + [WireFormat.JSON]
+
+
+def encode_frame(message: Message, wire_format: int = WireFormat.JSON) -> bytes:
+    """
+    JSON frames are `<json>;`, binary ones are described in `BinaryFormat`
+    `LEGACY_JSON` frames only have the `LEGACY_FIELDS` of a message
+    """
+    binary_format = binary_formats.get(wire_format)
+    if binary_format is None:
+        return serialize(message, legacy=wire_format == WireFormat.LEGACY_JSON) + JSON_DELIMITER
+    return binary_format.encode(message)
+
+
+class SharedFrame:
+    """
+    A message sent as the same bytes to every peer, encoded once per wire format
+    Notes:
+        its id is `SHARED_ID`, no connection hands it out so the acc a JSON peer
+        sends back doesn't resolve anything, binary peers aren't asked for one
+    """
+
+    SHARED_ID = 0
+
+    __slots__ = ("message", "frames")
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.frames: Dict[int, bytes] = {}
+
+    def encode(self, wire_format: int) -> bytes:
+        data = self.frames.get(wire_format)
+        if data is None:
+            message = copy.copy(self.message)
+            message.message_id = self.SHARED_ID
+            message.ack = wire_format in JSON_FORMATS
+            data = self.frames[wire_format] = encode_frame(message, wire_format)
+        return data
+
+
+def decode_frames(data: Union[bytes, bytearray]) -> Tuple[List[Message], int]:
+    """
+    Decode every complete frame in `data` whichever format each one uses
+    frame bodies are decoded from memoryview slices so nothing is copied
+    Returns:
+        decoded messages and number of consumed bytes
+    """
+    frames: List[Message] = []
+    view = memoryview(data)
+    try:
+        pos, _ = decode_view(data, view, frames, 0, len(data), 0)
+    finally:
+        view.release()
+    return frames, pos
+
+
+def decode_view(
+    data: Union[bytes, bytearray], view: memoryview, frames: List[Message], pos: int, size: int, scan: int
+) -> Tuple[int, int]:
+    """
+    Decode complete frames of `data[pos:size]` into `frames`
+    Args:
+        scan: the JSON delimiter isn't in `data[pos:scan]`, it was searched before
+    Returns:
+        start of the first incomplete frame and where to resume the delimiter search
+    Raises:
+        FrameError: for a frame that can't be decoded or is bigger than `MAX_FRAME_SIZE`
+    """
+    try:
+        while pos < size:
+            binary_format = markers.get(data[pos])
+            if binary_format is not None:
+                if size - pos < HEADER_SIZE:
+                    break
+                length = unpack_length(data, pos + 1)[0]
+                if length > MAX_FRAME_SIZE:
+                    raise FrameError(f"Frame of {length} bytes")
+                end = pos + HEADER_SIZE + length
+                if end > size:
+                    break
+                frames.append(binary_format.decode(view, pos + HEADER_SIZE, end))
+                pos = end
+            else:
+                end = data.find(JSON_DELIMITER, max(pos, scan), size)
+                if end == -1:
+                    if size - pos > MAX_FRAME_SIZE:
+                        raise FrameError(f"No delimiter in {size - pos} bytes")
+                    return pos, size
+                if end > pos:
+                    frames.append(get_message(view[pos:end]))
+                pos = end + 1
+    except FrameError:
+        raise
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as error:
+        raise FrameError(f"Can't decode frame at {pos}: {error!r}") from error
+    return pos, pos
+
+
+def negotiate(wire_formats: Optional[List[int]]) -> Optional[WireFormat]:
+    """
+    Pick the first format of peer's `HandShake.wire_formats` that we speak
+    None means peer didn't advertise anything so it only knows JSON
+    """
+    for wire_format in wire_formats or ():
+        if wire_format in WIRE_FORMATS:
+            return WireFormat(wire_format)
+    return None
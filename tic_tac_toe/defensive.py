@@ -3,6 +3,8 @@ import os
 import traceback
 from typing import Any, Callable
 
+from tic_tac_toe.logger import flush
+
 
 def defensive(print_fn: Callable = print) -> Callable:
     """
@@ -23,6 +25,7 @@ def defensive(print_fn: Callable = print) -> Callable:
                 print_fn("Going down... :(")
                 print_fn(traceback.format_exc())  # pylint:  disable=bare-except
                 print_fn("Bye!")
+                flush()
                 os.kill(os.getpid(), 9)
 
         return wrapped
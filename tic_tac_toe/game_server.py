@@ -1,129 +1,381 @@
-import random
+import argparse
+import copy
+import os
+import queue
+import signal
 import socket
-from enum import IntEnum
-from typing import Optional
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
-from tic_tac_toe import messages, DEFAULT_PORT
+from tic_tac_toe import archive, messages, DEFAULT_PORT
+from tic_tac_toe.board import Board, TIE
+from tic_tac_toe.bot import Bot, get_bots
+from tic_tac_toe.journal import Journal
+from tic_tac_toe.keepalive import KeepAlive
 from tic_tac_toe.logger import get_logger
-from tic_tac_toe.messages import Result, GameEnded
-from tic_tac_toe.socket_handler import SocketHandler
+from tic_tac_toe.messages import Difficulty, Result, GameEnded
+from tic_tac_toe.socket_handler import SocketHandler, ConnectionClosed
+
+
+class Game:
+    """
+    marks[0] plays first, the bot always plays second
+    """
+
+    logger = get_logger("game", split=" ")
+
+    def __init__(self, game_id: int, players, bot: Optional[Bot] = None, link: Optional[SocketHandler] = None):
+        self.game_id = game_id
+        self.bot = bot
+        self.link = link
+        self.marks = players[0], players[1]
+        if self.marks[0] == 'BOT':
+            self.marks = self.marks[1], self.marks[0]
+        self.board = Board()
+        self.winner: Optional[str] = None
+        self.moves: List[int] = []
+        self.started = time.time()
+
+    @classmethod
+    def restore(
+        cls, game_id: int, marks, moves: List[int], started: float, bot: Optional[Bot] = None
+    ) -> "Game":
+        game = cls(game_id, marks, bot)
+        game.started = started
+        for pos in moves:
+            game.play(pos)
+        return game
+
+    @property
+    def current(self) -> str:
+        return self.marks[self.board.turn]
+
+    def other(self, username: str) -> str:
+        return self.marks[0] if self.marks[1] == username else self.marks[1]
+
+    def play(self, pos: int) -> bool:
+        if self.winner is not None or not self.board.is_free(pos):
+            return False
+        outcome = self.board.play(pos)
+        self.moves.append(pos)
+        if outcome == TIE:
+            self.logger.info("TIE")
+            self.winner = 'TIE'
+        elif outcome is not None:
+            self.winner = self.marks[outcome]
+            self.logger.info('%s won', self.winner)
+        return True
+
+    def result(self) -> Result:
+        return Result(self.board.cells, list(self.marks), self.winner, game_id=self.game_id)
 
 
 class GameServer:
+    """
+    Hosts up to `capacity` games at once over `links` connections to the web server,
+    every game message carries the `game_id` it belongs to
+    Notes:
+        messages are handled in batches of what's already received, bot turns
+        of a batch are played together with one `choose_many` call per bot
+        a game is answered on the link it was last heard from so a busy link
+        doesn't hold back games of the others, games of a link that closes or
+        goes silent move to the remaining ones, a dropped link is reopened while
+        another one is still up
+        with an `archive_dir` every finished game is archived there, see `archive.Archive`
+        extra links and heartbeats are only used when the web server accepts them
+        with a `journal` every game is written to it, a restart on the same journal
+        comes back with the same `server_id` and resumes the games the web server
+        kept for it, they're dropped when it didn't
+    """
+
     logger = get_logger("game-server", split=" ")
+    CAPACITY = 256
+    BATCH = 1024
+    LINKS = 2
+    RECOVERY = 15000
+    REOPEN_DELAY = 0.5
+    REOPEN_ATTEMPTS = 5
 
-    def __init__(self, host: str, port: int):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        capacity: int = CAPACITY,
+        links: int = LINKS,
+        journal: Optional[str] = None,
+        recovery: int = RECOVERY,
+        archive_dir: Optional[str] = None,
+    ):
         self.host = host
         self.port = port
+        self.capacity = capacity
+        self.link_count = links
+        self.server_id = uuid.uuid4().hex
+        self.journal: Optional[Journal] = None
+        self.recovery = recovery
+        self.games: Dict[int, Game] = {}
+        self.bots = get_bots()
+        if journal is not None:
+            self.journal = Journal(journal, self.server_id)
+            self.server_id = self.journal.server_id
+            for game_id, kept in self.journal.games.items():
+                self.games[game_id] = Game.restore(
+                    game_id, kept.marks, kept.moves, kept.started, self.bots[Difficulty(kept.difficulty)]
+                )
+        self.archive: Optional[archive.ArchiveWriter] = None
+        if archive_dir is not None:
+            self.archive = archive.ArchiveWriter(archive_dir, self.server_id)
+        self.links: List[SocketHandler] = [self.connect()]
+        self.inbox: "queue.SimpleQueue[Tuple[SocketHandler, Optional[List[messages.Message]]]]" = queue.SimpleQueue()
+        self.keep_alive: Optional[KeepAlive] = None
+        self.bot_turns: List[Game] = []
+
+    def connect(self) -> SocketHandler:
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        conn.connect((host, port))
-        self.socket_handler = SocketHandler(conn)
-        self.players = None
-        self.game_state = [None, None, None, None, None, None, None, None, None]
-
-    def get_winner(self) -> Optional[str]:
-        crosses = [
-            [0, 1, 2],
-            [3, 4, 5],
-            [6, 7, 8],
-            [0, 4, 8],
-            [2, 4, 6],
-            [0, 3, 6],
-            [1, 4, 7],
-            [2, 5, 8],
-        ]
-        for cross in crosses:
-            if self.game_state[cross[0]] == self.game_state[cross[1]] == self.game_state[cross[2]]:
-                if self.game_state[cross[0]]:
-                    self.logger.info('%s won', self.game_state[cross[0]])
-                    return self.game_state[cross[0]]
-        if None in self.game_state:
-            self.logger.info("No one")
-            return None
-        self.logger.info("TIE")
-        return 'TIE'
-
-    def move(self):
-        self.logger.info("Player %s can move now", self.players[0])
-        self.socket_handler.send_message(
-            messages.YouCanMove(self.players[0]), False
+        conn.connect((self.host, self.port))
+        return SocketHandler(conn)
+
+    def handshake(self, link: SocketHandler) -> Optional[messages.Acc]:
+        return link.handshake(messages.HandShake(
+            messages.SocketType.GAME,
+            capacity=self.capacity,
+            pid=os.getpid(),
+            server_id=self.server_id,
+            heartbeat=KeepAlive.INTERVAL,
+            recovery=self.recovery if self.journal is not None else None,
+        ))
+
+    def move(self, game: Game):
+        self.logger.info("Player %s can move now", game.current)
+        game.link.send_message(
+            messages.YouCanMove(game.current, game_id=game.game_id), False
         )
 
     def start(self):
         self.logger.info("Start game server")
-        acc = self.socket_handler.send_message(
-            messages.HandShake(messages.SocketType.GAME), True
-        )
+        acc = self.handshake(self.links[0])
         self.logger.info("Acc is %d %s", acc.result, acc.text)
-        while True:
-            message = self.socket_handler.get_next_message()
-            if message.message_type != messages.MessageType.ACC:
-                self.socket_handler.send_acc(message.message_id)
-            self.logger.info("New message type %s %s", message.message_type, message)
-            if message.message_type == messages.MessageType.GAME_START:
-                self.logger.info("Game started %s vs %s", *message.opponents)
-                self.players = message.opponents[0], message.opponents[1]
-                if self.players[0] == 'BOT':
-                    self.players = self.players[1], self.players[0]
-                self.move()
-            elif message.message_type == messages.MessageType.EXIT:
-                self.logger.info("Player %s left the game", message.user)
-                self.end_game(
-                    self.players[0] if self.players[1] == message.user else self.players[1]
-                )
-            elif message.message_type == messages.MessageType.SEND_MESSAGE:
-                self.socket_handler.send_message(message, False)
-            elif message.message_type == messages.MessageType.RECONNECTED:
-                self.logger.info("Player %s reconnected", message.user)
-                if len(self.players):
-                    self.logger.info("Game not finished")
-                    self.socket_handler.send_message(
-                        Result(self.game_state, self.get_winner()),
-                        False
-                    )
-                    if self.players[0] == message.user:
-                        self.move()
-            elif message.message_type == messages.MessageType.MAKE_MOVE:
-                self.logger.info("Move made at %s", message.pos)
-                if self.game_state[message.pos]:
-                    self.logger.info("Cell is not empty")
-                    self.socket_handler.send_acc(message.message_id, *messages.Codes.INVALID_MOVE)
-                else:
-                    self.game_state[message.pos] = self.players[0]
-                    self.players = self.players[1], self.players[0]
-
-                    if self.players[0] == 'BOT' and self.get_winner() is None:
-                        self.logger.info("Bot making move")
-                        while True:
-                            pos = random.randint(0, 8)
-                            if self.game_state[pos] is None:
-                                break
-                        self.logger.info("Bot hit %d", pos)
-                        self.game_state[pos] = 'BOT'
-                        self.players = self.players[1], self.players[0]
-                        self.socket_handler.send_message(
-                            Result(self.game_state, self.get_winner()),
-                            False
-                        )
-                    else:
-                        self.socket_handler.send_message(
-                            Result(self.game_state, self.get_winner()),
-                            False
-                        )
-                    if self.get_winner() is None:
-                        self.move()
-            if self.get_winner():
-                self.end_game(self.get_winner())
-
-    def end_game(self, winner: str):
-        self.logger.info("Game ended")
-        self.socket_handler.send_message(
-            GameEnded(winner), False
+        if acc.heartbeat:
+            self.keep_alive = KeepAlive(acc.heartbeat)
+            for _ in range(self.link_count - 1):
+                try:
+                    link = self.connect()
+                except OSError as e:
+                    self.logger.warning("Can't open another link to the web server: %s", e)
+                    break
+                if self.handshake(link) is None:
+                    link.shutdown()
+                    continue
+                self.links.append(link)
+            for link in self.links:
+                self.keep_alive.add(link)
+            self.keep_alive.start()
+        if self.games:
+            self.resume(acc.recovered())
+        for link in self.links:
+            threading.Thread(target=self.read_link, args=(link,), daemon=True).start()
+        try:
+            while self.links:
+                link, batch = self.inbox.get()
+                if batch is None:
+                    self.drop_link(link)
+                    continue
+                if not batch:
+                    self.add_link(link)
+                    continue
+                link.acknowledge(batch)
+                for message in batch:
+                    self.handle_message(message, link)
+                self.play_bot_turns()
+            self.logger.error("Web server disconnected")
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+            if self.archive is not None:
+                self.archive.close()
+
+    def resume(self, kept: bool):
+        """
+        Carry on with the games read from the journal, or drop them when the web server didn't keep them
+        """
+        if not kept:
+            self.logger.warning("Web server didn't keep our %d games, dropping them", len(self.games))
+            for game_id in list(self.games):
+                self.journal.end(game_id)
+            self.games.clear()
+            return
+        self.logger.warning("Resuming %d games", len(self.games))
+        for game in list(self.games.values()):
+            game.link = self.links[game.game_id % len(self.links)]
+            if game.winner is not None:
+                self.end_game(game, game.winner)
+            elif game.current == 'BOT':
+                self.bot_turns.append(game)
+        self.play_bot_turns()
+
+    def read_link(self, link: SocketHandler):
+        try:
+            while True:
+                message = link.get_next_message()
+                self.inbox.put((link, [message] + link.get_received_messages(self.BATCH)))
+        except ConnectionClosed:
+            self.inbox.put((link, None))
+
+    def drop_link(self, link: SocketHandler):
+        self.links.remove(link)
+        if self.keep_alive is not None:
+            self.keep_alive.remove(link)
+        if not self.links:
+            return
+        self.logger.warning("Lost a link to the web server, %d left", len(self.links))
+        for game in self.games.values():
+            if game.link is link:
+                game.link = self.links[game.game_id % len(self.links)]
+        if self.keep_alive is not None:
+            threading.Thread(target=self.reopen_link, daemon=True).start()
+
+    def reopen_link(self):
+        """
+        Connect a link in place of a dropped one, it's handed to the main loop as an empty batch
+        """
+        for attempt in range(self.REOPEN_ATTEMPTS):
+            time.sleep(self.REOPEN_DELAY * 2 ** attempt)
+            if not self.links:
+                return
+            try:
+                link = self.connect()
+            except OSError as e:
+                self.logger.warning("Can't reopen a link to the web server: %s", e)
+                continue
+            if self.handshake(link) is not None:
+                self.inbox.put((link, []))
+                return
+            link.shutdown()
+        self.logger.error("Gave up reopening a link to the web server")
+
+    def add_link(self, link: SocketHandler):
+        self.links.append(link)
+        self.keep_alive.add(link)
+        threading.Thread(target=self.read_link, args=(link,), daemon=True).start()
+        self.logger.warning("Reopened a link to the web server, %d links", len(self.links))
+
+    def handle_message(self, message: messages.Message, link: SocketHandler):
+        if message.message_type in (messages.MessageType.ACC, messages.MessageType.HEARTBEAT):
+            return
+        self.logger.info("New message type %s %s", message.message_type, message)
+        if message.message_type == messages.MessageType.GAME_START:
+            self.logger.info("Game %d started %s vs %s", message.game_id, *message.opponents)
+            difficulty = message.difficulty if message.difficulty in self.bots else Difficulty.EASY
+            if message.difficulty not in (None, difficulty):
+                self.logger.warning("Unknown difficulty %s, game %d is easy", message.difficulty, message.game_id)
+            game = Game(message.game_id, message.opponents, self.bots[difficulty], link)
+            self.games[game.game_id] = game
+            if self.journal is not None:
+                self.journal.start(game.game_id, game.marks, difficulty, game.started)
+            self.move(game)
+            return
+        game = self.games.get(message.game_id)
+        if game is None:
+            self.logger.warning("Unknown game %s", message.game_id)
+            if message.message_type == messages.MessageType.RECONNECTED:
+                # lost with a crash before it reached the journal
+                link.send_message(GameEnded(None, game_id=message.game_id), False)
+            return
+        game.link = link
+        if message.message_type == messages.MessageType.EXIT:
+            self.logger.info("Player %s left the game", message.user)
+            self.end_game(game, game.other(message.user))
+            return
+        elif message.message_type == messages.MessageType.SEND_MESSAGE:
+            link.send_message(copy.copy(message), False)
+        elif message.message_type == messages.MessageType.RECONNECTED:
+            self.logger.info("Player %s reconnected", message.user)
+            self.logger.info("Game not finished")
+            link.send_message(game.result(), False)
+            if game.current == message.user:
+                self.move(game)
+        elif message.message_type == messages.MessageType.MAKE_MOVE:
+            self.logger.info("Move made at %s", message.pos)
+            if game.current == 'BOT' or not game.play(message.pos):
+                self.logger.info("Invalid move")
+                link.send_acc(message.message_id, *messages.Codes.INVALID_MOVE)
+                return
+            if self.journal is not None:
+                self.journal.move(game.game_id, message.pos)
+            if game.current == 'BOT' and game.winner is None:
+                self.bot_turns.append(game)
+            else:
+                self.send_result(game)
+            return
+        if game.winner:
+            self.end_game(game, game.winner)
+
+    def send_result(self, game: Game):
+        game.link.send_message(game.result(), False)
+        if game.winner is None:
+            self.move(game)
+        else:
+            self.end_game(game, game.winner)
+
+    def play_bot_turns(self):
+        turns, self.bot_turns = self.bot_turns, []
+        by_bot = defaultdict(list)
+        for game in turns:
+            if self.games.get(game.game_id) is game:
+                by_bot[game.bot].append(game)
+        for bot, games in by_bot.items():
+            moves = bot.choose_many([game.board.cells for game in games])
+            self.logger.info("Bot %s made %d moves", bot.difficulty.name, len(games))
+            for game, pos in zip(games, moves):
+                game.play(int(pos))
+                if self.journal is not None:
+                    self.journal.move(game.game_id, int(pos))
+                self.send_result(game)
+
+    def end_game(self, game: Game, winner: str):
+        self.logger.info("Game %d ended", game.game_id)
+        game.link.send_message(
+            GameEnded(winner, game_id=game.game_id), False
         )
-        self.game_state = [None, None, None, None, None, None, None, None, None]
-        self.players = None
+        del self.games[game.game_id]
+        if self.journal is not None:
+            self.journal.end(game.game_id)
+        if self.archive is not None:
+            self.archive_game(game, winner)
+
+    def archive_game(self, game: Game, winner: Optional[str]):
+        if winner == 'TIE':
+            outcome = archive.TIED
+        elif winner in game.marks:
+            outcome = game.marks.index(winner)
+        else:
+            outcome = archive.NO_WINNER
+        difficulty = int(game.bot.difficulty) if 'BOT' in game.marks else 0
+        self.archive.add(game.marks, game.moves, game.started, time.time(), outcome, difficulty)
 
 
 if __name__ == "__main__":
-    game = GameServer("localhost", DEFAULT_PORT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--capacity", type=int, default=GameServer.CAPACITY,
+                        help="number of games hosted at once")
+    parser.add_argument("--host", default="localhost", help="web server host")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="web server port")
+    parser.add_argument("--links", type=int, default=GameServer.LINKS,
+                        help="connections to the web server games are spread over")
+    parser.add_argument("--journal", help="file games are kept in, a restart on it resumes them")
+    parser.add_argument("--recovery", type=int, default=GameServer.RECOVERY,
+                        help="milliseconds the web server keeps our games for a restart with --journal")
+    parser.add_argument("--archive", help="directory finished games are archived in")
+    args = parser.parse_args()
+    # the pool stops us with SIGTERM, exit through `start` so buffered games are archived
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        game = GameServer(args.host, args.port, args.capacity, args.links, args.journal, args.recovery, args.archive)
+    except OSError as e:
+        GameServer.logger.error("Can't connect to the web server at %s:%d: %s", args.host, args.port, e)
+        sys.exit(1)
     game.start()
@@ -0,0 +1,237 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from tic_tac_toe.logger import get_logger
+
+MAGIC = b"TTTJ"
+VERSION = 2
+# magic, version, generation, server id
+HEADER = struct.Struct("<4sBxxxQ32s")
+CRC = struct.Struct("<I")
+# kind, game id, value, payload size
+BODY = struct.Struct("<BIIH")
+RECORD_SIZE = CRC.size + BODY.size
+STARTED = struct.Struct("<d")
+
+START, MOVE, END, MOVES = 1, 2, 3, 4
+
+
+@dataclass
+class JournaledGame:
+    marks: Tuple[str, ...]
+    difficulty: int
+    started: float
+    moves: List[int] = field(default_factory=list)
+
+
+Games = Dict[int, JournaledGame]
+
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def encode_record(kind: int, game_id: int, value: int, payload: bytes = b"") -> bytes:
+    body = BODY.pack(kind, game_id, value, len(payload)) + payload
+    return CRC.pack(zlib.crc32(body)) + body
+
+
+def decode_records(data: Sequence, pos: int) -> Iterator[Tuple[int, int, int, bytes, int]]:
+    """
+    Records from `pos` until the first empty or damaged one
+    Returns:
+        kind, game id, value, payload and where the next record starts
+    """
+    while pos + RECORD_SIZE <= len(data):
+        kind, game_id, value, size = BODY.unpack_from(data, pos + CRC.size)
+        end = pos + RECORD_SIZE + size
+        if kind == 0 or end > len(data):
+            return
+        if zlib.crc32(data[pos + CRC.size:end]) != CRC.unpack_from(data, pos)[0]:
+            return
+        yield kind, game_id, value, bytes(data[pos + RECORD_SIZE:end]), end
+        pos = end
+
+
+def start_record(game_id: int, game: JournaledGame) -> bytes:
+    payload = STARTED.pack(game.started) + "\0".join(game.marks).encode()
+    return encode_record(START, game_id, game.difficulty, payload)
+
+
+def apply_record(games: Games, kind: int, game_id: int, value: int, payload: bytes):
+    if kind == START:
+        (started,) = STARTED.unpack_from(payload)
+        games[game_id] = JournaledGame(tuple(payload[STARTED.size:].decode().split("\0")), value, started)
+    elif kind == END:
+        games.pop(game_id, None)
+    elif game_id not in games:
+        return
+    elif kind == MOVE:
+        games[game_id].moves.append(value)
+    elif kind == MOVES:
+        games[game_id].moves = list(payload)
+
+
+def remove_journal(path: str):
+    for name in (path, path + ".snapshot"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+class Journal:
+    """
+    Games of a game server in an append-only memory-mapped file, a restarted
+    process reads them back and carries on where they were
+    Notes:
+        one record per started game, move and ended game, boards are restored
+        by playing the moves again
+        appended records are in the page cache right away so they survive the
+        process, a thread syncs them to disk every `commit_interval` seconds so
+        moves never wait on the disk and a crash of the machine loses at most that much
+        when the file is full the live games go to `path`.snapshot and the file
+        starts over with the next generation, recovery reads the snapshot and
+        replays the file when both are of the same generation
+        every record has a crc32, a torn record ends the replay
+        only one thread appends
+    """
+
+    logger = get_logger("journal", split=" ")
+    SIZE = 1 << 18
+    COMMIT_INTERVAL = 0.01
+
+    def __init__(
+        self, path: str, server_id: str, size: int = SIZE, commit_interval: float = COMMIT_INTERVAL
+    ):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.games: Games = {}
+        existing = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if existing:
+            size = os.fstat(self.fd).st_size
+        else:
+            os.ftruncate(self.fd, size)
+        self.size = size
+        self.mm = mmap.mmap(self.fd, size)
+        magic, version, generation, stored_id = HEADER.unpack_from(self.mm)
+        self.pos = HEADER.size
+        self.committed = 0
+        if existing and magic == MAGIC and version == VERSION:
+            self.server_id = stored_id.decode()
+            self.generation = generation
+            self.recover()
+        else:
+            self.server_id = server_id
+            self.generation = 0
+            self.write_header()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="journal", daemon=True)
+        self.thread.start()
+
+    def write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.generation, self.server_id.encode())
+
+    def recover(self):
+        started = time.perf_counter()
+        snapshot_generation = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as snapshot:
+                data = snapshot.read()
+            magic, version, snapshot_generation, _ = HEADER.unpack_from(data)
+            if magic == MAGIC and version == VERSION:
+                for kind, game_id, value, payload, _ in decode_records(data, HEADER.size):
+                    apply_record(self.games, kind, game_id, value, payload)
+        if snapshot_generation == self.generation + 1:
+            # the snapshot was written but the file wasn't started over, it's all in the snapshot
+            self.generation = snapshot_generation
+            self.mm[HEADER.size:] = bytes(self.size - HEADER.size)
+            self.write_header()
+            self.mm.flush()
+        else:
+            for kind, game_id, value, payload, end in decode_records(self.mm, HEADER.size):
+                apply_record(self.games, kind, game_id, value, payload)
+                self.pos = end
+            # drop what's left of a torn record
+            self.mm[self.pos:] = bytes(self.size - self.pos)
+        self.logger.info(
+            "Recovered %d games from %s in %.1fms",
+            len(self.games), self.path, (time.perf_counter() - started) * 1000,
+        )
+
+    def append(self, record: bytes):
+        end = self.pos + len(record)
+        if end > self.size:
+            self.snapshot()
+            end = self.pos + len(record)
+        self.mm[self.pos:end] = record
+        self.pos = end
+
+    def start(self, game_id: int, marks: Sequence[str], difficulty: int, started: float):
+        game = self.games[game_id] = JournaledGame(tuple(marks), difficulty, started)
+        self.append(start_record(game_id, game))
+
+    def move(self, game_id: int, pos: int):
+        # a snapshot taken by `append` must not have the move yet, the record replays it
+        self.append(encode_record(MOVE, game_id, pos))
+        self.games[game_id].moves.append(pos)
+
+    def end(self, game_id: int):
+        self.games.pop(game_id, None)
+        self.append(encode_record(END, game_id, 0))
+
+    def clear(self):
+        """
+        Start the file over, everything in it must be in the snapshot
+        """
+        with self.lock:
+            self.mm[HEADER.size:self.pos] = bytes(self.pos - HEADER.size)
+            self.write_header()
+            self.mm.flush()
+            self.pos = HEADER.size
+            self.committed = 0
+
+    def snapshot(self):
+        records = []
+        for game_id, game in self.games.items():
+            records.append(start_record(game_id, game))
+            records.append(encode_record(MOVES, game_id, 0, bytes(game.moves)))
+        temporary = self.snapshot_path + ".tmp"
+        with open(temporary, "wb") as snapshot:
+            snapshot.write(HEADER.pack(MAGIC, VERSION, self.generation + 1, self.server_id.encode()))
+            snapshot.write(b"".join(records))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.snapshot_path)
+        self.generation += 1
+        self.clear()
+        self.logger.info("Snapshot of %d games, generation %d", len(self.games), self.generation)
+
+    def commit(self):
+        """
+        Sync what was appended since the last commit
+        """
+        with self.lock:
+            end = self.pos
+            if end == self.committed:
+                return
+            fdatasync(self.fd)
+            self.committed = end
+
+    def run(self):
+        while not self.stopped.wait(self.commit_interval):
+            self.commit()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.commit()
+        self.mm.close()
+        os.close(self.fd)
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Optional, Tuple, Union
+
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.messages import Heartbeat
+from tic_tac_toe.socket_handler import AsyncSocketHandler, SocketHandler
+
+Link = Union[SocketHandler, AsyncSocketHandler]
+
+
+class KeepAlive:
+    """
+    Sends heartbeats on links and drops the ones whose peer went silent
+    Notes:
+        every link gets a `Heartbeat` each `interval`, a link that received nothing
+        for `timeouts` intervals is shut down so its usual close path moves its
+        games to another link, a dead peer is noticed within `timeouts + 1` intervals
+        the intervals are those of whichever end of a link beats slower
+        `check` runs in a thread, or on the event loop when started with one
+    """
+
+    logger = get_logger("keep-alive", split=" ")
+    INTERVAL = 1000
+    TIMEOUTS = 3
+
+    def __init__(self, interval: int = INTERVAL, timeouts: int = TIMEOUTS):
+        self.interval_ms = interval
+        self.interval = interval / 1000
+        self.timeouts = timeouts
+        self.lock = threading.Lock()
+        self.links: Dict[int, Tuple[Link, float]] = {}
+        self.started = False
+
+    def add(self, link: Link, interval: Optional[int] = None):
+        """
+        Args:
+            interval: heartbeat interval of the peer in ms, when it's slower than ours
+        """
+        timeout = max(self.interval, (interval or 0) / 1000) * self.timeouts
+        with self.lock:
+            self.links[id(link)] = (link, timeout)
+
+    def remove(self, link: Link):
+        with self.lock:
+            self.links.pop(id(link), None)
+
+    def check(self):
+        now = time.monotonic()
+        with self.lock:
+            links = list(self.links.values())
+        for link, timeout in links:
+            if now - link.last_received > timeout:
+                self.logger.error("Peer is silent for %.1fs, dropping the link", now - link.last_received)
+                self.remove(link)
+                link.shutdown()
+            else:
+                link.send_message(Heartbeat(), False)
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        if loop is None:
+            threading.Thread(target=self.run, daemon=True).start()
+        else:
+            loop.call_later(self.interval, self.tick, loop)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def tick(self, loop: asyncio.AbstractEventLoop):
+        self.check()
+        loop.call_later(self.interval, self.tick, loop)
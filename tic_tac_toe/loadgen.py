@@ -0,0 +1,610 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from tic_tac_toe import messages
+from tic_tac_toe.bench import print_rows
+from tic_tac_toe.board import Board
+from tic_tac_toe.bot import PerfectBot
+from tic_tac_toe.codec import WIRE_FORMATS
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.messages import GameType, Message, MessageType, SocketType, WireFormat
+from tic_tac_toe.pool import ROOT, GameServerPool
+from tic_tac_toe.socket_handler import AsyncSocketHandler, ConnectionClosed
+from tic_tac_toe.web_server import WebServer
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+REPORT_VERSION = 1
+RECONNECT_DELAY = 0.05
+
+
+@dataclass
+class LoadConfig:
+    players: int = 100
+    games: int = 5
+    multi_player: float = 0.5
+    perfect: float = 0.5
+    chat: float = 0.1
+    reconnect: float = 0.02
+    binary: bool = True
+    seed: int = 0
+    ramp: float = 1.0
+    warmup: float = 1.0
+    timeout: float = 30.0
+    target: Optional[str] = None
+    in_process: bool = False
+    asyncio: bool = False
+    shards: int = 1
+    game_servers: int = 4
+    min_game_servers: int = 1
+    idle_game_servers: int = 1
+    game_server_capacity: int = GameServerPool.CAPACITY
+    journal_dir: Optional[str] = None
+    archive_dir: Optional[str] = None
+    user_ttl: float = WebServer.USER_TTL
+    log_level: str = "ERROR"
+
+
+@dataclass
+class LoadStats:
+    counters: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+    move_rtts: List[float] = field(default_factory=list)
+    match_waits: List[float] = field(default_factory=list)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Milliseconds, empty when nothing was measured
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        "p50": values[len(values) // 2] * 1e3,
+        "p90": values[int(len(values) * 0.9)] * 1e3,
+        "p99": values[int(len(values) * 0.99)] * 1e3,
+        "max": values[-1] * 1e3,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((WebServer.HOST, 0))
+        return s.getsockname()[1]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ProcessSampler:
+    """
+    CPU time and resident memory of a process and all of its descendants, read from /proc
+    Notes:
+        sampled every `INTERVAL` so game servers retired during the run still count
+        up to their last sample, reports nothing where there is no /proc
+    """
+
+    INTERVAL = 0.5
+
+    def __init__(self, root: int):
+        self.root = root
+        self.available = os.path.isdir("/proc")
+        self.cpu: Dict[int, float] = {}
+        self.baseline: Dict[int, float] = {}
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def read(self) -> Dict[int, Tuple[int, float, int]]:
+        """
+        Returns:
+            parent pid, CPU seconds and RSS bytes of every process
+        """
+        ticks, page_size = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+        stats = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    data = f.read()
+            except OSError:
+                continue
+            # fields after the command, which may contain spaces, start with the state
+            fields = data[data.rindex(")") + 2:].split()
+            stats[int(entry)] = (
+                int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * page_size
+            )
+        return stats
+
+    def sample(self):
+        stats = self.read()
+        children: Dict[int, List[int]] = {}
+        for pid, (parent, _, _) in stats.items():
+            children.setdefault(parent, []).append(pid)
+        tree, stack = [], [self.root]
+        while stack:
+            pid = stack.pop()
+            if pid in stats:
+                tree.append(pid)
+                stack.extend(children.get(pid, ()))
+        for pid in tree:
+            self.cpu[pid] = stats[pid][1]
+        self.peak_rss = max(self.peak_rss, sum(stats[pid][2] for pid in tree))
+
+    def start(self):
+        if not self.available:
+            return
+        self.sample()
+        self.baseline = dict(self.cpu)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.sample()
+
+    def stop(self):
+        if not self.thread.is_alive():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    def summary(self) -> Optional[Dict]:
+        if not self.available:
+            return None
+        return {
+            "cpu_s": sum(cpu - self.baseline.get(pid, 0.0) for pid, cpu in self.cpu.items()),
+            "peak_rss_mb": self.peak_rss / 2 ** 20,
+            "processes": len(self.cpu),
+        }
+
+
+class Player:
+    """
+    Headless `Client`, plays `LoadConfig.games` scripted games over one connection
+    Notes:
+        every choice comes from its own seeded `rng` so a seed replays the same script,
+        perfect players pick `PerfectBot` moves and the others random free cells
+        on its turn a player may drop its connection once per game and reconnect
+        with its username and resume token, in multiplayer games it may chat before moving
+        the move round trip is the time from `MakeMove` to the next `Result`
+    """
+
+    def __init__(self, load: "LoadGenerator", rng: random.Random):
+        self.load = load
+        self.config = load.config
+        self.stats = load.stats
+        self.rng = rng
+        self.perfect = rng.random() < self.config.perfect
+        self.handler: Optional[AsyncSocketHandler] = None
+        self.inbox: "asyncio.Queue[Optional[Message]]" = asyncio.Queue()
+        self.username: Optional[str] = None
+        self.token: Optional[str] = None
+        self.waiting = False
+        self.last = "connect"
+        self.task: Optional[asyncio.Task] = None
+
+    def received(self, handler: AsyncSocketHandler, message: Message):
+        if handler is self.handler:
+            self.inbox.put_nowait(message)
+
+    def closed(self, handler: AsyncSocketHandler):
+        if handler is self.handler:
+            self.inbox.put_nowait(None)
+
+    async def connect(self) -> messages.Acc:
+        _, self.handler = await asyncio.get_running_loop().create_connection(
+            lambda: AsyncSocketHandler(self.received, self.closed), self.load.host, self.load.port
+        )
+        handshake = messages.HandShake(
+            SocketType.CLIENT, self.username, token=self.token,
+            wire_formats=WIRE_FORMATS if self.config.binary else [WireFormat.JSON],
+        )
+        acc = await self.handler.request(handshake, self.config.timeout)
+        if acc is None:
+            raise asyncio.TimeoutError()
+        if acc.wire_format is not None:
+            self.handler.wire_format = acc.wire_format
+        self.token = acc.token or self.token
+        return acc
+
+    async def reconnect(self):
+        self.stats.counters["reconnects"] += 1
+        handler, self.handler = self.handler, None
+        handler.shutdown()
+        await asyncio.sleep(RECONNECT_DELAY)
+        if not (await self.connect()).in_game():
+            self.stats.errors["reconnect not in game"] += 1
+            raise ConnectionClosed()
+
+    async def next_message(self) -> Message:
+        message = await asyncio.wait_for(self.inbox.get(), self.config.timeout)
+        if message is None:
+            raise ConnectionClosed()
+        self.last = message.message_type.name
+        self.handler.acknowledge([message])
+        return message
+
+    def choose(self, board: Board) -> int:
+        if self.perfect:
+            return self.load.bot.choose(board)
+        return self.rng.choice(board.free_cells())
+
+    async def play(self):
+        multi_player = self.rng.random() < self.config.multi_player
+        game_type = GameType.MULTI_PLAYER if multi_player else GameType.SINGLE_PLAYER
+        difficulty = None if multi_player else self.rng.choice(list(messages.Difficulty))
+        requested = time.perf_counter()
+        acc = await self.handler.request(
+            messages.RequestNewGame(game_type, difficulty=difficulty), self.config.timeout
+        )
+        if acc is None:
+            self.last = "NEW_GAME_REQUEST"
+            raise asyncio.TimeoutError()
+        cells, moved, reconnected = 0, None, False
+        while True:
+            message = await self.next_message()
+            kind = message.message_type
+            if kind == MessageType.WAIT_FOR_OPPONENT:
+                self.waiting = multi_player
+            elif kind == MessageType.GAME_FOUND:
+                self.waiting = False
+                self.stats.match_waits.append(time.perf_counter() - requested)
+            elif kind == MessageType.RESULT:
+                cells = message.cells
+                if moved is not None:
+                    self.stats.move_rtts.append(time.perf_counter() - moved)
+                    moved = None
+            elif kind == MessageType.YOU_CAN_MOVE:
+                board = Board.from_cells(cells)
+                if board.outcome is not None:
+                    continue
+                if not reconnected and self.rng.random() < self.config.reconnect:
+                    reconnected = True
+                    await self.reconnect()
+                    continue
+                if multi_player and self.rng.random() < self.config.chat:
+                    self.handler.send_message(messages.SendMessage(f"good luck {self.username}", ""))
+                    self.stats.counters["chats"] += 1
+                self.handler.send_message(messages.MakeMove(self.choose(board)))
+                self.stats.counters["moves"] += 1
+                moved = time.perf_counter()
+            elif kind == MessageType.ACC and message.result == messages.Codes.INVALID_MOVE[0]:
+                self.stats.errors["invalid move"] += 1
+            elif kind == MessageType.GAME_ENDED:
+                self.stats.counters[game_type.name.lower()] += 1
+                return
+
+    async def run(self):
+        try:
+            self.username = (await self.connect()).username
+            for _ in range(self.config.games):
+                await self.play()
+        except ConnectionClosed:
+            self.stats.errors["disconnected"] += 1
+        except asyncio.TimeoutError:
+            self.stats.errors[f"timeout after {self.last}"] += 1
+        except OSError:
+            self.stats.errors["connect failed"] += 1
+        finally:
+            if self.handler is not None:
+                self.handler.close()
+
+
+class LoadGenerator:
+    """
+    Runs `LoadConfig.players` scripted players at once and reports what it measured
+    Notes:
+        the load goes to `target`, or to a web server with a game server pool started
+        for the run, as a child process or inside this one with `in_process`
+        server CPU and memory cover the whole process tree of the started web server,
+        in process that includes the players themselves
+        a multiplayer player still waiting once everyone else is done has no one left
+        to play with, it's counted as unmatched instead of waiting for its timeout
+    """
+
+    logger = get_logger("load-generator", split=" ")
+    START_TIMEOUT = 10.0
+    STOP_TIMEOUT = 5.0
+
+    def __init__(self, config: LoadConfig):
+        self.config = config
+        self.stats = LoadStats()
+        self.host = WebServer.HOST
+        self.port = WebServer.PORT
+        self.process: Optional[subprocess.Popen] = None
+        self.server: Optional[WebServer] = None
+        self.sampler: Optional[ProcessSampler] = None
+        self.players: List[Player] = []
+        self.bot: Optional[PerfectBot] = None
+        self.started = 0.0
+        self.finished = 0.0
+
+    def start_stack(self):
+        config = self.config
+        if config.target is not None:
+            host, _, port = config.target.rpartition(":")
+            self.host, self.port = host or self.host, int(port)
+            return
+        self.port = free_port()
+        if config.in_process:
+            if config.asyncio:
+                from tic_tac_toe.async_web_server import AsyncWebServer as server_class
+            else:
+                server_class = WebServer
+            server_class.PORT = self.port
+            self.server = server_class(config.user_ttl)
+            if config.game_servers > 0:
+                self.server.pool = GameServerPool(
+                    self.server, config.min_game_servers, config.game_servers,
+                    config.idle_game_servers, config.game_server_capacity,
+                    journal_dir=config.journal_dir, archive_dir=config.archive_dir,
+                )
+            self.server.sockets_thread.daemon = True
+            self.server.sockets_thread.start()
+            if self.server.pool is not None:
+                self.server.pool.start()
+            self.sampler = ProcessSampler(os.getpid())
+        else:
+            command = [
+                sys.executable, "-m", "tic_tac_toe.web_server",
+                "--port", str(self.port),
+                "--user-ttl", str(config.user_ttl),
+                "--shards", str(config.shards),
+                "--max-game-servers", str(config.game_servers),
+                "--min-game-servers", str(config.min_game_servers),
+                "--idle-game-servers", str(config.idle_game_servers),
+                "--game-server-capacity", str(config.game_server_capacity),
+            ]
+            if config.asyncio:
+                command.append("--asyncio")
+            if config.journal_dir is not None:
+                command += ["--journal-dir", config.journal_dir]
+            if config.archive_dir is not None:
+                command += ["--archive-dir", config.archive_dir]
+            self.process = subprocess.Popen(
+                command, cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                env=dict(os.environ, GAY_LEVEL=config.log_level),
+            )
+            self.sampler = ProcessSampler(self.process.pid)
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection((self.host, self.port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.logger.info("Web server is up on %s:%d", self.host, self.port)
+        # let the pool connect its first game servers
+        time.sleep(config.warmup)
+
+    def stop_stack(self):
+        if self.server is not None and self.server.pool is not None:
+            # `stop` would close the listener and `defensive` takes the process down with it
+            self.server.pool.stop()
+        if self.process is not None:
+            try:
+                self.process.communicate(b"/exit\n", timeout=self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.terminate()
+                self.process.wait()
+
+    def done(self, player: Player):
+        live = [other for other in self.players if other is not player and not other.task.done()]
+        if not live or not all(other.waiting for other in live):
+            return
+        self.logger.warning("%d players are left without an opponent", len(live))
+        self.stats.errors["unmatched"] += len(live)
+        for other in live:
+            other.waiting = False
+            other.task.cancel()
+
+    async def run_player(self, player: Player, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await player.run()
+        finally:
+            self.finished = time.perf_counter()
+            self.done(player)
+
+    async def run_players(self):
+        config = self.config
+        seeds = random.Random(config.seed)
+        self.players = [Player(self, random.Random(seeds.getrandbits(64))) for _ in range(config.players)]
+        self.started = time.perf_counter()
+        for number, player in enumerate(self.players):
+            player.task = asyncio.create_task(self.run_player(player, number * config.ramp / config.players))
+        await asyncio.gather(*(player.task for player in self.players), return_exceptions=True)
+
+    def run(self) -> Dict:
+        started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        usage = None
+        try:
+            self.start_stack()
+            if self.config.perfect > 0:
+                # solved before measuring so the table isn't counted as load
+                self.bot = PerfectBot()
+            usage = resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None
+            if self.sampler is not None:
+                self.sampler.start()
+            asyncio.run(self.run_players())
+        finally:
+            if self.sampler is not None:
+                self.sampler.stop()
+            self.stop_stack()
+        client = None
+        if usage is not None:
+            end = resource.getrusage(resource.RUSAGE_SELF)
+            client = {
+                "cpu_s": end.ru_utime + end.ru_stime - usage.ru_utime - usage.ru_stime,
+                "max_rss_mb": end.ru_maxrss / 2 ** 10,
+            }
+        return {
+            "version": REPORT_VERSION,
+            "started": started_at,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": asdict(self.config),
+            "results": self.results(client),
+        }
+
+    def results(self, client: Optional[Dict]) -> Dict:
+        counters = self.stats.counters
+        duration = self.finished - self.started
+        matches = counters["single_player"] + counters["multi_player"] / 2
+        return {
+            "duration_s": duration,
+            "single_player_games": counters["single_player"],
+            "multi_player_games": counters["multi_player"],
+            "matches": matches,
+            "matches_per_s": matches / duration if duration else 0.0,
+            "moves": counters["moves"],
+            "moves_per_s": counters["moves"] / duration if duration else 0.0,
+            "move_rtt_ms": percentiles(self.stats.move_rtts),
+            "match_wait_ms": percentiles(self.stats.match_waits),
+            "chats": counters["chats"],
+            "reconnects": counters["reconnects"],
+            "errors": dict(self.stats.errors),
+            "client": client,
+            "server": self.sampler.summary() if self.sampler is not None else None,
+        }
+
+
+def flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare_rows(old: Dict, new: Dict) -> List[Dict]:
+    old_results, new_results = flatten(old["results"]), flatten(new["results"])
+    rows = []
+    for metric in sorted(set(old_results) | set(new_results)):
+        before, after = old_results.get(metric), new_results.get(metric)
+        change = (
+            f"{(after - before) / before * 100:+.1f}%"
+            if before and after is not None else "-"
+        )
+        rows.append({"metric": metric, "old": before, "new": after, "change": change})
+    return rows
+
+
+if __name__ == "__main__":
+    defaults = LoadConfig()
+    parser = argparse.ArgumentParser(
+        description="scripted players against a web server and its game servers, "
+                    "prints a JSON report that --compare can diff against a later run",
+    )
+    parser.add_argument("--players", type=int, default=defaults.players, help="players connected at once")
+    parser.add_argument("--games", type=int, default=defaults.games, help="games played by every player")
+    parser.add_argument(
+        "--multi-player", type=float, default=defaults.multi_player, help="share of multiplayer games",
+    )
+    parser.add_argument(
+        "--perfect", type=float, default=defaults.perfect,
+        help="share of players playing perfect moves instead of random ones",
+    )
+    parser.add_argument(
+        "--chat", type=float, default=defaults.chat, help="chance to chat before a multiplayer move",
+    )
+    parser.add_argument(
+        "--reconnect", type=float, default=defaults.reconnect,
+        help="chance to drop the connection and reconnect on a turn, at most once per game",
+    )
+    parser.add_argument("--json", action="store_true", help="players only speak JSON")
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="seed of every player's script")
+    parser.add_argument("--ramp", type=float, default=defaults.ramp, help="seconds over which players connect")
+    parser.add_argument(
+        "--warmup", type=float, default=defaults.warmup, help="seconds to wait for the game servers to connect",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=defaults.timeout, help="seconds a player waits for any message",
+    )
+    parser.add_argument("--target", help="HOST:PORT of a running web server instead of starting one")
+    parser.add_argument(
+        "--in-process", action="store_true", help="run the web server in this process instead of a child one",
+    )
+    parser.add_argument("--asyncio", action="store_true", help="start the asyncio web server")
+    parser.add_argument("--shards", type=int, default=defaults.shards, help="web server processes (linux only)")
+    parser.add_argument(
+        "--game-servers", type=int, default=defaults.game_servers,
+        help="most game server processes the pool may spawn, 0 to connect them by hand",
+    )
+    parser.add_argument("--min-game-servers", type=int, default=defaults.min_game_servers)
+    parser.add_argument("--idle-game-servers", type=int, default=defaults.idle_game_servers)
+    parser.add_argument("--game-server-capacity", type=int, default=defaults.game_server_capacity)
+    parser.add_argument("--journal-dir", help="spawned game servers journal their games here")
+    parser.add_argument("--archive-dir", help="spawned game servers archive finished games here")
+    parser.add_argument("--user-ttl", type=float, default=defaults.user_ttl)
+    parser.add_argument(
+        "--log-level", default=defaults.log_level, help="log level of a web server started as a child process",
+    )
+    parser.add_argument("--report", help="also write the report to this file")
+    parser.add_argument("--compare", help="report of an earlier run to compare with")
+    args = parser.parse_args()
+    if args.shards > 1 and args.in_process:
+        parser.error("--shards needs a web server in its own process")
+    report = LoadGenerator(LoadConfig(
+        players=args.players,
+        games=args.games,
+        multi_player=args.multi_player,
+        perfect=args.perfect,
+        chat=args.chat,
+        reconnect=args.reconnect,
+        binary=not args.json,
+        seed=args.seed,
+        ramp=args.ramp,
+        warmup=args.warmup,
+        timeout=args.timeout,
+        target=args.target,
+        in_process=args.in_process,
+        asyncio=args.asyncio,
+        shards=args.shards,
+        game_servers=args.game_servers,
+        min_game_servers=args.min_game_servers,
+        idle_game_servers=args.idle_game_servers,
+        game_server_capacity=args.game_server_capacity,
+        journal_dir=args.journal_dir,
+        archive_dir=args.archive_dir,
+        user_ttl=args.user_ttl,
+        log_level=args.log_level,
+    )).run()
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print_rows(compare_rows(json.load(f), report))
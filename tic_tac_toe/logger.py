@@ -1,6 +1,13 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
 import zlib
+from typing import Dict, List, Optional, Tuple
 
 reset = "\x1b[0m"
 FORMATS = {
@@ -67,47 +74,338 @@ class LoggerFormatter(logging.Formatter):
                        its false by default meaning it only shows line number
             emphasize_from: make whole log line colorized should the log_level be greater
                             than `emphasize_from`
+        Notes:
+            the painted level and name parts are built once per level and name,
+            the date once per second
         """
         super().__init__()
         self.splitter = splitter
         self.show_func = show_func
         self.emphasize_from = emphasize_from
+        self.prefixes: Dict[Tuple[int, str, int], Tuple[str, str]] = {}
+        self.second = -1
+        self.date = ""
+
+    def format_time(self, record: logging.LogRecord) -> str:
+        second = int(record.created)
+        if second != self.second:
+            self.second = second
+            self.date = time.strftime(self.default_time_format, self.converter(record.created))
+        return self.default_msec_format % (self.date, record.msecs)
+
+    def prefix(self, record: logging.LogRecord, time_size: int) -> Tuple[str, str]:
+        """
+        Returns:
+            what goes between the time and the message, and the color of the whole line
+        """
+        key = (record.levelno, record.name, time_size)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            split_3 = self.splitter * 3
+            level = f"{split_3}[{'x' * time_size}]{split_3}[{record.levelname}]"
+            level_pad = self.splitter * (self.level_just - len(level))
+            name = f"{split_3}[{record.name}]{split_3}"
+            name_pad = self.splitter * (self.name_just - len(name))
+            if record.levelno >= self.emphasize_from:
+                prefix = (
+                    f"]{split_3}[{record.levelname}]{level_pad}{name}{name_pad}",
+                    FORMATS[record.levelno],
+                )
+            else:
+                prefix = (
+                    f"]{split_3}[{paint_level(record.levelno, record.levelname)}]{level_pad}"
+                    f"{split_3}[{paint_name(record.name)}]{split_3}{name_pad}",
+                    "",
+                )
+            self.prefixes[key] = prefix
+        return prefix
 
     def format(self, record: logging.LogRecord) -> str:
-        time = self.formatTime(record, self.datefmt)
-        split_3 = self.splitter * 3
+        time_text = self.format_time(record)
+        prefix, color = self.prefix(record, len(time_text))
+        message = record.getMessage()
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            message += f" (+{suppressed} suppressed)"
         log_text = (
-            f"{split_3}[{time}]{split_3}[{record.levelname}]".ljust(
-                self.level_just, self.splitter
-            )
-            + f"{split_3}[{record.name}]{split_3}".ljust(self.name_just, self.splitter)
-            + f" {record.getMessage()} :: ({record.filename}:"
+            f"{color}{self.splitter * 3}[{time_text}{prefix} {message} :: ({record.filename}:"
             + (f"{record.lineno}", record.funcName)[self.show_func]
             + ")"
         )
-        if record.levelno >= self.emphasize_from:
-            return paint_level(record.levelno, log_text)
-        return log_text.replace(
-            record.levelname, paint_level(record.levelno, record.levelname)
-        ).replace(record.name, paint_name(record.name))
+        if color:
+            return log_text + reset
+        return log_text
 
 
-def get_logger(
-    name: str,
-    level: int = logging.NOTSET,
-    split: str = "=",
-    show_func: bool = False,
-    emphasize_from: int = logging.ERROR,
-) -> logging.Logger:
-    lev_tmp = os.getenv("GAY_LEVEL")
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, for log files read by tools rather than people
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "file": record.filename,
+            "line": record.lineno,
+            "function": record.funcName,
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class RateLimit(logging.Filter):
+    """
+    Lets at most `per_second` records below WARNING through per line of code every second
+    Notes:
+        the next record let through from a line says how many of its records were dropped
+        counts aren't locked, under contention a few extra records may pass
+    """
+
+    def __init__(self, per_second: int):
+        super().__init__()
+        self.per_second = per_second
+        # (path, line) -> [second, passed in that second, dropped since the last one passed]
+        self.sites: Dict[Tuple[str, int], List[int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        second = int(record.created)
+        site = self.sites.get((record.pathname, record.lineno))
+        if site is None:
+            site = self.sites[(record.pathname, record.lineno)] = [second, 0, 0]
+        if site[0] != second:
+            site[0], site[1] = second, 0
+        if site[1] >= self.per_second:
+            site[2] += 1
+            return False
+        site[1] += 1
+        if site[2]:
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+
+class LogWriter:
+    """
+    Background thread formatting and writing the records of every `QueuedHandler`
+    Notes:
+        logging only puts the record on a queue, so a slow terminal or disk never
+        holds up the thread that logs, the writer drains whatever is queued and
+        flushes each output once per batch
+        records past `MAX_QUEUED` are dropped and counted rather than waited for
+    """
+
+    MAX_QUEUED = 100000
+
+    def __init__(self):
+        self.queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def put(self, output: logging.Handler, record: logging.LogRecord):
+        if self.thread is None:
+            self.start()
+        if self.queue.qsize() >= self.MAX_QUEUED:
+            self.dropped += 1
+            return
+        self.queue.put((output, record))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+                self.thread.start()
+
+    def write(self, output: logging.Handler, record: logging.LogRecord):
+        try:
+            output.stream.write(output.format(record) + output.terminator)  # type: ignore
+        except Exception:  # pylint: disable=broad-except
+            output.handleError(record)
+
+    def run(self):
+        while True:
+            outputs = set()
+            item = self.queue.get()
+            while True:
+                if isinstance(item, threading.Event):
+                    for output in outputs:
+                        output.flush()
+                    outputs.clear()
+                    item.set()
+                else:
+                    output, record = item
+                    if self.dropped:
+                        dropped, self.dropped = self.dropped, 0
+                        self.write(output, logging.makeLogRecord({
+                            "name": "logger", "levelno": logging.WARNING, "levelname": "WARNING",
+                            "msg": "Dropped %d records, the log writer was behind", "args": (dropped,),
+                        }))
+                    self.write(output, record)
+                    outputs.add(output)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            for output in outputs:
+                output.flush()
+
+    def flush(self, timeout: float = 1.0):
+        """
+        Wait until every record queued so far is written
+        """
+        if self.thread is None or threading.current_thread() is self.thread:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+
+WRITER = LogWriter()
+atexit.register(WRITER.flush)
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to `WRITER`, which writes them with `output`
+    Notes:
+        the message is built from its arguments in the logging thread, they may
+        change before the writer gets to it, the rest of the line is left to `output`
+    """
+
+    def __init__(self, output: logging.Handler):
+        super().__init__(None)  # type: ignore
+        self.output = output
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            # tracebacks hold frames alive, keep the text only
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        WRITER.put(self.output, record)
+
+    def emit(self, record: logging.LogRecord):
+        self.enqueue(self.prepare(record))
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # the queue is thread safe, skip the handler lock
+        passed = self.filter(record)
+        if passed:
+            self.emit(record)
+        return passed
+
+
+# name -> arguments of its latest `get_logger` call, so `configure` can rebuild its handlers
+LOGGERS: Dict[str, Tuple[int, str, bool, int]] = {}
+HANDLERS: Dict[str, List[logging.Handler]] = {}
+SETTINGS = {
+    "level": os.getenv("GAY_LEVEL"),
+    "queue": os.getenv("GAY_QUEUE", "1") != "0",
+    "json": os.getenv("GAY_JSON"),
+    "rate": int(os.getenv("GAY_RATE", "0") or 0),
+}
+JSON_OUTPUTS: Dict[str, logging.Handler] = {}
+RATE_LIMIT = RateLimit(SETTINGS["rate"])  # type: ignore
+
+
+def json_output(path: str) -> logging.Handler:
+    """
+    The handler writing JSON lines to `path`, shared by every logger
+    """
+    if path not in JSON_OUTPUTS:
+        output = logging.FileHandler(path)
+        output.setFormatter(JsonFormatter())
+        JSON_OUTPUTS[path] = output
+    return JSON_OUTPUTS[path]
+
+
+def attach(name: str):
+    level, split, show_func, emphasize_from = LOGGERS[name]
     if level is logging.NOTSET:
-        level = (lev_tmp, logging.INFO)[lev_tmp is None]  # type: ignore
+        level = (SETTINGS["level"], logging.INFO)[SETTINGS["level"] is None]  # type: ignore
     stdout_h = logging.StreamHandler()
-    stdout_h.setLevel(level)
     stdout_h.setFormatter(LoggerFormatter(split, show_func, emphasize_from))
+    outputs = [stdout_h]
+    if SETTINGS["json"]:
+        outputs.append(json_output(SETTINGS["json"]))  # type: ignore
+    handlers = [QueuedHandler(output) for output in outputs] if SETTINGS["queue"] else outputs
 
     logger = logging.getLogger(name)
+    for handler in HANDLERS.get(name, []):
+        logger.removeHandler(handler)
+    for handler in handlers:
+        logger.addHandler(handler)
+    HANDLERS[name] = handlers
+    logger.removeFilter(RATE_LIMIT)
+    if RATE_LIMIT.per_second > 0:
+        logger.addFilter(RATE_LIMIT)
     logger.setLevel(level)
-    logger.addHandler(stdout_h)
 
-    return logger
+
+def configure(
+    level: Optional[str] = None,
+    use_queue: Optional[bool] = None,
+    json_path: Optional[str] = None,
+    rate: Optional[int] = None,
+):
+    """
+    Change how every logger writes, already created loggers included
+    Args:
+        level: default level name, like `GAY_LEVEL`
+        use_queue: write from the background `WRITER` thread, like `GAY_QUEUE` (on unless it's 0)
+        json_path: also write JSON lines to this file, like `GAY_JSON`
+        rate: records below WARNING let through per line of code every second, 0 for all of them,
+              like `GAY_RATE`
+    """
+    if level is not None:
+        SETTINGS["level"] = level
+    if use_queue is not None:
+        SETTINGS["queue"] = use_queue
+    if json_path is not None:
+        SETTINGS["json"] = json_path
+    if rate is not None:
+        SETTINGS["rate"] = RATE_LIMIT.per_second = rate
+    WRITER.flush()
+    for name in LOGGERS:
+        attach(name)
+
+
+def flush(timeout: float = 1.0):
+    """
+    Write out queued records, call it before the process dies without running `atexit`
+    """
+    WRITER.flush(timeout)
+
+
+def get_logger(
+    name: str,
+    level: int = logging.NOTSET,
+    split: str = "=",
+    show_func: bool = False,
+    emphasize_from: int = logging.ERROR,
+) -> logging.Logger:
+    """
+    Notes:
+        calling it again for a name replaces the handlers of the first call instead of adding more
+        where records go is set by the `GAY_*` environment variables or `configure`
+    """
+    LOGGERS[name] = (level, split, show_func, emphasize_from)
+    attach(name)
+    return logging.getLogger(name)
@@ -0,0 +1,247 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from itertools import count
+from typing import Callable, Deque, Dict, List, Optional
+
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.metrics import MATCHMAKING_SECONDS
+from tic_tac_toe.messages import Difficulty, GameType
+from tic_tac_toe.models import GameServerData, GameSession, User
+
+
+class Ticket:
+    """
+    A player's place in matchmaking
+    Notes:
+        `game` resolves once a seat is reserved for the user
+        `ready` resolves once every seat of that game is taken
+    """
+
+    numbers = count()
+
+    def __init__(self, user: User, game_type: GameType, difficulty: Optional[Difficulty] = None):
+        self.number = next(self.numbers)
+        self.joined = time.monotonic()
+        self.user = user
+        self.game_type = game_type
+        self.difficulty = difficulty
+        self.game: "Future[GameSession]" = Future()
+        self.ready: "Future[GameSession]" = Future()
+
+
+class Matchmaker:
+    """
+    Keeps two free lists, `half_full` games have a player waiting for an opponent
+    and are matched oldest first, `free` game servers have at least one free slot
+    and are reused most recently freed first, players that can't be seated
+    wait in a FIFO queue per game type
+    Notes:
+        `listeners` are called outside the lock after servers, games or players change
+        only servers in `servers` get slots back on the free list, a game released
+        after its server was suspended, retired or removed doesn't bring it back
+    """
+
+    logger = get_logger("matchmaker", split=" ")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.game_ids = count(1)
+        self.half_full: "OrderedDict[int, GameSession]" = OrderedDict()
+        self.free: Dict[int, GameServerData] = {}
+        self.servers: Dict[int, GameServerData] = {}
+        self.waiting: Dict[GameType, Deque[Ticket]] = {
+            GameType.SINGLE_PLAYER: deque(),
+            GameType.MULTI_PLAYER: deque(),
+        }
+        self.pending: Dict[int, Ticket] = {}
+        self.listeners: List[Callable[[], None]] = []
+
+    def changed(self):
+        for listener in self.listeners:
+            listener()
+
+    def add_server(self, server: GameServerData):
+        with self.lock:
+            self.servers[id(server)] = server
+            if server.free_slots > 0:
+                self.free[id(server)] = server
+            self.dispatch()
+        self.changed()
+
+    def retire(self, server: GameServerData) -> bool:
+        """
+        Stop seating players on `server` if it hosts no game
+        """
+        with self.lock:
+            if server.games:
+                return False
+            self.servers.pop(id(server), None)
+            self.free.pop(id(server), None)
+            return True
+
+    def suspend(self, server: GameServerData):
+        """
+        Seat nobody on `server` until it's added again, its games still missing a player are cancelled
+        """
+        with self.lock:
+            self.servers.pop(id(server), None)
+            self.free.pop(id(server), None)
+            tickets = []
+            for game_id in list(server.games):
+                if self.half_full.pop(game_id, None) is None:
+                    continue
+                del server.games[game_id]
+                ticket = self.pending.pop(game_id, None)
+                if ticket is not None:
+                    tickets.append(ticket)
+        for ticket in tickets:
+            ticket.ready.cancel()
+        self.changed()
+
+    def remove_server(self, server: GameServerData):
+        with self.lock:
+            self.servers.pop(id(server), None)
+            self.free.pop(id(server), None)
+            tickets = []
+            for game_id in list(server.games):
+                self.half_full.pop(game_id, None)
+                ticket = self.pending.pop(game_id, None)
+                if ticket is not None:
+                    tickets.append(ticket)
+        for ticket in tickets:
+            ticket.ready.cancel()
+        self.changed()
+
+    def release(self, game: GameSession) -> bool:
+        """
+        `game` ended, its slot can host a new one
+        Returns:
+            False when it was already released
+        """
+        with self.lock:
+            hosted = game.server.games.pop(game.game_id, None) is not None
+            self.half_full.pop(game.game_id, None)
+            self.pending.pop(game.game_id, None)
+            self.free_slot(game.server)
+            self.dispatch()
+        self.changed()
+        return hosted
+
+    def free_slot(self, server: GameServerData):
+        """
+        A game of `server` ended, caller holds the lock
+        """
+        if id(server) in self.servers:
+            self.free[id(server)] = server
+
+    def join(self, user: User, game_type: GameType, difficulty: Optional[Difficulty] = None) -> Ticket:
+        ticket = Ticket(user, game_type, difficulty)
+        with self.lock:
+            if not self.seat(ticket):
+                self.logger.info("%s waits for a free slot", user.username)
+                self.waiting[game_type].append(ticket)
+        self.changed()
+        return ticket
+
+    def cancel(self, ticket: Ticket) -> bool:
+        """
+        Take the player of `ticket` out of matchmaking, its futures are cancelled
+        Returns:
+            False when its game already has every player, it has to be released instead
+        """
+        with self.lock:
+            game = ticket.game.result() if ticket.game.done() and not ticket.game.cancelled() else None
+            if game is None:
+                queue = self.waiting[ticket.game_type]
+                if ticket not in queue:
+                    return False
+                queue.remove(ticket)
+            elif self.pending.get(game.game_id) is ticket:
+                del self.pending[game.game_id]
+                self.half_full.pop(game.game_id, None)
+                game.server.games.pop(game.game_id, None)
+                self.free_slot(game.server)
+                self.dispatch()
+            else:
+                return False
+        self.logger.info("%s left matchmaking", ticket.user.username)
+        ticket.game.cancel()
+        ticket.ready.cancel()
+        self.changed()
+        return True
+
+    def confirm(self, game: GameSession) -> bool:
+        """
+        A player accepted the game, returns True for the last one
+        so the game is started exactly once, never for a released game
+        """
+        with self.lock:
+            if game.server.games.get(game.game_id) is not game:
+                return False
+            game.confirmed += 1
+            return game.confirmed == sum(not user.is_bot for user in game.users)
+
+    def seat(self, ticket: Ticket) -> bool:
+        game = self.take(ticket.game_type)
+        if game is None:
+            return False
+        if ticket.game_type == GameType.SINGLE_PLAYER:
+            game.difficulty = ticket.difficulty
+        game.users.append(ticket.user)
+        ticket.game.set_result(game)
+        if game.number_of_users == 2:
+            now = time.monotonic()
+            opponent = self.pending.pop(game.game_id, None)
+            if opponent is not None:
+                MATCHMAKING_SECONDS.observe(now - opponent.joined)
+                opponent.ready.set_result(game)
+            MATCHMAKING_SECONDS.observe(now - ticket.joined)
+            ticket.ready.set_result(game)
+        else:
+            self.pending[game.game_id] = ticket
+        return True
+
+    def take(self, game_type: GameType) -> Optional[GameSession]:
+        if game_type == GameType.MULTI_PLAYER and self.half_full:
+            _, game = self.half_full.popitem(last=False)
+            game.number_of_users += 1
+            return game
+        game = self.new_game()
+        if game is None:
+            return None
+        if game_type == GameType.MULTI_PLAYER:
+            game.number_of_users += 1
+            self.half_full[game.game_id] = game
+        else:
+            game.number_of_users += 2
+            game.users.append(User(None, None, "BOT", is_bot=True))
+        return game
+
+    def new_game(self) -> Optional[GameSession]:
+        if not self.free:
+            return None
+        server_id, server = self.free.popitem()
+        game = GameSession(next(self.game_ids), server)
+        game.link = server.link_for(game.game_id)
+        server.games[game.game_id] = game
+        if server.free_slots > 0:
+            self.free[server_id] = server
+        return game
+
+    def dispatch(self):
+        """
+        Seat waiting players in arrival order, multiplayer ones fill half full games first
+        """
+        multi_player = self.waiting[GameType.MULTI_PLAYER]
+        single_player = self.waiting[GameType.SINGLE_PLAYER]
+        while multi_player and self.half_full:
+            self.seat(multi_player.popleft())
+        while self.free and (multi_player or single_player):
+            if not single_player or (multi_player and multi_player[0].number < single_player[0].number):
+                self.seat(multi_player.popleft())
+            else:
+                self.seat(single_player.popleft())
+            while multi_player and self.half_full:
+                self.seat(multi_player.popleft())
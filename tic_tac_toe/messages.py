@@ -1,7 +1,5 @@
-import uuid
 from dataclasses import dataclass
 from enum import IntEnum
-import json
 from dataclasses import field
 from itertools import count
 from typing import List, Optional
@@ -28,6 +26,15 @@ class MessageType(IntEnum):
     YOU_CAN_MOVE = 12
     RECONNECTED = 13
     EXIT = 14
+    HEARTBEAT = 15
+
+
+class WireFormat(IntEnum):
+    # JSON without the fields added since, for peers whose handshake has no `wire_formats`, never negotiated
+    LEGACY_JSON = 0
+    JSON = 1
+    BINARY = 2
+    MSGPACK = 3
 
 
 class GameType(IntEnum):
@@ -35,39 +42,90 @@ class GameType(IntEnum):
     MULTI_PLAYER = 2
 
 
+class Difficulty(IntEnum):
+    EASY = 1
+    MEDIUM = 2
+    PERFECT = 3
+
+
 class Message:
-    def __init__(self, message_type: MessageType, message_id: str = None):
-        if message_id is None:
-            message_id = str(uuid.uuid1())
+    """
+    Notes:
+        message_id is None until the message is sent, `SocketHandler` stamps it
+        from a per-connection counter and accs carry the id they acknowledge
+        `ack` asks the receiver for an acc, `SocketHandler` clears it when
+        the sender doesn't wait for one, messages from peers that don't send it want one
+    """
+
+    __slots__ = ("message_id", "message_type", "ack")
+
+    def __init__(self, message_type: MessageType, message_id: Optional[int] = None):
         self.message_id = message_id
         self.message_type = message_type
+        self.ack = True
 
 
 class HandShake(Message):
+    """
+    Notes:
+        game servers advertise how many games they can host at once in `capacity`
+        and their process id in `pid` so a pool knows which process connected
+        every link of a game server has the same `server_id`, a game server that
+        sets `heartbeat` (milliseconds) can send and answer `Heartbeat`
+        a game server with a journal sets `recovery`, the milliseconds its games
+        are kept after its last link is lost so a restart of it can resume them
+        a client reconnects as `username` only with the `token` the acc of its first handshake had
+    """
+
+    __slots__ = (
+        "username", "socket_type", "wire_formats", "capacity", "pid", "server_id", "heartbeat", "recovery",
+        "token",
+    )
+
     def __init__(
         self,
         socket_type: SocketType,
         username: Optional[str] = None,
         message_type: MessageType = MessageType.HAND_SHAKE,
         message_id: int = None,
+        wire_formats: Optional[List[WireFormat]] = None,
+        capacity: Optional[int] = None,
+        pid: Optional[int] = None,
+        server_id: Optional[str] = None,
+        heartbeat: Optional[int] = None,
+        recovery: Optional[int] = None,
+        token: Optional[str] = None,
     ):
         super().__init__(message_type, message_id)
         self.username = username
         self.socket_type = socket_type
+        self.wire_formats = wire_formats
+        self.capacity = capacity
+        self.pid = pid
+        self.server_id = server_id
+        self.heartbeat = heartbeat
+        self.recovery = recovery
+        self.token = token
 
 
 class RequestNewGame(Message):
+    __slots__ = ("game_type", "difficulty")
+
     def __init__(
         self,
         game_type: GameType,
         message_type: MessageType = MessageType.NEW_GAME_REQUEST,
         message_id: int = None,
+        difficulty: Optional[Difficulty] = None,
     ):
         super().__init__(message_type, message_id)
         self.game_type = game_type
+        self.difficulty = difficulty
 
 
 class GameFound(Message):
+    __slots__ = ("opponent",)
+
     def __init__(
         self,
         opponent: str,
@@ -78,16 +136,24 @@ class GameFound(Message):
         self.opponent = opponent
 
 class StartGame(Message):
+    __slots__ = ("opponents", "game_id", "difficulty")
+
     def __init__(
             self,
             opponents: List[str],
             message_type: MessageType = MessageType.GAME_START,
             message_id: int = None,
+            game_id: Optional[int] = None,
+            difficulty: Optional[Difficulty] = None,
     ):
         super().__init__(message_type, message_id)
         self.opponents = opponents
+        self.game_id = game_id
+        self.difficulty = difficulty
 
 class WaitForOpponent(Message):
+    __slots__ = ()
+
     def __init__(
             self,
             message_type: MessageType = MessageType.WAIT_FOR_OPPONENT,
@@ -97,100 +163,201 @@ class WaitForOpponent(Message):
 
 
 class MakeMove(Message):
+    __slots__ = ("pos", "game_id")
+
     def __init__(
         self,
             pos: int,
             message_type: MessageType = MessageType.MAKE_MOVE,
-            message_id: int = None
+            message_id: int = None,
+            game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
         self.pos = pos
+        self.game_id = game_id
 
 
 class StopProxy(Message):
+    __slots__ = ()
+
     def __init__(
         self, message_type: MessageType = MessageType.STOP_PROXY, message_id: int = None
     ):
         super().__init__(message_type, message_id)
 
 class YouCanMove(Message):
+    __slots__ = ("user", "game_id")
+
     def __init__(
-            self,user:str, message_type: MessageType = MessageType.YOU_CAN_MOVE, message_id: int = None
+            self,user:str, message_type: MessageType = MessageType.YOU_CAN_MOVE, message_id: int = None,
+            game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
         self.user = user
+        self.game_id = game_id
 
 class PlayerReconnected(Message):
+    __slots__ = ("user", "game_id")
+
     def __init__(
-            self,user:str, message_type: MessageType = MessageType.RECONNECTED, message_id: int = None
+            self,user:str, message_type: MessageType = MessageType.RECONNECTED, message_id: int = None,
+            game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
         self.user = user
+        self.game_id = game_id
 
 class Exit(Message):
+    __slots__ = ("user", "game_id")
+
     def __init__(
             self,
             user: str,
             message_type: MessageType = MessageType.EXIT,
-            message_id: int = None
+            message_id: int = None,
+            game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
         self.user = user
+        self.game_id = game_id
 
 class Result(Message):
+    """
+    Board is packed in `cells`, bit i is set when cell i belongs to players[0]
+    and bit i + 9 when it belongs to players[1]
+    """
+
+    __slots__ = ("cells", "players", "winner", "game_id")
+
     def __init__(
         self,
-        game_state: List[Optional[str]],
+        cells: int,
+        players: List[str],
         winner: Optional[str],
         message_type: MessageType = MessageType.RESULT,
-        message_id: int = None
+        message_id: int = None,
+        game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
-        self.game_state = game_state
+        self.cells = cells
+        self.players = players
         self.winner = winner
+        self.game_id = game_id
+
+    @classmethod
+    def pack(
+            cls,
+            game_state: List[Optional[str]],
+            players: List[str],
+            winner: Optional[str],
+            game_id: Optional[int] = None,
+    ) -> "Result":
+        cells = 0
+        for i, cell in enumerate(game_state):
+            if cell is None:
+                continue
+            cells |= 1 << (i if cell == players[0] else i + 9)
+        return cls(cells, list(players), winner, game_id=game_id)
+
+    @property
+    def game_state(self) -> List[Optional[str]]:
+        return [
+            self.players[0] if self.cells >> i & 1 else
+            self.players[1] if self.cells >> (i + 9) & 1 else None
+            for i in range(9)
+        ]
 
 class GameEnded(Message):
+    __slots__ = ("winner", "game_id")
+
     def __init__(
             self,
             winner: str,
             message_type: MessageType = MessageType.GAME_ENDED,
-            message_id: int = None
+            message_id: int = None,
+            game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
         self.winner = winner
+        self.game_id = game_id
 
 class Codes:
     OK = 0, "OK"
     WAIT_FOR_EMPTY_SERVER = 1, "wait for empty server"
     INVALID_MOVE = 3, "cell is invalid"
     IN_GAME = 4, "You were in game"
+    RECOVERED = 5, "Your games were kept"
+    NO_GAME_IDS = 6, "Game servers must advertise capacity and tag messages with game_id"
+    INVALID_GAME_REQUEST = 7, "unknown game type or difficulty"
 
 class Acc(Message):
+    """
+    Notes:
+        a batched acc also acknowledges every id in `message_ids` with the same result
+        the acc of a game server handshake sets `heartbeat` (milliseconds) when
+        the web server accepts heartbeats and more than one link
+        the acc of a client handshake has the `token` to reconnect with and the `username` it got,
+        clients whose handshake has no `wire_formats` only get the username in `text`
+    """
+
+    __slots__ = ("result", "text", "wire_format", "message_ids", "heartbeat", "token", "username")
+
     def __init__(
         self,
         result: int,
         text: str,
         message_type: MessageType = MessageType.ACC,
         message_id: int = None,
+        wire_format: Optional[WireFormat] = None,
+        message_ids: Optional[List[int]] = None,
+        heartbeat: Optional[int] = None,
+        token: Optional[str] = None,
+        username: Optional[str] = None,
     ):
         super().__init__(message_type, message_id)
         self.result = result
         self.text = text
+        self.wire_format = wire_format
+        self.message_ids = message_ids
+        self.heartbeat = heartbeat
+        self.token = token
+        self.username = username
     def in_game(self) -> bool:
         return self.result == Codes.IN_GAME[0]
     def is_ok(self) -> bool:
         return self.result == Codes.OK[0]
+    def recovered(self) -> bool:
+        return self.result == Codes.RECOVERED[0]
 class SendMessage(Message):
+    __slots__ = ("text", "target", "game_id")
+
     def __init__(
         self,
         text: str,
         target: str,
         message_type: MessageType = MessageType.SEND_MESSAGE,
         message_id: int = None,
+        game_id: Optional[int] = None,
     ):
         super().__init__(message_type, message_id)
         self.text = text
         self.target = target
+        self.game_id = game_id
+
+
+class Heartbeat(Message):
+    """
+    Keeps an idle link between the web server and a game server alive, never acked
+    """
+
+    __slots__ = ()
+
+    def __init__(
+        self,
+        message_type: MessageType = MessageType.HEARTBEAT,
+        message_id: int = None,
+    ):
+        super().__init__(message_type, message_id)
 
 
 messages_types = {
@@ -208,13 +375,5 @@ messages_types = {
     MessageType.SEND_MESSAGE: SendMessage,
     MessageType.RECONNECTED: PlayerReconnected,
     MessageType.EXIT: Exit,
+    MessageType.HEARTBEAT: Heartbeat,
 }
-
-
-def serialize(msg: Message) -> bytes:
-    return json.dumps(msg, default=lambda x: x.__dict__).encode()
-
-
-def get_message(data: bytes) -> Message:
-    json_data = json.loads(data)
-    return messages_types[json_data["message_type"]](**json_data)
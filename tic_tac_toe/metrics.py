@@ -0,0 +1,254 @@
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from tic_tac_toe.logger import get_logger
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def label_value(key: Hashable) -> str:
+    """
+    Enum members like `MessageType` are labelled by name
+    """
+    return str(getattr(key, "name", key))
+
+
+def format_sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        name += "{" + ",".join(f'{label}="{text}"' for label, text in labels.items()) + "}"
+    if float(value).is_integer():
+        return f"{name} {int(value)}"
+    return f"{name} {float(value)!r}"
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, registry: "Registry", name: str, description: str, label: Optional[str] = None):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.label = label
+        self.lock = threading.Lock()
+
+    def labels(self, key: Hashable) -> Dict[str, str]:
+        return {self.label: label_value(key)} if self.label is not None and key is not None else {}
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]:
+        pass
+
+
+class Counter(Metric):
+    """
+    Totals that only go up, split by `label` when it's set
+    """
+
+    kind = "counter"
+
+    def __init__(self, registry: "Registry", name: str, description: str, label: Optional[str] = None):
+        super().__init__(registry, name, description, label)
+        self.values: Dict[Hashable, float] = {}
+
+    def inc(self, key: Hashable = None, amount: float = 1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Sample]:
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, self.labels(key), value
+
+
+class Gauge(Metric):
+    """
+    Current value of something, read from `function` on every render when it's given
+    Notes:
+        `function` returns a number, or values by label key when `label` is set
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        registry: "Registry",
+        name: str,
+        description: str,
+        label: Optional[str] = None,
+        function: Optional[Callable[[], Union[float, Dict[Hashable, float]]]] = None,
+    ):
+        super().__init__(registry, name, description, label)
+        self.function = function
+        self.values: Dict[Hashable, float] = {}
+
+    def set(self, value: float, key: Hashable = None):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> Iterator[Sample]:
+        if self.function is None:
+            with self.lock:
+                values = dict(self.values)
+        else:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {None: values}
+        for key, value in values.items():
+            yield self.name, self.labels(key), value
+
+
+class Histogram(Metric):
+    """
+    Distribution of durations in seconds over `buckets`, rendered cumulatively like Prometheus does
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, registry: "Registry", name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(registry, name, description)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> Iterator[Sample]:
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield f"{self.name}_bucket", {"le": "+Inf" if bound == float("inf") else repr(bound)}, cumulative
+        yield f"{self.name}_sum", {}, total
+        yield f"{self.name}_count", {}, cumulative
+
+
+class Registry:
+    """
+    Every metric of the process, rendered in the Prometheus text format
+    Notes:
+        collection is off until `enable`, until then `inc`, `set` and `observe`
+        return right away so an instrumented hot path pays a method call,
+        callback gauges are only evaluated by `render`
+        registering a name again replaces the old metric, so a new web server
+        in the same process owns the gauges that read its state
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.metrics: Dict[str, Metric] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, label: Optional[str] = None) -> Counter:
+        return self.register(Counter(self, name, description, label))
+
+    def gauge(
+        self,
+        name: str,
+        description: str,
+        label: Optional[str] = None,
+        function: Optional[Callable[[], Union[float, Dict[Hashable, float]]]] = None,
+    ) -> Gauge:
+        return self.register(Gauge(self, name, description, label, function))
+
+    def histogram(self, name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(self, name, description, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(format_sample(*sample) for sample in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES_RECEIVED = REGISTRY.counter("ttt_messages_received_total", "Messages received by type", "type")
+MESSAGES_SENT = REGISTRY.counter("ttt_messages_sent_total", "Messages sent by type", "type")
+BYTES_RECEIVED = REGISTRY.counter("ttt_received_bytes_total", "Bytes read from sockets")
+BYTES_SENT = REGISTRY.counter("ttt_sent_bytes_total", "Bytes written to sockets")
+ACK_SECONDS = REGISTRY.histogram("ttt_ack_round_trip_seconds", "Message sent until its acc arrived")
+MATCHMAKING_SECONDS = REGISTRY.histogram(
+    "ttt_matchmaking_wait_seconds", "Player joined matchmaking until every seat of its game was taken"
+)
+SESSION_RESUMES = REGISTRY.counter(
+    "ttt_session_resumes_total", "Client reconnects by how they were served", "outcome"
+)
+MOVE_SECONDS = REGISTRY.histogram(
+    "ttt_move_result_seconds", "Client move relayed until the game server's result came back"
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    logger = get_logger("metrics", split=" ")
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def serve_metrics(host: str, port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Enable `registry` and serve it on http://`host`:`port`/metrics from a daemon thread
+    """
+    registry.enable()
+    handler = type("RegistryHandler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    MetricsHandler.logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
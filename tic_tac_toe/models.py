@@ -1,22 +1,76 @@
 from dataclasses import dataclass, field
+import secrets
 import socket
-from typing import Optional, List
+import threading
+from typing import Optional, List, Dict
 
 import names
 
+from tic_tac_toe.codec import SharedFrame
 from tic_tac_toe.socket_handler import SocketHandler
 
 
 @dataclass
 class GameServerData:
-    socket_handler: SocketHandler
-    number_of_users: int
+    """
+    A game server and every link the web server has to it
+    Notes:
+        `lost_at` is set while the games of a server with `recovery` wait for it to come back
+    """
+
+    links: List[SocketHandler]
+    capacity: int
+    games: Dict[int, "GameSession"] = field(default_factory=dict)
+    server_id: Optional[str] = None
+    recovery: Optional[int] = None
+    lost_at: Optional[float] = None
+
+    @property
+    def free_slots(self) -> int:
+        return self.capacity - len(self.games)
+
+    def link_for(self, game_id: int) -> Optional[SocketHandler]:
+        links = self.links
+        return links[game_id % len(links)] if links else None
+
+
+@dataclass
+class GameSession:
+    """
+    Notes:
+        `result` is the last `Result` of the game and `turn` the `YouCanMove` relayed
+        after it, both already encoded so a reconnecting user gets them without the game server
+    """
+
+    game_id: int
+    server: GameServerData
+    number_of_users: int = 0
     users: List["User"] = field(default_factory=list)
+    confirmed: int = 0
+    difficulty: Optional[int] = None
+    link: Optional[SocketHandler] = None
+    moved_at: Optional[float] = None
+    result: Optional[SharedFrame] = None
+    turn: Optional[SharedFrame] = None
+
+
+@dataclass
+class Session:
+    """
+    Notes:
+        `nonce` is signed into the resume token of the user, `lock` keeps relaying
+        messages to the user from racing its socket being swapped on reconnect
+    """
+
+    nonce: str = field(default_factory=lambda: secrets.token_hex(8))
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
 
 @dataclass
 class User:
     socket_handler: SocketHandler
-    game_server: Optional[GameServerData]
+    game: Optional[GameSession]
     username: str = field(default_factory=names.get_last_name)
     is_bot: bool = False
+    online: bool = True
+    session: Session = field(default_factory=Session)
@@ -0,0 +1,182 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from tic_tac_toe.game_server import GameServer
+from tic_tac_toe.journal import remove_journal
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.models import GameServerData
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass
+class PooledServer:
+    process: subprocess.Popen
+    started: float
+    server: Optional[GameServerData] = None
+    idle_since: Optional[float] = None
+    retiring: Optional[float] = None
+    journal: Optional[str] = None
+
+
+class GameServerPool:
+    """
+    Spawns, health-checks and retires game server processes of a web server
+    Notes:
+        keeps `target_idle` servers worth of free slots as warm spares on top of
+        the players queued in matchmaking, with `minimum`..`maximum` processes
+        a server without games for `retire_after` seconds is retired when the
+        others still have enough spare slots
+        a process that exits, doesn't connect within `START_TIMEOUT` or doesn't
+        exit `STOP_TIMEOUT` seconds after being retired is killed and replaced
+        servers started by hand count as spare slots but are never retired
+        with a `journal_dir` every process keeps its games in a journal there,
+        one that exits on its own is restarted on its journal right away so it
+        resumes its games, the journal of a retired one is removed
+        with an `archive_dir` every process archives its finished games there
+    """
+
+    logger = get_logger("game-server-pool", split=" ")
+    INTERVAL = 0.5
+    START_TIMEOUT = 10.0
+    STOP_TIMEOUT = 5.0
+    RETIRE_AFTER = 30.0
+    CAPACITY = GameServer.CAPACITY
+
+    def __init__(
+        self,
+        web_server,
+        minimum: int = 1,
+        maximum: int = 8,
+        target_idle: int = 1,
+        capacity: int = CAPACITY,
+        retire_after: float = RETIRE_AFTER,
+        journal_dir: Optional[str] = None,
+        archive_dir: Optional[str] = None,
+    ):
+        self.web_server = web_server
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_idle = target_idle
+        self.capacity = capacity
+        self.retire_after = retire_after
+        self.journal_dir = journal_dir
+        self.archive_dir = archive_dir
+        self.lock = threading.Lock()
+        self.processes: Dict[int, PooledServer] = {}
+        self.on_spawn: Optional[Callable[[int], None]] = None
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        web_server.matchmaker.listeners.append(self.wakeup.set)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.check()
+            self.wakeup.wait(self.INTERVAL)
+            self.wakeup.clear()
+
+    def spawn(self, journal: Optional[str] = None):
+        command = [
+            sys.executable, "-m", "tic_tac_toe.game_server",
+            "--host", self.web_server.HOST,
+            "--port", str(self.web_server.PORT),
+            "--capacity", str(self.capacity),
+        ]
+        if journal is None and self.journal_dir is not None:
+            journal = os.path.join(self.journal_dir, f"{uuid.uuid4().hex}.journal")
+        if journal is not None:
+            command += ["--journal", journal]
+        if self.archive_dir is not None:
+            command += ["--archive", self.archive_dir]
+        process = subprocess.Popen(command, cwd=ROOT)
+        self.logger.info("Spawned game server %d", process.pid)
+        self.processes[process.pid] = PooledServer(process, time.monotonic(), journal=journal)
+        if self.on_spawn is not None:
+            self.on_spawn(process.pid)
+
+    def attach(self, server: GameServerData, pid: Optional[int]):
+        with self.lock:
+            pooled = self.processes.get(pid)
+            if pooled is not None and pooled.server is None:
+                pooled.server = server
+
+    def detach(self, server: GameServerData):
+        with self.lock:
+            for pooled in self.processes.values():
+                if pooled.server is server:
+                    pooled.server = None
+                    pooled.retiring = pooled.retiring or time.monotonic()
+        self.wakeup.set()
+
+    def reap(self, now: float):
+        for pid, pooled in list(self.processes.items()):
+            if pooled.process.poll() is not None:
+                del self.processes[pid]
+                if pooled.retiring is None:
+                    self.logger.error("Game server %d exited with %s", pid, pooled.process.returncode)
+                    if pooled.journal is not None:
+                        self.spawn(pooled.journal)
+                elif pooled.journal is not None:
+                    remove_journal(pooled.journal)
+            elif pooled.retiring is not None:
+                if now - pooled.retiring > self.STOP_TIMEOUT:
+                    self.logger.error("Game server %d didn't stop, killing it", pid)
+                    pooled.process.kill()
+            elif pooled.server is None and now - pooled.started > self.START_TIMEOUT:
+                self.logger.error("Game server %d didn't connect, killing it", pid)
+                pooled.process.kill()
+                pooled.retiring = now
+            elif pooled.server is not None and pooled.server.games:
+                pooled.idle_since = None
+            elif pooled.server is not None and pooled.idle_since is None:
+                pooled.idle_since = now
+
+    def check(self):
+        now = time.monotonic()
+        matchmaker = self.web_server.matchmaker
+        with self.lock:
+            self.reap(now)
+            live = [pooled for pooled in self.processes.values() if pooled.retiring is None]
+            with matchmaker.lock:
+                queued = sum(len(tickets) for tickets in matchmaker.waiting.values())
+                spare = sum(server.free_slots for server in matchmaker.free.values())
+            spare += self.capacity * sum(pooled.server is None for pooled in live)
+            wanted = self.target_idle * self.capacity + queued
+            missing = max(
+                min(-((spare - wanted) // self.capacity), self.maximum - len(self.processes)),
+                self.minimum - len(live),
+            )
+            for _ in range(missing):
+                self.spawn()
+            if missing > 0:
+                return
+            idle = sorted(
+                (pooled for pooled in live if pooled.idle_since is not None),
+                key=lambda pooled: pooled.idle_since,
+            )
+            for pooled in idle:
+                if len(live) <= self.minimum or spare - pooled.server.capacity < wanted:
+                    return
+                if now - pooled.idle_since < self.retire_after or not matchmaker.retire(pooled.server):
+                    continue
+                self.logger.info("Retire game server %d", pooled.process.pid)
+                pooled.retiring = now
+                spare -= pooled.server.capacity
+                live.remove(pooled)
+                self.web_server.close_game_server(pooled.server)
+
+    def stop(self):
+        with self.lock:
+            for pooled in self.processes.values():
+                pooled.process.terminate()
+                if pooled.journal is not None:
+                    remove_journal(pooled.journal)
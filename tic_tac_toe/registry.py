@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Callable, Dict, Optional
+
+from tic_tac_toe.logger import get_logger
+from tic_tac_toe.models import User
+from tic_tac_toe.socket_handler import SocketHandler
+
+
+class UserRegistry:
+    """
+    Users indexed by username and by the connection they're using
+    Notes:
+        disconnected users stay in `offline` in disconnect order so they can reconnect,
+        they're forgotten `ttl` seconds later unless they're still in a game
+        every lookup is O(1), eviction is amortized O(1) per disconnect
+        `on_forget` is called with every evicted user while the lock is held
+        a new user whose username is taken gets a numeric suffix, so does one that
+        picked a `RESERVED` name, games tell the bot and a tie apart from players by them
+    """
+
+    logger = get_logger("user-registry", split=" ")
+    RESERVED = frozenset({"BOT", "TIE"})
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.by_name: Dict[str, User] = {}
+        self.by_connection: Dict[int, User] = {}
+        self.offline: "OrderedDict[str, float]" = OrderedDict()
+        self.on_forget: Optional[Callable[[User], None]] = None
+        self.suffixes = count(2)
+
+    def __len__(self) -> int:
+        return len(self.by_name)
+
+    @property
+    def online(self) -> int:
+        return len(self.by_name) - len(self.offline)
+
+    def get(self, username: str) -> Optional[User]:
+        return self.by_name.get(username)
+
+    def add(self, user: User):
+        with self.lock:
+            self.evict()
+            while user.username in self.by_name or user.username in self.RESERVED:
+                user.username = f"{user.username.rstrip('0123456789')}{next(self.suffixes)}"
+            self.by_name[user.username] = user
+            self.by_connection[id(user.socket_handler)] = user
+            self.offline.pop(user.username, None)
+            user.online = True
+
+    def connect(self, user: User, socket_handler: SocketHandler) -> bool:
+        """
+        Move a known user to its new connection, False when it was forgotten meanwhile
+        """
+        with self.lock:
+            self.evict()
+            if self.by_name.get(user.username) is not user:
+                return False
+            self.by_connection.pop(id(user.socket_handler), None)
+            user.socket_handler = socket_handler
+            self.by_connection[id(socket_handler)] = user
+            self.offline.pop(user.username, None)
+            user.online = True
+            return True
+
+    def disconnect(self, socket_handler: SocketHandler) -> Optional[User]:
+        """
+        The user of `socket_handler` went offline, does nothing if it already reconnected
+        """
+        with self.lock:
+            user = self.by_connection.pop(id(socket_handler), None)
+            if user is not None:
+                user.online = False
+                self.offline[user.username] = time.monotonic()
+            self.evict()
+            return user
+
+    def evict(self):
+        """
+        Forget users that have been offline for more than `ttl`, caller holds the lock
+        """
+        deadline = time.monotonic() - self.ttl
+        while self.offline:
+            username, since = next(iter(self.offline.items()))
+            if since > deadline:
+                return
+            del self.offline[username]
+            user = self.by_name[username]
+            if user.game is not None:
+                self.offline[username] = time.monotonic()
+                continue
+            del self.by_name[username]
+            self.logger.info("Forget %s", username)
+            if self.on_forget is not None:
+                self.on_forget(user)
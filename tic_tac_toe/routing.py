@@ -0,0 +1,46 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+from tic_tac_toe.models import GameSession, User
+from tic_tac_toe.socket_handler import SocketHandler
+
+
+class Router:
+    """
+    Where to relay game messages to
+    Notes:
+        `routes` maps (game_id, username) to the player's live socket handler and
+        `opponents` maps a username to its opponent, game ids are unique per
+        web server so they also identify the game server
+        every update holds `lock` so a relay never sees half of a game
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes: Dict[Tuple[int, str], SocketHandler] = {}
+        self.opponents: Dict[str, User] = {}
+
+    def join(self, game: GameSession):
+        first, second = game.users
+        with self.lock:
+            for user, opponent in ((first, second), (second, first)):
+                if not user.is_bot:
+                    self.routes[game.game_id, user.username] = user.socket_handler
+                    self.opponents[user.username] = opponent
+
+    def leave(self, game: GameSession):
+        with self.lock:
+            for user in game.users:
+                if self.routes.pop((game.game_id, user.username), None) is not None:
+                    self.opponents.pop(user.username, None)
+
+    def reconnect(self, user: User):
+        with self.lock:
+            if user.game is not None and (user.game.game_id, user.username) in self.routes:
+                self.routes[user.game.game_id, user.username] = user.socket_handler
+
+    def route(self, game_id: int, username: str) -> Optional[SocketHandler]:
+        return self.routes.get((game_id, username))
+
+    def opponent(self, user: User) -> Optional[User]:
+        return self.opponents.get(user.username)
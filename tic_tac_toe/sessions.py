@@ -0,0 +1,52 @@
+import hashlib
+import hmac
+import os
+from typing import Optional, Tuple
+
+
+class SessionTokens:
+    """
+    Resume tokens of users, `username`.`nonce`.`mac` where `mac` is an HMAC-SHA256
+    of the first two parts under `key`
+    Notes:
+        checking a token is one HMAC and a constant time compare, no lookup,
+        the caller then finds the user with one dict get and compares its nonce
+        a user gets a new nonce when it's registered so a token dies with its user,
+        even when someone registers the same username later
+        every shard of a coordinator must use the same `key`, by default it's
+        random so tokens don't survive a restart of the web server
+    """
+
+    MAC_SIZE = 32
+
+    def __init__(self, key: Optional[bytes] = None):
+        self.key = key or os.urandom(32)
+
+    def mac(self, username: str, nonce: str) -> str:
+        return hmac.new(self.key, f"{username}.{nonce}".encode(), hashlib.sha256).hexdigest()[:self.MAC_SIZE]
+
+    def issue(self, username: str, nonce: str) -> str:
+        return f"{username}.{nonce}.{self.mac(username, nonce)}"
+
+    @staticmethod
+    def nonce(token: Optional[str]) -> Optional[str]:
+        """
+        Nonce of what looks like a token, not verified
+        """
+        parts = token.rsplit(".", 2) if token else ()
+        return parts[1] if len(parts) == 3 else None
+
+    def verify(self, token: Optional[str]) -> Optional[Tuple[str, str]]:
+        """
+        Returns:
+            username and nonce of a token we issued, None for anything else
+        """
+        if not token:
+            return None
+        parts = token.rsplit(".", 2)
+        if len(parts) != 3:
+            return None
+        username, nonce, mac = parts
+        if not hmac.compare_digest(self.mac(username, nonce), mac):
+            return None
+        return username, nonce
@@ -0,0 +1,385 @@
+import array
+import asyncio
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from tic_tac_toe.async_web_server import AsyncWebServer
+from tic_tac_toe.codec import FrameError, decode_frames
+from tic_tac_toe.defensive import defensive
+from tic_tac_toe.logger import flush, get_logger
+from tic_tac_toe.messages import HandShake, SocketType
+from tic_tac_toe.metrics import serve_metrics
+from tic_tac_toe.models import User
+from tic_tac_toe.pool import GameServerPool
+from tic_tac_toe.sessions import SessionTokens
+from tic_tac_toe.socket_handler import SocketHandler
+from tic_tac_toe.web_server import WebServer
+
+MAX_PACKET = 4096
+PEEK_SIZE = 1024
+
+
+def send_packet(channel: socket.socket, packet: Dict, conn: Optional[socket.socket] = None):
+    """
+    Send `packet` as one SOCK_SEQPACKET message, the fd of `conn` travels with it
+    """
+    fds = []
+    if conn is not None:
+        fds.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [conn.fileno()])))
+    channel.sendmsg([json.dumps(packet).encode()], fds)
+
+
+def recv_packet(channel: socket.socket) -> Tuple[Optional[Dict], Optional[socket.socket]]:
+    """
+    Returns:
+        the packet and the connection sent with it, no packet once the other side is gone
+    """
+    fds = array.array("i")
+    data, ancdata, _, _ = channel.recvmsg(MAX_PACKET, socket.CMSG_SPACE(fds.itemsize))
+    if not data:
+        return None, None
+    conn = None
+    for level, kind, fd_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+            conn = socket.socket(fileno=fds[0])
+    return json.loads(data), conn
+
+
+def peek_handshake(conn: socket.socket, timeout: float) -> Optional[HandShake]:
+    """
+    The handshake `conn` starts with, its bytes are left unread for whoever serves the connection
+    Notes:
+        a peek returns at once while any byte is buffered so SO_RCVLOWAT is raised past
+        what was seen, the wait for the rest of a split handshake then blocks until it comes
+    """
+    deadline = time.monotonic() + timeout
+    size, seen = PEEK_SIZE, 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            conn.settimeout(remaining)
+            data = conn.recv(size, socket.MSG_PEEK)
+            if len(data) <= seen:
+                # the peer closed before the handshake was complete
+                return None
+            try:
+                frames, _ = decode_frames(data)
+            except FrameError:
+                return None
+            if frames:
+                return frames[0] if isinstance(frames[0], HandShake) else None
+            seen = len(data)
+            if seen == size:
+                size *= 2
+            else:
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, seen + 1)
+    except socket.timeout:
+        return None
+    finally:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, 1)
+        conn.setblocking(True)
+
+
+class Shard:
+    """
+    One of the web server processes accepting on the same port with SO_REUSEPORT
+    Notes:
+        the handshake of every accepted connection is peeked and the connection's fd
+        is handed to the coordinator, which sends it to the shard that should serve it,
+        every game lives in a single shard so relays never cross processes
+        shards report their users and free slots to the coordinator as they change
+        every shard signs resume tokens with the coordinator's `session_key` so
+        a token is good wherever its user lives
+    """
+
+    logger = get_logger("shard", split=" ")
+    REUSE_PORT = True
+    PEEK_TIMEOUT = 5.0
+
+    def __init__(
+        self,
+        index: int,
+        path: str,
+        user_ttl: float = WebServer.USER_TTL,
+        pool: Optional[Tuple] = None,
+        session_key: Optional[bytes] = None,
+    ):
+        super().__init__(user_ttl, session_key)  # type: ignore
+        self.index = index
+        self.path = path
+        self.channel: Optional[socket.socket] = None
+        self.matchmaker.listeners.append(self.report)
+        self.users.on_forget = self.forget
+        if pool is not None:
+            self.pool = GameServerPool(self, *pool)
+            self.pool.on_spawn = self.spawned
+
+    def send(self, packet: Dict, conn: Optional[socket.socket] = None):
+        send_packet(self.channel, packet, conn)
+
+    def connect(self):
+        self.channel = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.channel.connect(self.path)
+        self.send({"op": "hello", "shard": self.index})
+        self.server_socket = self.listen()
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+        if self.pool is not None:
+            self.pool.start()
+
+    @defensive(logger.error)
+    def accept_connections(self):
+        while True:
+            conn, addr = self.server_socket.accept()
+            self.logger.info("Shard %d accepted %s", self.index, addr)
+            threading.Thread(target=self.route, args=(conn,), daemon=True).start()
+
+    def route(self, conn: socket.socket):
+        with conn:
+            try:
+                handshake = peek_handshake(conn, self.PEEK_TIMEOUT)
+            except OSError as e:
+                self.logger.warning("No handshake %s", e)
+                return
+            if handshake is None:
+                self.logger.warning("Connection closed or sent garbage before its handshake")
+                return
+            self.send({
+                "op": "route",
+                "kind": "game" if handshake.socket_type == SocketType.GAME else "client",
+                "username": handshake.username,
+                "nonce": SessionTokens.nonce(handshake.token),
+                "pid": handshake.pid,
+                "server_id": handshake.server_id,
+            }, conn)
+
+    def receive_connections(self):
+        while True:
+            packet, conn = recv_packet(self.channel)
+            if packet is None:
+                self.logger.error("Coordinator is gone, shard %d exits", self.index)
+                flush()
+                os._exit(1)
+            if conn is not None:
+                self.adopt(conn)
+
+    def report(self):
+        with self.servers_lock:
+            servers = list(self.game_servers)
+        with self.matchmaker.lock:
+            capacity = sum(server.capacity for server in servers)
+            free = sum(server.free_slots for server in servers)
+            waiting = len(self.matchmaker.half_full)
+        self.send({
+            "op": "state",
+            "capacity": capacity,
+            "free": free,
+            "waiting": waiting,
+            "online": self.users.online,
+            "known": len(self.users),
+        })
+
+    def spawned(self, pid: int):
+        self.send({"op": "spawn", "pid": pid})
+
+    def forget(self, user: User):
+        self.send({"op": "forget", "username": user.username, "nonce": user.session.nonce})
+
+    def add_client(self, socket_handler: SocketHandler, message: HandShake) -> Optional[User]:
+        user = super().add_client(socket_handler, message)  # type: ignore
+        if user is not None:
+            self.send({"op": "user", "username": user.username, "nonce": user.session.nonce})
+        return user
+
+
+class ShardWebServer(Shard, WebServer):
+    @defensive(Shard.logger.error)
+    def handle_sockets(self):
+        self.connect()
+        self.receive_connections()
+
+
+class AsyncShardWebServer(Shard, AsyncWebServer):
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.connect()
+        threading.Thread(target=self.receive_connections, daemon=True).start()
+        await self.loop.create_future()
+
+
+def run_shard(
+    index: int,
+    path: str,
+    port: int,
+    use_asyncio: bool,
+    user_ttl: float,
+    pool: Optional[Tuple],
+    metrics_port: Optional[int] = None,
+    session_key: Optional[bytes] = None,
+):
+    server_class = AsyncShardWebServer if use_asyncio else ShardWebServer
+    server_class.PORT = port
+    if metrics_port is not None:
+        serve_metrics(server_class.HOST, metrics_port + index)
+    server_class(index, path, user_ttl, pool, session_key).handle_sockets()
+
+
+@dataclass
+class ShardState:
+    channel: socket.socket
+    capacity: int = 0
+    free: int = 0
+    waiting: int = 0
+    online: int = 0
+    known: int = 0
+
+
+class Coordinator:
+    """
+    Runs `shards` web server processes on one port and decides which shard serves
+    every connection
+    Notes:
+        a resume token goes to the shard holding its user so reconnects find their game,
+        usernames are only unique within a shard so users are known by username and nonce,
+        a new client goes to a shard with a player waiting for an opponent, or to
+        one with free slots when its own shard has none, game servers go to the
+        shard that spawned them or else to the one with the least capacity, later
+        links of a game server follow its first one
+        shards talk to it over a SOCK_SEQPACKET unix socket, one packet per message
+        with the fd of the routed connection attached
+    """
+
+    logger = get_logger("coordinator", split=" ")
+    PORT = WebServer.PORT
+
+    def __init__(
+        self,
+        shards: int,
+        use_asyncio: bool = False,
+        user_ttl: float = WebServer.USER_TTL,
+        pool: Optional[Tuple] = None,
+        metrics_port: Optional[int] = None,
+    ):
+        self.path = os.path.join(tempfile.mkdtemp(), "coordinator.sock")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.listener.bind(self.path)
+        self.listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.shards: Dict[int, ShardState] = {}
+        self.indexes: Dict[int, int] = {}
+        self.owners: Dict[Tuple[str, str], int] = {}
+        self.spawned: Dict[int, int] = {}
+        self.servers: Dict[str, int] = {}
+        session_key = os.urandom(32)
+        # forking while another thread holds a lock, like a logging handler's, can deadlock the shard
+        context = multiprocessing.get_context("spawn")
+        self.processes = [
+            context.Process(
+                target=run_shard,
+                args=(index, self.path, self.PORT, use_asyncio, user_ttl, pool, metrics_port, session_key),
+                daemon=True,
+            )
+            for index in range(shards)
+        ]
+        self.sockets_thread = threading.Thread(target=self.handle_sockets)
+
+    def target(self, packet: Dict, origin: int) -> int:
+        if packet["kind"] == "game":
+            # every link of a game server goes where its first one went
+            index = self.servers.get(packet["server_id"], self.spawned.pop(packet["pid"], None))
+            if index not in self.shards:
+                index = min(self.shards, key=lambda index: (self.shards[index].capacity, index != origin))
+            if packet["server_id"]:
+                self.servers[packet["server_id"]] = index
+            return index
+        owner = self.owners.get((packet["username"], packet["nonce"]))
+        if owner in self.shards:
+            return owner
+        for index, shard in self.shards.items():
+            if shard.waiting > 0:
+                # assume it's taken until the shard reports again
+                shard.waiting -= 1
+                return index
+        if self.shards[origin].free > 0:
+            return origin
+        return max(self.shards, key=lambda index: (self.shards[index].free, index == origin))
+
+    def handle_packet(self, channel: socket.socket):
+        packet, conn = recv_packet(channel)
+        origin = self.indexes.get(channel.fileno())
+        if packet is None:
+            self.logger.error("Shard %s is gone", origin)
+            self.selector.unregister(channel)
+            self.shards.pop(self.indexes.pop(channel.fileno(), None), None)
+            channel.close()
+            return
+        op = packet["op"]
+        if op == "hello":
+            self.indexes[channel.fileno()] = packet["shard"]
+            self.shards[packet["shard"]] = ShardState(channel)
+        elif op == "route":
+            with conn:
+                index = self.target(packet, origin)
+                try:
+                    send_packet(self.shards[index].channel, {"op": "adopt"}, conn)
+                except OSError as e:
+                    self.logger.error("Couldn't hand a connection to shard %d %s", index, e)
+        elif op == "state":
+            shard = self.shards[origin]
+            shard.capacity, shard.free, shard.waiting = packet["capacity"], packet["free"], packet["waiting"]
+            shard.online, shard.known = packet["online"], packet["known"]
+        elif op == "spawn":
+            self.spawned[packet["pid"]] = origin
+        elif op == "user":
+            self.owners[packet["username"], packet["nonce"]] = origin
+        elif op == "forget":
+            if self.owners.get((packet["username"], packet["nonce"])) == origin:
+                del self.owners[packet["username"], packet["nonce"]]
+
+    @defensive(logger.error)
+    def handle_sockets(self):
+        for process in self.processes:
+            process.start()
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.listener:
+                    channel, _ = self.listener.accept()
+                    self.selector.register(channel, selectors.EVENT_READ)
+                else:
+                    self.handle_packet(key.fileobj)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        os.unlink(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+    def start(self):
+        self.logger.info("Coordinator started with %d shards", len(self.processes))
+        self.sockets_thread.daemon = True
+        self.sockets_thread.start()
+        while True:
+            print("Commands\n/users")
+            cmd = input().strip()
+            if cmd == "/exit":
+                self.stop()
+                self.logger.warning("Exiting...")
+                exit(0)
+            if cmd == "/users":
+                shards = list(self.shards.items())
+                online = sum(shard.online for _, shard in shards)
+                known = sum(shard.known for _, shard in shards)
+                print(f'Number of online users is {online} of {known} known')
+                for index, shard in sorted(shards, key=lambda item: item[0]):
+                    print(f'Shard {index}: {shard.online} online, {shard.free} of {shard.capacity} slots free')
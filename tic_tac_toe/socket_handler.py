@@ -1,77 +1,614 @@
+import asyncio
+import queue
 import socket
 import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from itertools import count
 from logging import ERROR
-from typing import List, Dict, Optional
+from typing import Deque, List, Dict, Optional, Callable, Union, Iterable
 
-from tic_tac_toe.messages import Message, get_message, Acc, serialize, MessageType
+from tic_tac_toe.codec import JSON_DELIMITER, JSON_FORMATS, WIRE_FORMATS, FrameError, SharedFrame, decode_view, encode_frame
+from tic_tac_toe.messages import Message, Acc, Codes, MessageType, WireFormat, HandShake
 from tic_tac_toe.logger import get_logger
+from tic_tac_toe.metrics import ACK_SECONDS, BYTES_RECEIVED, BYTES_SENT, MESSAGES_RECEIVED, MESSAGES_SENT, REGISTRY
+
+
+def set_no_delay(conn):
+    """
+    Turn off Nagle's algorithm on a TCP socket, every frame is a whole message to be sent right away
+    Notes:
+        with it on, a small frame waits for the ack of the previous one, about 40ms with delayed acks
+    """
+    if conn is not None and conn.family in (socket.AF_INET, socket.AF_INET6):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class FrameDecoder:
+    """
+    Splits a byte stream into messages, JSON and binary frames can be mixed
+    Notes:
+        doesn't touch the socket so it can be fed by both
+        the threaded `SocketHandler` and `AsyncSocketHandler`
+        bytes are received straight into `buffer` with `reserve` and `received`,
+        frames are decoded from memoryview slices of it, `buffer[start:end]` is
+        not decoded yet and `scan` is where the JSON delimiter search resumes
+        so a frame split over many reads is scanned once
+        undecoded bytes are moved to the front only when the free tail is too
+        small for the next read and the buffer is replaced by a bigger one
+        only when that isn't enough, it's never resized so exported views are fine
+        the read size doubles after every full read and halves after small ones
+    """
+
+    logger = get_logger("frame", split=" ", level=ERROR)
+    MIN_CHUNK = 1024
+    MAX_CHUNK = 1 << 16
+    IDLE_SIZE = 1 << 16
+
+    def __init__(self):
+        self.buffer = bytearray(4 * self.MIN_CHUNK)
+        self.start = self.end = self.scan = 0
+        self.chunk_size = self.MIN_CHUNK
+
+    def reserve(self, size: int = 0) -> memoryview:
+        """
+        Writable view of the next `size` or `chunk_size` free bytes
+        """
+        size = size or self.chunk_size
+        if len(self.buffer) - self.end < size:
+            unread = self.end - self.start
+            if unread + size > len(self.buffer):
+                buffer = bytearray(max(2 * len(self.buffer), unread + size))
+                buffer[:unread] = memoryview(self.buffer)[self.start:self.end]
+                self.buffer = buffer
+            else:
+                self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.scan -= self.start
+            self.start, self.end = 0, unread
+        return memoryview(self.buffer)[self.end:self.end + size]
+
+    def received(self, size: int) -> List[Message]:
+        """
+        `size` bytes were written to the view returned by `reserve()`
+        """
+        if size == self.chunk_size:
+            self.chunk_size = min(2 * size, self.MAX_CHUNK)
+        elif size < self.chunk_size // 4:
+            self.chunk_size = max(self.chunk_size // 2, self.MIN_CHUNK)
+        self.end += size
+        return self.decode()
+
+    def feed(self, data: bytes) -> List[Message]:
+        with self.reserve(len(data)) as view:
+            view[:] = data
+        self.end += len(data)
+        return self.decode()
+
+    def decode(self) -> List[Message]:
+        new_messages: List[Message] = []
+        with memoryview(self.buffer) as view:
+            self.start, self.scan = decode_view(
+                self.buffer, view, new_messages, self.start, self.end, self.scan
+            )
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
+            if len(self.buffer) > max(self.IDLE_SIZE, 2 * self.chunk_size):
+                self.buffer = bytearray(4 * self.MIN_CHUNK)
+        if new_messages:
+            self.logger.info("New messages %s remain: %d bytes", new_messages, self.end - self.start)
+        return new_messages
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class AckStore:
+    """
+    Futures of messages waiting for an acc, keyed by message id
+    Notes:
+        ids are added in increasing order so expired ones are dropped from the front,
+        when more than `MAX_SIZE` are waiting the oldest one gets None
+        like a timeout so the store never grows without bound
+    """
+
+    MAX_SIZE = 1024
+
+    def __init__(self):
+        self.futures: "OrderedDict[int, Union[Future, asyncio.Future]]" = OrderedDict()
+        self.deadlines: Dict[int, float] = {}
+        self.sent: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.futures)
+
+    def add(self, message_id: int, future: Union[Future, "asyncio.Future"], timeout: float):
+        self.expire()
+        while len(self.futures) >= self.MAX_SIZE:
+            self.resolve(next(iter(self.futures)), None)
+        now = time.monotonic()
+        self.futures[message_id] = future
+        self.deadlines[message_id] = now + timeout
+        self.sent[message_id] = now
+
+    def resolve(self, message_id: int, acc: Optional[Acc]) -> bool:
+        future = self.futures.pop(message_id, None)
+        self.deadlines.pop(message_id, None)
+        sent = self.sent.pop(message_id, None)
+        if future is None:
+            return False
+        if acc is not None and REGISTRY.enabled:
+            ACK_SECONDS.observe(time.monotonic() - sent)
+        if not future.done():
+            future.set_result(acc)
+        return True
+
+    def resolve_acc(self, acc: Acc) -> bool:
+        """
+        Resolve every id acknowledged by `acc`, False if nobody waited for it
+        """
+        found = self.resolve(acc.message_id, acc)
+        for message_id in acc.message_ids or ():
+            found = self.resolve(message_id, acc) or found
+        return found
+
+    def expire(self):
+        now = time.monotonic()
+        while self.futures:
+            message_id = next(iter(self.futures))
+            if self.deadlines[message_id] > now:
+                return
+            self.resolve(message_id, None)
+
+    def clear(self):
+        for message_id in list(self.futures):
+            self.resolve(message_id, None)
 
 
 class SocketHandler:
+    """
+    Notes:
+        a single reader thread owns `recv`, it resolves pending accs and
+        queues every other message so waiters sleep instead of polling,
+        bytes it can't decode close the connection like the peer leaving does,
+        callbacks given to `on_close` are then called from the reader thread
+        a single writer thread owns `send`, every frame queued since its last
+        write goes out in one `sendmsg` call
+        when more than `MAX_PENDING` bytes are queued the sender waits for the
+        writer, or the peer is disconnected if `disconnect_slow` is set
+        only messages that wait for an acc ask for one, except on JSON connections
+        where the peer may predate `Message.ack` and can't parse it
+    """
+
     logger = get_logger("socket", split=" ", level=ERROR)
-    CHUNK_SIZE = 1024
-    DELIMITER = b";"
+    DELIMITER = JSON_DELIMITER
+    MAX_PENDING = 1 << 20
+    MAX_BATCH = 1024
 
-    def __init__(self, conn: socket.socket):
+    def __init__(self, conn: socket.socket, disconnect_slow: bool = False):
         self.lock = threading.Lock()
+        self.has_frames = threading.Condition(self.lock)
+        self.has_room = threading.Condition(self.lock)
+        self.outbox: Deque[bytes] = deque()
+        self.pending = 0
+        self.disconnect_slow = disconnect_slow
         self.socket = conn
-        self.buffer: List[Message] = []
-        self.accs: Dict[str, Acc] = {}
-        self.remain = b""
+        set_no_delay(conn)
+        self.buffer: "queue.SimpleQueue[Optional[Message]]" = queue.SimpleQueue()
+        self.accs = AckStore()
+        self.decoder = FrameDecoder()
+        self.wire_format = WireFormat.JSON
+        self.message_ids = count(1)
+        self.closed = threading.Event()
+        self.close_callbacks: List[Callable[[], None]] = []
+        self.closing = False
+        self.last_received = time.monotonic()
+        self.reader = threading.Thread(target=self.read_messages, daemon=True)
+        self.reader.start()
+        self.writer = threading.Thread(target=self.write_messages, daemon=True)
+        self.writer.start()
 
     def fill_buffer(self) -> bool:
-        data = self.socket.recv(self.CHUNK_SIZE)
-        if not data:
+        try:
+            with self.decoder.reserve() as view:
+                size = self.socket.recv_into(view)
+        except OSError:
+            size = 0
+        if not size:
+            return False
+        self.last_received = time.monotonic()
+        BYTES_RECEIVED.inc(amount=size)
+        try:
+            new_messages = self.decoder.received(size)
+        except FrameError as error:
+            self.logger.error("Closing connection, %s", error)
+            self.shutdown()
             return False
-        self.remain += data
-        raw_messages = self.remain.split(self.DELIMITER)
-        if len(raw_messages) and len(raw_messages[-1]):
-            self.remain = raw_messages[-1]
-            raw_messages = raw_messages[:-1]
-        else:
-            self.remain = b""
-        if len(raw_messages) and not raw_messages[-1]:
-            raw_messages = raw_messages[:-1]
-        new_messages = list(map(get_message, raw_messages))
         for message in new_messages:
+            MESSAGES_RECEIVED.inc(message.message_type)
             if message.message_type == MessageType.ACC:
-                self.accs[message.message_id] = message
-        self.buffer.extend(new_messages)
-        if len(raw_messages):
-            self.logger.info("New messages %s remain: %s", raw_messages, self.remain)
-            return True
-        return False
+                with self.lock:
+                    if self.accs.resolve_acc(message):
+                        continue
+            self.buffer.put(message)
+        return True
 
-    def get_next_message(self) -> Message:
-        # self.lock.acquire()
+    def read_messages(self):
+        while self.fill_buffer():
+            pass
+        self.logger.info("Connection closed")
+        with self.lock:
+            self.closed.set()
+            callbacks, self.close_callbacks = self.close_callbacks, []
+            self.has_frames.notify_all()
+            self.has_room.notify_all()
+            self.accs.clear()
+        self.buffer.put(None)
+        for callback in callbacks:
+            callback()
+
+    def on_close(self, callback: Callable[[], None]):
+        """
+        Call `callback` once the connection is closed, right away when it already is
+        """
+        with self.lock:
+            if not self.closed.is_set():
+                self.close_callbacks.append(callback)
+                return
+        callback()
+
+    def shutdown(self):
+        """
+        Close both directions, the reader sees it and runs the usual close path
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def enqueue(self, data: bytes) -> bool:
+        """
+        Queue a frame for the writer, False when the connection is gone
+        """
+        with self.lock:
+            while self.outbox and self.pending + len(data) > self.MAX_PENDING and not self.closed.is_set():
+                if self.disconnect_slow:
+                    self.logger.error("Peer is too slow, %d bytes pending", self.pending)
+                    self.shutdown()
+                    return False
+                self.has_room.wait()
+            if self.closed.is_set():
+                return False
+            self.outbox.append(data)
+            self.pending += len(data)
+            self.has_frames.notify()
+        return True
+
+    def write_messages(self):
         while True:
-            if len(self.buffer):
-                # self.lock.release()
-                return self.buffer.pop(0)
-            else:
-                self.fill_buffer()
-                time.sleep(0)
-                continue
+            with self.lock:
+                while not self.outbox and not self.closed.is_set() and not self.closing:
+                    self.has_frames.wait()
+                if self.closed.is_set():
+                    return
+                if not self.outbox:
+                    break
+                frames = [self.outbox.popleft() for _ in range(min(len(self.outbox), self.MAX_BATCH))]
+            try:
+                self.send_frames(frames)
+            except OSError:
+                self.shutdown()
+                return
+            sent = sum(map(len, frames))
+            BYTES_SENT.inc(amount=sent)
+            with self.lock:
+                self.pending -= sent
+                self.has_room.notify_all()
+        self.shutdown()
+
+    def close(self):
+        """
+        Shut the connection down once every queued frame is written
+        """
+        with self.lock:
+            self.closing = True
+            self.has_frames.notify()
+
+    def send_frames(self, frames: List[bytes]):
+        if not hasattr(self.socket, "sendmsg"):
+            self.socket.sendall(b"".join(frames))
+            return
+        while frames:
+            sent = self.socket.sendmsg(frames)
+            done = 0
+            while done < len(frames) and sent >= len(frames[done]):
+                sent -= len(frames[done])
+                done += 1
+            frames = frames[done:]
+            if frames:
+                frames[0] = memoryview(frames[0])[sent:]
+
+    @property
+    def backlog(self) -> int:
+        """
+        Bytes queued for the peer that weren't written yet
+        """
+        return self.pending
+
+    def get_next_message(self) -> Message:
+        message = self.buffer.get()
+        if message is None:
+            self.buffer.put(None)
+            raise ConnectionClosed()
+        return message
+
+    def get_received_messages(self, limit: int) -> List[Message]:
+        """
+        Up to `limit` messages that are already received, doesn't block
+        Notes:
+            stops before the close sentinel so the next `get_next_message` raises
+        """
+        received = []
+        while len(received) < limit:
+            try:
+                message = self.buffer.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                self.buffer.put(None)
+                break
+            received.append(message)
+        return received
 
     def send_acc(
-        self, message_id: str, result: int = 0, text: str = "OK"
+        self,
+        message_id: str,
+        result: int = 0,
+        text: str = "OK",
+        wire_format: Optional[WireFormat] = None,
+        heartbeat: Optional[int] = None,
+        token: Optional[str] = None,
+        username: Optional[str] = None,
     ) -> Optional[Acc]:
-        return self.send_message(
-            Acc(result=result, message_id=message_id, text=text), wait_for_acc=False
+        """
+        Notes:
+            passing `wire_format` accepts peer's handshake, the acc itself
+            is still JSON and every later message uses the new format
+        """
+        acc = self.send_message(
+            Acc(
+                result=result, message_id=message_id, text=text, wire_format=wire_format,
+                heartbeat=heartbeat, token=token, username=username,
+            ),
+            wait_for_acc=False,
         )
+        if wire_format is not None:
+            self.wire_format = wire_format
+        return acc
+
+    def acknowledge(self, received: Iterable[Message]):
+        """
+        Acc every received message that asked for one
+        Notes:
+            peers that negotiated a binary format get a single batched acc,
+            JSON peers may not know `Acc.message_ids` so they get one each
+        """
+        message_ids = [
+            message.message_id for message in received
+            if message.ack and message.message_type not in (MessageType.ACC, MessageType.HEARTBEAT)
+        ]
+        if not message_ids:
+            return
+        if self.wire_format in JSON_FORMATS:
+            for message_id in message_ids:
+                self.send_acc(message_id)
+            return
+        self.send_message(Acc(
+            *Codes.OK, message_id=message_ids[0], message_ids=message_ids[1:] or None
+        ), wait_for_acc=False)
 
     def send_message(
         self, message: Message, wait_for_acc: bool, timeout: int = 5
     ) -> Optional[Acc]:
-        # self.lock.acquire()
         self.logger.info("Sending new message %s", message.message_type)
-        self.socket.sendall(serialize(message) + self.DELIMITER)
+        if message.message_type != MessageType.ACC:
+            message.message_id = next(self.message_ids)
+            message.ack = wait_for_acc or self.wire_format in JSON_FORMATS
+        data = encode_frame(message, self.wire_format)
+        MESSAGES_SENT.inc(message.message_type)
         if not wait_for_acc:
-            # self.lock.release()
+            self.enqueue(data)
+            return
+        future = Future()
+        with self.lock:
+            self.accs.add(message.message_id, future, timeout)
+        if not self.enqueue(data) or self.closed.is_set():
+            with self.lock:
+                self.accs.resolve(message.message_id, None)
+            return None
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.accs.resolve(message.message_id, None)
+            return None
+
+    def send_frame(self, frame: SharedFrame) -> bool:
+        self.logger.info("Sending shared message %s", frame.message.message_type)
+        MESSAGES_SENT.inc(frame.message.message_type)
+        return self.enqueue(frame.encode(self.wire_format))
+
+    def handshake(self, message: HandShake, timeout: int = 5) -> Optional[Acc]:
+        message.wire_formats = WIRE_FORMATS
+        acc = self.send_message(message, True, timeout)
+        if acc is not None and acc.wire_format is not None:
+            self.wire_format = acc.wire_format
+        return acc
+
+
+class AsyncSocketHandler(asyncio.BufferedProtocol):
+    """
+    `SocketHandler` counterpart for an asyncio event loop
+    Notes:
+        `send_message` never blocks, use `request` to wait for an acc
+        every received message is passed to `on_message` from the loop thread
+        frames sent during one loop iteration are written together by `flush`,
+        frames sent from other threads are handed to the loop first
+        a peer with more than `MAX_PENDING` unsent bytes is disconnected
+        if `disconnect_slow` is set
+    """
+
+    logger = get_logger("async-socket", split=" ", level=ERROR)
+    DELIMITER = JSON_DELIMITER
+    MAX_PENDING = SocketHandler.MAX_PENDING
+
+    def __init__(
+        self,
+        on_message: Callable[["AsyncSocketHandler", Message], None],
+        on_close: Callable[["AsyncSocketHandler"], None],
+    ):
+        self.on_message = on_message
+        self.on_close = on_close
+        self.transport: Optional[asyncio.Transport] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self.accs = AckStore()
+        self.decoder = FrameDecoder()
+        self.wire_format = WireFormat.JSON
+        self.message_ids = count(1)
+        self.peer = None
+        self.last_received = time.monotonic()
+        self.outbox: List[bytes] = []
+        self.pending = 0
+        self.disconnect_slow = False
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        self.transport = transport
+        set_no_delay(transport.get_extra_info("socket"))
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.accs.clear()
+        self.on_close(self)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.reserve()
+
+    def buffer_updated(self, nbytes: int):
+        self.last_received = time.monotonic()
+        BYTES_RECEIVED.inc(amount=nbytes)
+        try:
+            new_messages = self.decoder.received(nbytes)
+        except FrameError as error:
+            self.logger.error("Closing connection, %s", error)
+            self.transport.abort()
+            return
+        for message in new_messages:
+            MESSAGES_RECEIVED.inc(message.message_type)
+            if message.message_type == MessageType.ACC and self.accs.resolve_acc(message):
+                continue
+            self.on_message(self, message)
+
+    @property
+    def backlog(self) -> int:
+        buffered = self.transport.get_write_buffer_size() if self.transport is not None else 0
+        return self.pending + buffered
+
+    def close(self):
+        """
+        Close once every queued frame is written
+        """
+        self.flush()
+        self.transport.close()
+
+    def shutdown(self):
+        """
+        Drop the connection without flushing, for peers that stopped reading
+        """
+        self.transport.abort()
+
+    def send_acc(
+        self,
+        message_id: str,
+        result: int = 0,
+        text: str = "OK",
+        wire_format: Optional[WireFormat] = None,
+        heartbeat: Optional[int] = None,
+        token: Optional[str] = None,
+        username: Optional[str] = None,
+    ) -> Optional[Acc]:
+        """
+        Notes:
+            passing `wire_format` accepts peer's handshake, the acc itself
+            is still JSON and every later message uses the new format
+        """
+        acc = self.send_message(
+            Acc(
+                result=result, message_id=message_id, text=text, wire_format=wire_format,
+                heartbeat=heartbeat, token=token, username=username,
+            ),
+            wait_for_acc=False,
+        )
+        if wire_format is not None:
+            self.wire_format = wire_format
+        return acc
+
+    acknowledge = SocketHandler.acknowledge
+
+    def send_message(self, message: Message, wait_for_acc: bool = False) -> None:
+        assert not wait_for_acc, "use `request` to wait for acc"
+        self.write(message, ack=False)
+
+    def write(self, message: Message, ack: bool):
+        self.logger.info("Sending new message %s", message.message_type)
+        if self.transport.is_closing():
+            return
+        if message.message_type != MessageType.ACC:
+            message.message_id = next(self.message_ids)
+            message.ack = ack or self.wire_format in JSON_FORMATS
+        data = encode_frame(message, self.wire_format)
+        MESSAGES_SENT.inc(message.message_type)
+        self.append_frame(data)
+
+    def send_frame(self, frame: SharedFrame):
+        self.logger.info("Sending shared message %s", frame.message.message_type)
+        if self.transport.is_closing():
+            return
+        MESSAGES_SENT.inc(frame.message.message_type)
+        self.append_frame(frame.encode(self.wire_format))
+
+    def append_frame(self, data: bytes):
+        if threading.get_ident() != self.loop_thread:
+            # `outbox` belongs to the loop thread
+            self.loop.call_soon_threadsafe(self.append_frame, data)
             return
-        cur = time.time()
-        while message.message_id not in self.accs and (time.time() - cur) < timeout:
-            self.fill_buffer()
-        # self.lock.release()
-        return self.accs.get(message.message_id, None)
+        if not self.outbox:
+            self.loop.call_soon(self.flush)
+        self.outbox.append(data)
+        self.pending += len(data)
+
+    def flush(self):
+        frames, self.outbox = self.outbox, []
+        pending, self.pending = self.pending, 0
+        if self.transport.is_closing():
+            return
+        if self.disconnect_slow and self.transport.get_write_buffer_size() + pending > self.MAX_PENDING:
+            self.logger.error("Peer is too slow, %d bytes pending", self.transport.get_write_buffer_size())
+            self.transport.abort()
+            return
+        self.transport.writelines(frames)
+        BYTES_SENT.inc(amount=pending)
+
+    async def request(self, message: Message, timeout: int = 5) -> Optional[Acc]:
+        if self.transport.is_closing():
+            return None
+        future = self.loop.create_future()
+        self.write(message, ack=True)
+        self.accs.add(message.message_id, future, timeout)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.accs.resolve(message.message_id, None)
+            return None
@@ -1,211 +1,648 @@
+import argparse
+import copy
+import hmac
 import socket
 import threading
 import time
-from typing import Tuple, List, Optional
+from concurrent.futures import CancelledError
+from typing import Callable, Dict, Tuple, List, Optional
 
 from tic_tac_toe import DEFAULT_PORT
+from tic_tac_toe.codec import SharedFrame, negotiate
 from tic_tac_toe.defensive import defensive
+from tic_tac_toe.keepalive import KeepAlive
 from tic_tac_toe.logger import get_logger
 from tic_tac_toe.messages import (
     Message,
-    get_message,
     HandShake,
     SocketType,
     Acc,
-    serialize,
     GameType,
     MessageType,
     RequestNewGame,
     Codes,
-    GameFound, StartGame, WaitForOpponent, PlayerReconnected,
+    Difficulty,
+    GameFound, StartGame, WaitForOpponent, PlayerReconnected, GameEnded, WireFormat,
 )
-from tic_tac_toe.models import GameServerData, User
-from tic_tac_toe.socket_handler import SocketHandler
+from tic_tac_toe.matchmaking import Matchmaker, Ticket
+from tic_tac_toe.metrics import MOVE_SECONDS, REGISTRY, SESSION_RESUMES, serve_metrics
+from tic_tac_toe.models import GameServerData, GameSession, User
+from tic_tac_toe.pool import GameServerPool
+from tic_tac_toe.registry import UserRegistry
+from tic_tac_toe.routing import Router
+from tic_tac_toe.sessions import SessionTokens
+from tic_tac_toe.socket_handler import SocketHandler, ConnectionClosed
 
 
 class WebServer:
+    """
+    Notes:
+        a game server may open several links, every game is relayed over one of
+        them and moves to another link if its own closes or its peer goes silent
+        a client reconnects with the resume token of its first handshake, the last
+        `Result` and `YouCanMove` of its game are sent again from the `GameSession`
+        so the game server only hears of it when nothing was relayed yet
+        relayed results are encoded once per wire format, every player gets the same bytes
+    """
+
     logger = get_logger("web-server", split=" ")
     HOST = "127.0.0.1"
     PORT = DEFAULT_PORT
+    USER_TTL = 600.0
+    BACKLOG = socket.SOMAXCONN
+    REUSE_PORT = False
 
-    def __init__(self):
+    def __init__(self, user_ttl: float = USER_TTL, session_key: Optional[bytes] = None):
         self.logger.info("New webserver on port %d", self.PORT)
         self.server_socket = None
         self.sockets_thread = threading.Thread(target=self.handle_sockets)
         self.game_servers: List[GameServerData] = []
-        self.users: List[User] = []
-        self.lock = threading.Lock()
+        self.users = UserRegistry(user_ttl)
+        self.matchmaker = Matchmaker()
+        self.tickets: Dict[int, Ticket] = {}
+        self.router = Router()
+        self.pool: Optional[GameServerPool] = None
+        self.keep_alive = KeepAlive()
+        self.servers_lock = threading.Lock()
+        self.server_ids: Dict[str, GameServerData] = {}
+        self.tokens = SessionTokens(session_key)
+        self.register_metrics()
 
-    def handle_game_server_socket(self, socket_handler: SocketHandler):
-        self.logger.info("New game socket")
-        game = GameServerData(socket_handler, 0)
-        self.game_servers.append(game)
-        while True:
-            message = socket_handler.get_next_message()
-            if message.message_type != MessageType.ACC:
-                game.socket_handler.send_acc(message.message_id)
-            self.logger.info("Game server said %s %s", message.message_type, message)
-            if message.message_type == MessageType.RESULT:
-                for user in game.users:
-                    if not user.is_bot:
-                        user.socket_handler.send_message(message, False)
-            elif message.message_type == MessageType.GAME_ENDED:
-                for user in game.users:
-                    if not user.is_bot:
-                        user.socket_handler.send_message(message, False)
-                        user.game_server = None
-                self.logger.info("Game ended")
-                game.users = []
-                game.number_of_users = 0
-            elif message.message_type == MessageType.YOU_CAN_MOVE:
-                for user in game.users:
-                    if user.username == message.user:
-                        self.logger.info("User %s can move now", user.username)
-                        user.socket_handler.send_message(message, False)
-            elif message.message_type == MessageType.SEND_MESSAGE:
-                for user in game.users:
-                    if user.username == message.target:
-                        user.socket_handler.send_message(message, False)
-
-    def get_empty_server(
-            self, game_type: GameType, block: bool
-    ) -> Optional[GameServerData]:
-        self.lock.acquire()
-        while True:
-            if game_type == GameType.MULTI_PLAYER:
-                for game_server_data in self.game_servers:
-                    if game_server_data.number_of_users == 1:
-                        game_server_data.number_of_users += 1
-                        self.lock.release()
-                        return game_server_data
-                for game_server_data in self.game_servers:
-                    if game_server_data.number_of_users == 0:
-                        game_server_data.number_of_users += 1
-                        self.lock.release()
-                        return game_server_data
+    def register_metrics(self):
+        """
+        Gauges that read this server's state whenever metrics are rendered
+        """
+        REGISTRY.gauge("ttt_users_online", "Connected users", function=lambda: self.users.online)
+        REGISTRY.gauge("ttt_users_known", "Users that can still reconnect", function=lambda: len(self.users))
+        REGISTRY.gauge("ttt_game_servers", "Connected game servers", function=lambda: len(self.game_servers))
+        REGISTRY.gauge(
+            "ttt_free_slots", "Games the connected game servers can still host",
+            function=lambda: sum(server.free_slots for server in list(self.game_servers)),
+        )
+        REGISTRY.gauge(
+            "ttt_games_active", "Games hosted by the connected game servers",
+            function=lambda: sum(len(server.games) for server in list(self.game_servers)),
+        )
+        REGISTRY.gauge(
+            "ttt_games_waiting_for_opponent", "Multiplayer games with one player",
+            function=lambda: len(self.matchmaker.half_full),
+        )
+        REGISTRY.gauge("ttt_matchmaking_queued", "Players waiting for a free slot", "game_type", self.queued)
+        REGISTRY.gauge(
+            "ttt_outbox_bytes", "Bytes queued for peers that weren't written yet",
+            function=lambda: sum(handler.backlog for handler in self.connections()),
+        )
+        REGISTRY.gauge(
+            "ttt_acks_pending", "Sent messages waiting for an acc",
+            function=lambda: sum(len(handler.accs) for handler in self.connections()),
+        )
+
+    def queued(self) -> Dict[GameType, int]:
+        with self.matchmaker.lock:
+            return {game_type: len(tickets) for game_type, tickets in self.matchmaker.waiting.items()}
+
+    def connections(self) -> List[SocketHandler]:
+        """
+        Sockets of online users and links to game servers
+        """
+        with self.users.lock:
+            handlers = [user.socket_handler for user in self.users.by_connection.values()]
+        for server in list(self.game_servers):
+            handlers.extend(server.links)
+        return handlers
+
+    def add_game_server(self, socket_handler: SocketHandler, message: HandShake) -> Optional[GameServerData]:
+        """
+        Acc the handshake of a game server link, a game server that came back is told its games were kept
+        Returns:
+            None for a game server without `capacity`, it predates game ids so nothing it sends could be routed
+        """
+        if not message.capacity:
+            self.logger.error("Game server without capacity, it doesn't tag messages with game ids")
+            socket_handler.send_acc(message.message_id, *Codes.NO_GAME_IDS)
+            socket_handler.close()
+            return None
+        if message.heartbeat:
+            self.keep_alive.add(socket_handler, message.heartbeat)
+            self.start_keep_alive()
+        with self.servers_lock:
+            server = self.server_ids.get(message.server_id) if message.server_id else None
+            recovered = server is not None and server.lost_at is not None
+            # the acc goes out before the link can carry a game
+            socket_handler.send_acc(
+                message.message_id,
+                *(Codes.RECOVERED if recovered else Codes.OK),
+                wire_format=negotiate(message.wire_formats),
+                heartbeat=self.keep_alive.interval_ms if message.heartbeat else None,
+            )
+            if recovered:
+                self.logger.warning("Game server %s is back with %d games", server.server_id, len(server.games))
+                server.lost_at = None
+                server.links = [socket_handler]
+            elif server is not None:
+                server.links.append(socket_handler)
+                self.logger.info("New link to game server %s, %d links", server.server_id, len(server.links))
+                return server
             else:
-                for game_server_data in self.game_servers:
-                    if game_server_data.number_of_users == 0:
-                        game_server_data.number_of_users += 2
-                        bot = User(None, None, "BOT", is_bot=True)
-                        game_server_data.users.append(bot)
-                        self.lock.release()
-                        return game_server_data
-            if not block:
-                self.lock.release()
-                return None
-            self.lock.release()
-            time.sleep(1)
-            self.lock.acquire()
+                self.logger.info("New game socket with %s slots", message.capacity)
+                server = GameServerData(
+                    [socket_handler], message.capacity, server_id=message.server_id, recovery=message.recovery
+                )
+                self.game_servers.append(server)
+                if message.server_id:
+                    self.server_ids[message.server_id] = server
+        if self.pool is not None:
+            self.pool.attach(server, message.pid)
+        if recovered:
+            for game in list(server.games.values()):
+                game.link = server.link_for(game.game_id)
+                self.resend_game(game)
+        self.matchmaker.add_server(server)
+        return server
+
+    def start_keep_alive(self):
+        self.keep_alive.start()
+
+    def remove_link(self, server: GameServerData, link: SocketHandler):
+        self.keep_alive.remove(link)
+        with self.servers_lock:
+            last = server.links == [link]
+            hold = last and bool(server.recovery) and bool(server.games)
+            if last and not hold:
+                self.server_ids.pop(server.server_id, None)
+            elif link in server.links and not last:
+                server.links.remove(link)
+        if hold:
+            self.hold_game_server(server)
+            return
+        if last:
+            self.remove_game_server(server)
+            return
+        self.logger.warning("Lost a link to game server %s, %d left", server.server_id, len(server.links))
+        for game in list(server.games.values()):
+            if game.link is not link:
+                continue
+            game.link = server.link_for(game.game_id)
+            self.resend_game(game)
+
+    def resend_game(self, game: GameSession):
+        """
+        Have the game server resend the state of a started game, what its old link carried may be lost
+        """
+        if game.confirmed == sum(not user.is_bot for user in game.users):
+            for user in game.users:
+                if not user.is_bot:
+                    game.link.send_message(PlayerReconnected(user.username, game_id=game.game_id), False)
+
+    def hold_game_server(self, server: GameServerData):
+        """
+        Keep the games of a lost game server that journals them for `recovery` ms, a restart of it resumes them
+        """
+        self.logger.error(
+            "Lost game server %s, keeping its %d games for %dms", server.server_id, len(server.games), server.recovery
+        )
+        lost_at = server.lost_at = time.monotonic()
+        self.matchmaker.suspend(server)
+        self.call_later(server.recovery / 1000, self.expire_game_server, server, lost_at)
+
+    def expire_game_server(self, server: GameServerData, lost_at: float):
+        with self.servers_lock:
+            if server.lost_at != lost_at:
+                return
+            self.server_ids.pop(server.server_id, None)
+        self.remove_game_server(server)
+
+    def call_later(self, delay: float, callback: Callable, *args):
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+
+    def close_game_server(self, server: GameServerData):
+        for link in list(server.links):
+            link.shutdown()
+
+    def remove_game_server(self, server: GameServerData):
+        self.logger.error("Game server disconnected")
+        with self.servers_lock:
+            self.game_servers.remove(server)
+        if self.pool is not None:
+            self.pool.detach(server)
+        self.matchmaker.remove_server(server)
+        for game in list(server.games.values()):
+            self.router.leave(game)
+            for user in game.users:
+                if not user.is_bot:
+                    self.game_lost(user, game)
+
+    @staticmethod
+    def game_lost(user: User, game: GameSession):
+        """
+        Tell `user` that `game` ended without a result, only while it's still the game of `user`
+        so a player is told once whether matchmaking or the removal of the game server noticed first
+        """
+        with user.session.lock:
+            if user.game is not game:
+                return
+            user.game = None
+            user.socket_handler.send_message(GameEnded(None, game_id=game.game_id), False)
+
+    def handle_game_server_message(self, server: GameServerData, message: Message, link: SocketHandler):
+        if message.message_type in (MessageType.ACC, MessageType.HEARTBEAT):
+            return
+        link.acknowledge([message])
+        self.logger.info("Game server said %s %s", message.message_type, message)
+        game = server.games.get(message.game_id)
+        if game is None:
+            self.logger.warning("Unknown game %s", message.game_id)
+            return
+        if message.message_type == MessageType.RESULT:
+            if game.moved_at is not None:
+                MOVE_SECONDS.observe(time.perf_counter() - game.moved_at)
+                game.moved_at = None
+            # a user resuming before the loop reaches it gets the result twice, it's the whole board
+            frame = game.result = SharedFrame(message)
+            game.turn = None
+            for user in game.users:
+                if not user.is_bot:
+                    with user.session.lock:
+                        user.socket_handler.send_frame(frame)
+        elif message.message_type == MessageType.GAME_ENDED:
+            frame = SharedFrame(message)
+            game.result = game.turn = None
+            for user in game.users:
+                if not user.is_bot:
+                    with user.session.lock:
+                        user.socket_handler.send_frame(frame)
+                    user.game = None
+            self.logger.info("Game ended")
+            self.router.leave(game)
+            self.matchmaker.release(game)
+        elif message.message_type == MessageType.YOU_CAN_MOVE:
+            for user in game.users:
+                if user.username != message.user or user.is_bot:
+                    continue
+                with user.session.lock:
+                    game.turn = SharedFrame(message)
+                    socket_handler = self.router.route(game.game_id, message.user)
+                    if socket_handler is not None:
+                        self.logger.info("User %s can move now", message.user)
+                        socket_handler.send_frame(game.turn)
+        elif message.message_type == MessageType.SEND_MESSAGE:
+            socket_handler = self.router.route(game.game_id, message.target)
+            if socket_handler is not None:
+                self.relay(socket_handler, message)
+
+    @staticmethod
+    def relay(socket_handler: SocketHandler, message: Message):
+        """
+        Forward a received message, sending stamps a new id on it so a copy is sent
+        """
+        socket_handler.send_message(copy.copy(message), False)
+
+    def handle_game_server_socket(self, socket_handler: SocketHandler, message: HandShake):
+        server = self.add_game_server(socket_handler, message)
+        if server is None:
+            return
+        try:
+            while True:
+                self.handle_game_server_message(server, socket_handler.get_next_message(), socket_handler)
+        finally:
+            self.remove_link(server, socket_handler)
 
     def new_game(self, user: User, message: RequestNewGame):
         self.logger.info("New game")
-        user.socket_handler.send_acc(message.message_id, *Codes.WAIT_FOR_EMPTY_SERVER)
+        socket_handler = user.socket_handler
+        socket_handler.send_acc(message.message_id, *Codes.WAIT_FOR_EMPTY_SERVER)
         self.logger.info("Wait for game")
-        user.game_server = self.get_empty_server(message.game_type, True)
-        user.game_server.users.append(user)
-
-        user.socket_handler.send_message(WaitForOpponent(), False)
-        while message.game_type == GameType.MULTI_PLAYER and user.game_server.number_of_users != 2:
-            time.sleep(0.1)
+        ticket = self.tickets[id(socket_handler)] = self.matchmaker.join(user, message.game_type, message.difficulty)
+        if socket_handler.closed.is_set():
+            # closed before the ticket was stored, the close path found nothing to cancel
+            self.leave_matchmaking(socket_handler)
+        try:
+            # the close path runs `leave_matchmaking`, which cancels the futures
+            user.game = ticket.game.result()
+            user.socket_handler.send_message(WaitForOpponent(), False)
+            ticket.ready.result()
+        except CancelledError:
+            self.logger.error("%s left matchmaking or its game server did", user.username)
+            if user.game is not None:
+                self.game_lost(user, user.game)
+            return
+        finally:
+            self.tickets.pop(id(socket_handler), None)
         self.logger.info("Found game")
-        opp = (
-            user.game_server.users[0]
-            if user.game_server.users[0] != user.username
-            else user.game_server.users[1]
-        )
+        self.router.join(user.game)
+        self.game_found(user)
+
+    def leave_matchmaking(self, socket_handler: SocketHandler):
+        ticket = self.tickets.pop(id(socket_handler), None)
+        if ticket is not None:
+            self.matchmaker.cancel(ticket)
+
+    def game_found(self, user: User):
+        game = user.game
+        opp = self.router.opponent(user)
         acc = user.socket_handler.send_message(
             GameFound(opp.username), wait_for_acc=True
         )
         if acc is None:
             self.logger.error("User disconnected")
+            self.abort_game(game)
             return
-        else:
-            self.logger.info("Acc game found %d %s", acc.result, acc.text)
-            user.game_server.socket_handler.send_message(StartGame(
+        self.logger.info("Acc game found %d %s", acc.result, acc.text)
+        self.start_game(game)
+
+    def abort_game(self, game: GameSession):
+        """
+        A player didn't accept `game`, it's released and everyone in it is told it ended
+        """
+        if not self.matchmaker.release(game):
+            return
+        self.router.leave(game)
+        for user in game.users:
+            if user.is_bot:
+                continue
+            if user.game is game:
+                user.game = None
+            user.socket_handler.send_message(GameEnded(None, game_id=game.game_id), False)
+
+    def start_game(self, game: GameSession):
+        if self.matchmaker.confirm(game):
+            game.link.send_message(StartGame(
                 [
-                    user.game_server.users[0].username,
-                    user.game_server.users[1].username,
-                ]
+                    game.users[0].username,
+                    game.users[1].username,
+                ],
+                game_id=game.game_id,
+                difficulty=game.difficulty,
             ), False)
 
+    @staticmethod
+    def valid_request(message: RequestNewGame) -> bool:
+        try:
+            GameType(message.game_type)
+            if message.difficulty is not None:
+                Difficulty(message.difficulty)
+        except ValueError:
+            return False
+        return True
+
+    def handle_client_message(self, user: User, message: Message):
+        self.logger.info("Client said %s %s", message.message_type, message)
+        if message.message_type == MessageType.NEW_GAME_REQUEST:
+            if not self.valid_request(message):
+                self.logger.warning("%s asked for game type %s at difficulty %s",
+                                    user.username, message.game_type, message.difficulty)
+                user.socket_handler.send_acc(message.message_id, *Codes.INVALID_GAME_REQUEST)
+                return
+            self.new_game(user, message)
+            return
+        if message.message_type not in (MessageType.SEND_MESSAGE, MessageType.MAKE_MOVE, MessageType.EXIT):
+            return
+        if user.game is None:
+            self.logger.warning("%s isn't in a game", user.username)
+            return
+        message.game_id = user.game.game_id
+        if message.message_type == MessageType.SEND_MESSAGE:
+            opponent = self.router.opponent(user)
+            if opponent is None:
+                self.logger.warning("%s has no opponent yet", user.username)
+                return
+            message.target = opponent.username
+            self.logger.info("%s said to %s %s", user.username, message.target, message.text)
+            self.relay(user.game.link, message)
+        else:
+            if message.message_type == MessageType.MAKE_MOVE and REGISTRY.enabled:
+                user.game.moved_at = time.perf_counter()
+            user.socket_handler.acknowledge([message])
+            self.relay(user.game.link, message)
+
     def handle_client_socket(self, socket_handler: SocketHandler, user: User):
         self.logger.info("New client")
-        while True:
-            message = socket_handler.get_next_message()
-            self.logger.info("Client said %s %s", message.message_type, message)
-            if message.message_type == MessageType.NEW_GAME_REQUEST:
-                self.new_game(user, message)
-            elif message.message_type == MessageType.SEND_MESSAGE:
-                message.target = (
-                    user.game_server.users[0].username if user.game_server.users[0].username != user.username else
-                    user.game_server.users[1].username)
-                self.logger.info("%s said to %s %s", user.username, message.target, message.text)
-                user.game_server.socket_handler.send_message(message, False)
-            elif message.message_type in (MessageType.MAKE_MOVE, MessageType.EXIT):
-                user.socket_handler.send_acc(message.message_id)
-                user.game_server.socket_handler.send_message(message, False)
+        socket_handler.on_close(lambda: self.leave_matchmaking(socket_handler))
+        try:
+            while True:
+                self.handle_client_message(user, socket_handler.get_next_message())
+        finally:
+            self.remove_client(socket_handler)
 
-    @defensive(logger.error)
-    def handle_socket(self, socket_handler: SocketHandler):
-        message = socket_handler.get_next_message()
-        self.logger.info("Handle socket %s", message)
-        if message.socket_type == SocketType.GAME:
-            socket_handler.send_acc(message.message_id)
-            self.handle_game_server_socket(socket_handler)
-        elif message.socket_type == SocketType.CLIENT:
-            message: HandShake
+    def remove_client(self, socket_handler: SocketHandler):
+        self.leave_matchmaking(socket_handler)
+        user = self.users.disconnect(socket_handler)
+        if user is not None:
+            self.logger.info("User %s disconnected", user.username)
+
+    def add_client(self, socket_handler: SocketHandler, message: HandShake) -> Optional[User]:
+        """
+        Notes:
+            a client whose handshake has no `wire_formats` predates every field added to
+            the messages since, it's sent `LEGACY_JSON` so it can still build them
+        """
+        wire_format = negotiate(message.wire_formats)
+        if message.wire_formats is None:
+            socket_handler.wire_format = WireFormat.LEGACY_JSON
+        socket_handler.disconnect_slow = True
+        user = self.resume(socket_handler, message, wire_format) if message.username else None
+        if user is None:
             if message.username:
-                self.logger.info("%s reconnected", message.username)
-
-                for user in self.users:
-                    if user.username == message.username:
-                        user.socket_handler = socket_handler
-                        if user.game_server:
-                            socket_handler.send_acc(message.message_id, *Codes.IN_GAME)
-                        else:
-                            socket_handler.send_acc(message.message_id, text='Welcome back')
-                        if user.game_server:
-                            user.game_server.socket_handler.send_message(
-                                PlayerReconnected(user.username), False
-                            )
-                self.handle_client_socket(socket_handler, user)
+                self.logger.warning("Can't resume %s, registering it again", message.username)
+                user = User(socket_handler, None, message.username)
             else:
                 user = User(socket_handler, None)
-                self.users.append(user)
-                socket_handler.send_acc(message.message_id, text='Your username is ' + user.username)
-                self.handle_client_socket(socket_handler, user)
-        else:
-            self.logger.error("Unexpected socket type %s", message)
-            exit(3)
+            self.users.add(user)
+            socket_handler.send_acc(
+                message.message_id, text='Your username is ' + user.username, wire_format=wire_format,
+                token=self.tokens.issue(user.username, user.session.nonce), username=user.username,
+            )
+        return user
+
+    def resume(self, socket_handler: SocketHandler, message: HandShake, wire_format) -> Optional[User]:
+        """
+        Move the user of a valid resume token to `socket_handler` and send it what it missed
+        Returns:
+            the user, None when the token isn't valid for `message.username`
+        """
+        verified = self.tokens.verify(message.token)
+        user = None
+        if verified is not None and verified[0] == message.username:
+            user = self.users.get(message.username)
+        if user is None or not hmac.compare_digest(user.session.nonce, verified[1]):
+            SESSION_RESUMES.inc("rejected")
+            return None
+        token = message.token
+        with user.session.lock:
+            if not self.users.connect(user, socket_handler):
+                SESSION_RESUMES.inc("rejected")
+                return None
+            self.logger.info("%s reconnected", message.username)
+            self.router.reconnect(user)
+            game = user.game
+            if game is None:
+                socket_handler.send_acc(
+                    message.message_id, text='Welcome back', wire_format=wire_format, token=token,
+                    username=user.username,
+                )
+                SESSION_RESUMES.inc("idle")
+                return user
+            socket_handler.send_acc(
+                message.message_id, *Codes.IN_GAME, wire_format=wire_format, token=token, username=user.username,
+            )
+            missed = [game.result] if game.result is not None else []
+            if game.turn is not None and game.turn.message.user == user.username:
+                missed.append(game.turn)
+            for frame in missed:
+                socket_handler.send_frame(frame)
+        if missed:
+            SESSION_RESUMES.inc("cached")
+        elif game.link is not None and game.confirmed == sum(not player.is_bot for player in game.users):
+            # nothing was relayed yet, the game server knows where the game is
+            SESSION_RESUMES.inc("game_server")
+            game.link.send_message(PlayerReconnected(user.username, game_id=game.game_id), False)
+        return user
+
+    def valid_handshake(self, message: Message) -> bool:
+        """
+        A peer has to open with the handshake of a game server or a client, anything else only drops its connection
+        """
+        if isinstance(message, HandShake) and message.socket_type in (SocketType.GAME, SocketType.CLIENT):
+            return True
+        self.logger.error("Expected a handshake, got %s", message)
+        return False
+
+    @defensive(logger.error)
+    def handle_socket(self, socket_handler: SocketHandler):
+        try:
+            message = socket_handler.get_next_message()
+            self.logger.info("Handle socket %s", message)
+            if not self.valid_handshake(message):
+                socket_handler.close()
+            elif message.socket_type == SocketType.GAME:
+                self.handle_game_server_socket(socket_handler, message)
+            else:
+                user = self.add_client(socket_handler, message)
+                if user is not None:
+                    self.handle_client_socket(socket_handler, user)
+        except ConnectionClosed:
+            self.logger.info("Socket disconnected")
+
+    def listen(self) -> socket.socket:
+        """
+        Listening socket on `HOST`:`PORT`, other processes can bind the same port when `REUSE_PORT`
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.REUSE_PORT:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((self.HOST, self.PORT))
+        s.listen(self.BACKLOG)
+        return s
+
+    def adopt(self, conn: socket.socket):
+        """
+        Serve an accepted connection, safe to call from any thread
+        """
+        threading.Thread(target=self.handle_socket, args=(SocketHandler(conn),)).start()
 
     @defensive(logger.error)
     def handle_sockets(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        with self.listen() as s:
             self.server_socket = s
-            s.bind((self.HOST, self.PORT))
-            s.listen()
             while True:
                 conn, addr = s.accept()
-                sh = SocketHandler(conn)
                 self.logger.info("New socket connection by %s", addr)
-                threading.Thread(target=self.handle_socket, args=(sh,)).start()
+                self.adopt(conn)
+
+    def stop(self):
+        self.server_socket.close()
+        if self.pool is not None:
+            self.pool.stop()
 
     def start(self):
         self.logger.info("Web server started")
         self.sockets_thread.start()
+        if self.pool is not None:
+            self.pool.start()
         while True:
-            print("Commands\n/users")
+            print("Commands\n/users\n/servers\n/metrics")
             cmd = input().strip()
             if cmd == "/exit":
-                self.server_socket.close()
+                self.stop()
                 self.logger.warning("Exiting...")
                 exit(0)
             if cmd == "/users":
-                print(f'Number of online users is {len(self.users)}')
-                pass
+                print(f'Number of online users is {self.users.online} of {len(self.users)} known')
+            if cmd == "/servers":
+                slots = sum(server.free_slots for server in self.game_servers)
+                print(f'{len(self.game_servers)} game servers with {slots} free slots')
+            if cmd == "/metrics":
+                print(REGISTRY.render() if REGISTRY.enabled else "Metrics are off, start with --metrics")
 
 
 if __name__ == "__main__":
-    ws = WebServer()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--asyncio", action="store_true",
+        help="serve every socket from one asyncio event loop instead of a thread per socket",
+    )
+    parser.add_argument("--port", type=int, default=WebServer.PORT, help="port to listen on")
+    parser.add_argument(
+        "--user-ttl", type=float, default=WebServer.USER_TTL,
+        help="seconds a disconnected user is kept so it can reconnect",
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1,
+        help="number of web server processes sharing the port (linux only)",
+    )
+    parser.add_argument(
+        "--max-game-servers", type=int, default=0,
+        help="spawn and retire up to this many game server processes, 0 to only use the ones started by hand",
+    )
+    parser.add_argument("--min-game-servers", type=int, default=1, help="game server processes kept running")
+    parser.add_argument(
+        "--idle-game-servers", type=int, default=1,
+        help="game servers worth of free slots kept as warm spares",
+    )
+    parser.add_argument(
+        "--game-server-capacity", type=int, default=GameServerPool.CAPACITY,
+        help="games hosted by every spawned game server",
+    )
+    parser.add_argument(
+        "--journal-dir",
+        help="spawned game servers keep their games in journals here and resume them when restarted",
+    )
+    parser.add_argument("--archive-dir", help="spawned game servers archive finished games here")
+    parser.add_argument("--metrics", action="store_true", help="collect metrics, /metrics prints them")
+    parser.add_argument(
+        "--metrics-port", type=int, default=0,
+        help="also serve metrics over HTTP on this port, shard i uses this port + i",
+    )
+    args = parser.parse_args()
+    if args.shards > 1 and args.metrics and not args.metrics_port:
+        parser.error("shards can only expose metrics with --metrics-port")
+    WebServer.PORT = args.port
+    pool = None
+    if args.max_game_servers > 0:
+        pool = (
+            args.min_game_servers, args.max_game_servers, args.idle_game_servers, args.game_server_capacity,
+            GameServerPool.RETIRE_AFTER, args.journal_dir, args.archive_dir,
+        )
+    if args.shards > 1:
+        from tic_tac_toe.sharding import Coordinator
+
+        Coordinator.PORT = args.port
+        ws = Coordinator(args.shards, args.asyncio, args.user_ttl, pool, args.metrics_port or None)
+    else:
+        if args.asyncio:
+            from tic_tac_toe.async_web_server import AsyncWebServer
+
+            AsyncWebServer.PORT = args.port
+            ws = AsyncWebServer(args.user_ttl)
+        else:
+            ws = WebServer(args.user_ttl)
+        if pool is not None:
+            ws.pool = GameServerPool(ws, *pool)
+        if args.metrics:
+            REGISTRY.enable()
+        if args.metrics_port:
+            serve_metrics(WebServer.HOST, args.metrics_port)
     ws.start()